@@ -0,0 +1,127 @@
+"""Compare committing and pushing a fix through the working tree and index with the object-level commit path, against
+local bare repos of increasing size.
+
+Each round clones the remote with a full checkout, modifies a few files and times committing them to a new branch
+and pushing it: once as create_branch did before (index diff, checkout of a new branch, `git add -A` and commit), and
+once as create_branch does now, writing only the changed blobs and the trees on their paths.
+
+Usage: python benchmarks/branch_commit.py [--sizes 1000 10000 50000] [--changed 3] [--rounds 3]
+"""
+import argparse
+import logging
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from git import Repo  # noqa: E402
+
+from source_code import commit_files, configure_repo  # noqa: E402
+
+FILES_PER_DIRECTORY = 50
+SOURCE = (
+    "def handler(event, context):\n    return {{'statusCode': 200, 'body': '{}'}}\n"
+)
+
+
+def legacy_commit(branch_name, repo, commit_message):
+    """Commit through the index and working tree, as create_branch did. Return the pushed refspec."""
+    if repo.index.diff(None):
+        new_branch = repo.create_head(branch_name)
+        new_branch.checkout()
+        repo.git.add(A=True)
+        repo.git.commit(m=commit_message)
+        return branch_name
+
+
+def object_commit(branch_name, repo, commit_message, filenames):
+    """Commit through the object database, as create_branch does. Return the pushed refspec."""
+    commit = commit_files(repo, filenames, commit_message)
+    return f"{commit.hexsha}:refs/heads/{branch_name}"
+
+
+def create_remote(directory, size):
+    """Create a bare repo of `size` files in nested directories with git fast-import."""
+    subprocess.run(["git", "init", "-q", "--bare", directory], check=True)
+    commands = ["commit refs/heads/main", "committer a <a@b> 0 +0000", "data 4", "init"]
+    for i in range(size):
+        path = f"pkg_{i // FILES_PER_DIRECTORY // FILES_PER_DIRECTORY}/mod_{i // FILES_PER_DIRECTORY}/file_{i}.py"
+        data = SOURCE.format(i)
+        commands.extend([f"M 100644 inline {path}", f"data {len(data)}", data])
+    subprocess.run(
+        ["git", "fast-import", "--quiet"],
+        cwd=directory,
+        input="\n".join(commands).encode() + b"\n",
+        check=True,
+    )
+    subprocess.run(
+        ["git", "symbolic-ref", "HEAD", "refs/heads/main"], cwd=directory, check=True
+    )
+
+
+def measure(remote, workdir, size, changed, legacy):
+    """Return the durations of the commit, and of the commit and push."""
+    repo_dir = os.path.join(workdir, "clone")
+    repo = Repo.clone_from(remote, repo_dir)
+    configure_repo(repo)
+    filenames = [
+        repo.git.ls_files(f"*/file_{i * size // changed}.py") for i in range(changed)
+    ]
+    for filename in filenames:
+        with open(os.path.join(repo_dir, filename), "a") as f:
+            f.write("# fixed\n")
+    branch_name = f"fix-{time.perf_counter_ns()}"
+    try:
+        start = time.perf_counter()
+        if legacy:
+            refspec = legacy_commit(branch_name, repo, "Fix")
+        else:
+            refspec = object_commit(branch_name, repo, "Fix", filenames)
+        committed = time.perf_counter()
+        repo.git.push("origin", refspec)
+        return committed - start, time.perf_counter() - start
+    finally:
+        repo.close()
+        shutil.rmtree(repo_dir)
+
+
+def run(sizes, changed, rounds):
+    logging.disable(logging.INFO)
+    print(f"{changed} files changed, median of {rounds} rounds")
+    print(f"{'':>8} {'commit (s)':>21} {'commit and push (s)':>21}")
+    print(f"{'files':>8}" + f" {'index':>10} {'objects':>10}" * 2)
+    for size in sizes:
+        workdir = tempfile.mkdtemp()
+        try:
+            remote = os.path.join(workdir, "remote.git")
+            create_remote(remote, size)
+            durations = {True: [], False: []}
+            for _ in range(rounds):
+                for legacy in durations:
+                    durations[legacy].append(
+                        measure(remote, workdir, size, changed, legacy)
+                    )
+            print(
+                f"{size:>8}"
+                + "".join(
+                    f" {statistics.median(d[i] for d in durations[legacy]):>10.3f}"
+                    for i in (0, 1)
+                    for legacy in durations
+                )
+            )
+        finally:
+            shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--changed", type=int, default=3)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+    run(args.sizes, args.changed, args.rounds)
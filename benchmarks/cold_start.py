@@ -0,0 +1,113 @@
+"""Profile the import time of each Lambda handler in a fresh interpreter, and enforce a cold start budget.
+
+Each handler is imported with `python -X importtime`, and the median over the runs is compared with its budget.
+The functions other than fix_code must also not import any of the fix path dependencies. Exits with status 1 when a
+handler breaks its budget. With --build-dir, handlers are imported from the deployment packages built by
+cloudformation/package.sh instead of src/.
+
+Usage: python benchmarks/cold_start.py [--runs 5] [--budget-scale 1.0] [--build-dir .build]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+SOURCE_DIR = os.path.join(os.path.dirname(__file__), "..", "src")
+# Import time budget of each handler module, in milliseconds, including the clients created at import.
+BUDGETS_MS = {"detect_error": 400, "triage": 400, "schedule": 400, "fix_code": 500}
+FIX_PATH_MODULES = ("langchain", "black", "git", "requests", "openai")
+ENVIRONMENT = {
+    "PARAMETER_STORE_PREFIX": "/self-healing-code/",
+    "ISSUE_TABLE": "issues",
+    "SCHEDULER_TABLE": "scheduler",
+    "PENDING_QUEUE_URL": "https://sqs.us-east-1.amazonaws.com/123456789012/pending",
+    "WORKER_QUEUE_URL": "https://sqs.us-east-1.amazonaws.com/123456789012/worker",
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "fake",
+    "AWS_SECRET_ACCESS_KEY": "fake",
+}
+PROBE = "import sys, handlers.{handler}; print(' '.join(sorted(sys.modules)))"
+
+
+def import_profile(handler, source_dir):
+    """Import a handler in a fresh interpreter. Returns the total and per direct dependency import times in ms, and
+    the names of the modules loaded."""
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE.format(handler=handler)],
+        cwd=source_dir,
+        env={**os.environ, **ENVIRONMENT, "PYTHONPATH": source_dir},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    total = None
+    dependencies = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        # -X importtime reports a module after its own imports, so the direct dependencies precede the handler.
+        if name.strip() == f"handlers.{handler}":
+            total = int(cumulative) / 1000
+            break
+        if depth == 1:
+            dependencies[name.strip()] = int(cumulative) / 1000
+    return total, dependencies, set(process.stdout.split())
+
+
+def run(runs, budget_scale, build_dir):
+    print(
+        f"{'handler':<14} {'import ms':>10} {'budget ms':>10}  slowest direct imports"
+    )
+    failed = False
+    for handler, budget in BUDGETS_MS.items():
+        source_dir = SOURCE_DIR
+        if build_dir:
+            package = "package" if handler == "fix_code" else f"package-{handler}"
+            source_dir = os.path.join(build_dir, package)
+        totals = []
+        dependencies = defaultdict(list)
+        modules = set()
+        for _ in range(runs):
+            total, run_dependencies, modules = import_profile(
+                handler, os.path.abspath(source_dir)
+            )
+            totals.append(total)
+            for name, duration in run_dependencies.items():
+                dependencies[name].append(duration)
+        total = statistics.median(totals)
+        budget *= budget_scale
+        slowest = sorted(
+            (
+                (statistics.median(durations), name)
+                for name, durations in dependencies.items()
+            ),
+            reverse=True,
+        )[:3]
+        print(
+            f"{handler:<14} {total:>10.0f} {budget:>10.0f}  "
+            + ", ".join(f"{name} {duration:.0f}" for duration, name in slowest)
+        )
+        if total > budget:
+            print(f"  {handler} exceeds its cold start budget")
+            failed = True
+        if handler != "fix_code":
+            imported = sorted(name for name in FIX_PATH_MODULES if name in modules)
+            if imported:
+                print(
+                    f"  {handler} imports fix path dependencies: {', '.join(imported)}"
+                )
+                failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-scale", type=float, default=1.0)
+    parser.add_argument("--build-dir")
+    args = parser.parse_args()
+    sys.exit(run(args.runs, args.budget_scale, args.build_dir))
@@ -0,0 +1,103 @@
+"""Compare the legacy whole-payload decoder with the streaming log event decoder.
+
+Reports total decode time, time to the first log event and peak traced memory for synthetic CloudWatch
+subscription payloads from 1 KB to 1 MB (decompressed).
+
+Usage: python benchmarks/decode_payload.py [--repeat 5]
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+import tracemalloc
+import unicodedata
+from base64 import b64decode, b64encode
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from log_events import iter_log_events  # noqa: E402
+
+PAYLOAD_SIZES = (1024, 10 * 1024, 100 * 1024, 1024 * 1024)
+TRACEBACK = (
+    "[ERROR] KeyError: 'order_items'\nTraceback (most recent call last):\n"
+    '  File "/var/task/handlers/create_order.py", line 14, in handler\n'
+    '    order_items = body["order_items"]\n'
+)
+
+
+def legacy_iter_log_events(encoded_zipped_data):
+    """The decode path detect_error used before log events were streamed."""
+    zipped_data = b64decode(encoded_zipped_data)
+    data = gzip.decompress(zipped_data)
+    data = unicodedata.normalize("NFKD", data.decode("utf-8")).encode("ascii", "ignore")
+    data = data.decode("utf-8")
+    yield from json.loads(data)["logEvents"]
+
+
+def make_payload(size):
+    """Build a base64 gzip CloudWatch subscription payload of roughly `size` decompressed bytes."""
+    log_events = []
+    length = 0
+    while length < size:
+        message = f"{TRACEBACK}request {len(log_events)} café"
+        log_events.append(
+            {"id": str(len(log_events)), "timestamp": 1700000000000, "message": message}
+        )
+        length += len(message) + 60
+    data = {
+        "messageType": "DATA_MESSAGE",
+        "owner": "123456789012",
+        "logGroup": "/aws/lambda/orders",
+        "logStream": "2024/01/01/[$LATEST]abcdef",
+        "subscriptionFilters": ["Traceback"],
+        "logEvents": log_events,
+    }
+    data = json.dumps(data, ensure_ascii=False).encode()
+    return b64encode(gzip.compress(data)).decode(), len(log_events)
+
+
+def measure(decode, payload):
+    """Time a full decode, then repeat it under tracemalloc to record peak memory."""
+    start = time.perf_counter()
+    events = decode(payload)
+    next(events)
+    first = time.perf_counter() - start
+    for _ in events:
+        pass
+    total = time.perf_counter() - start
+
+    tracemalloc.start()
+    for _ in decode(payload):
+        pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return total, first, peak
+
+
+def run(repeat):
+    print(
+        f"{'size':>8} {'events':>7} | {'decoder':>9} {'total ms':>9} {'first ms':>9} {'peak KiB':>9}"
+    )
+    for size in PAYLOAD_SIZES:
+        payload, count = make_payload(size)
+        legacy = [e["message"] for e in legacy_iter_log_events(payload)]
+        streamed = [e["message"] for e in iter_log_events(payload)]
+        assert legacy == streamed, "Decoders disagree"
+        for name, decode in (
+            ("legacy", legacy_iter_log_events),
+            ("streaming", iter_log_events),
+        ):
+            results = [measure(decode, payload) for _ in range(repeat)]
+            total, first, peak = (min(r[i] for r in results) for i in range(3))
+            print(
+                f"{size:>8} {count:>7} | {name:>9} {total * 1000:>9.2f} {first * 1000:>9.2f} {peak / 1024:>9.1f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    run(args.repeat)
@@ -0,0 +1,297 @@
+"""Local stand-in for the Bedrock runtime API, to run model invocations offline.
+
+Serves InvokeModel and InvokeModelWithResponseStream for Claude text completions, generating a scripted completion
+at a fixed token rate. Point a client at it with `Claude(endpoint_url=...)` and any fake AWS credentials. Requests
+can be throttled, per region, beyond a concurrency quota or at random, before or in the middle of the response.
+
+Usage: python benchmarks/fake_bedrock.py [--port 8080] [--tokens-per-second 50]
+"""
+import argparse
+import base64
+import json
+import random
+import re
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Characters per streamed chunk, about the size of the chunks Bedrock sends.
+CHUNK_CHARS = 16
+CHARS_PER_TOKEN = 4
+PATH_PATTERN = re.compile(
+    r"^/model/(?P<model_id>[^/]+)/(?P<action>invoke|invoke-with-response-stream)$"
+)
+# The region a request is signed for, in its Authorization header.
+REGION_PATTERN = re.compile(r"Credential=[^/]+/[^/]+/(?P<region>[^/]+)/")
+
+DEFAULT_COMPLETION = """
+    "description": "Handle KeyErrors when the key does not exist in the dict",
+    "title": "Handle KeyErrors in get_key",
+    "source_code": [
+        {
+            "filename": "src/foo.py",
+            "edits": [{"search": "    return dict[key]\\n", "replace": "    return dict.get(key)\\n"}]
+        }
+    ]
+}"""
+
+
+def encode_event(payload, event_type="chunk", message_type="event"):
+    """Encode an event, or an exception, in the binary event stream format of streaming AWS APIs."""
+    headers = b""
+    type_header = ":exception-type" if message_type == "exception" else ":event-type"
+    for name, value in (
+        (type_header, event_type),
+        (":content-type", "application/json"),
+        (":message-type", message_type),
+    ):
+        name, value = name.encode(), value.encode()
+        # Header value type 7 is a string.
+        headers += (
+            struct.pack("!B", len(name))
+            + name
+            + struct.pack("!BH", 7, len(value))
+            + value
+        )
+    body = json.dumps(payload).encode()
+    total_length = 16 + len(headers) + len(body)
+    prelude = struct.pack("!II", total_length, len(headers))
+    message = prelude + struct.pack("!I", zlib.crc32(prelude)) + headers + body
+    return message + struct.pack("!I", zlib.crc32(message))
+
+
+def completion_chunk(text, stop_reason=None, metrics=None):
+    completion = {"completion": text, "stop_reason": stop_reason}
+    if metrics:
+        completion["amazon-bedrock-invocationMetrics"] = metrics
+    return {"bytes": base64.b64encode(json.dumps(completion).encode()).decode()}
+
+
+class FakeBedrock:
+    """Fake Bedrock runtime endpoint.
+
+    `respond` maps the request body to the completion text. Generation starts after `first_token_delay` seconds and
+    proceeds at `tokens_per_second`, truncated at the request's `max_tokens_to_sample`.
+
+    Requests beyond `max_concurrency` concurrent requests of a region (an int for every region, or a dict by region)
+    are throttled with a ThrottlingException, and so is a `throttle_probability` fraction of the others. A
+    `stream_throttle_probability` fraction of the streamed responses is interrupted by a throttlingException event.
+    An `error_probability` fraction of the admitted requests fails with an InternalServerException, and a
+    `stream_error_probability` fraction of the streamed responses is interrupted by an internalServerException event.
+    `throttled` counts the throttled requests, `errors` the failed ones and `peak_concurrency` the most concurrent
+    requests of each region.
+    """
+
+    def __init__(
+        self,
+        respond=None,
+        first_token_delay=0.5,
+        tokens_per_second=50,
+        port=0,
+        max_concurrency=None,
+        throttle_probability=0.0,
+        stream_throttle_probability=0.0,
+        error_probability=0.0,
+        stream_error_probability=0.0,
+    ):
+        self.respond = respond or (lambda body: DEFAULT_COMPLETION)
+        self.first_token_delay = first_token_delay
+        self.tokens_per_second = tokens_per_second
+        self.max_concurrency = max_concurrency
+        self.throttle_probability = throttle_probability
+        self.stream_throttle_probability = stream_throttle_probability
+        self.error_probability = error_probability
+        self.stream_error_probability = stream_error_probability
+        self.throttled = 0
+        self.errors = 0
+        self.peak_concurrency = {}
+        self._concurrency = {}
+        self._lock = threading.Lock()
+        self.requests = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler_class())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def endpoint_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def admit(self, region):
+        """Count a request of a region in, unless it is throttled. Return whether it was admitted."""
+        limit = self.max_concurrency
+        if isinstance(limit, dict):
+            limit = limit.get(region)
+        with self._lock:
+            concurrency = self._concurrency.get(region, 0)
+            if (limit is not None and concurrency >= limit) or (
+                random.random() < self.throttle_probability
+            ):
+                self.throttled += 1
+                return False
+            self._concurrency[region] = concurrency + 1
+            self.peak_concurrency[region] = max(
+                self.peak_concurrency.get(region, 0), concurrency + 1
+            )
+            return True
+
+    def leave(self, region):
+        with self._lock:
+            self._concurrency[region] -= 1
+
+    def generate(self, body):
+        """Yield the completion in chunks at the configured pace, and the stop reason."""
+        text = self.respond(body)
+        max_chars = body.get("max_tokens_to_sample", 10000) * CHARS_PER_TOKEN
+        stop_reason = "stop_sequence"
+        if len(text) > max_chars:
+            text, stop_reason = text[:max_chars], "max_tokens"
+        time.sleep(self.first_token_delay)
+        chunk_seconds = CHUNK_CHARS / CHARS_PER_TOKEN / self.tokens_per_second
+        for i in range(0, len(text), CHUNK_CHARS):
+            yield text[i : i + CHUNK_CHARS], None
+            time.sleep(chunk_seconds)
+        yield "", stop_reason
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                match = PATH_PATTERN.match(self.path)
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if not match:
+                    self.send_error(404)
+                    return
+                region_match = REGION_PATTERN.search(
+                    self.headers.get("Authorization", "")
+                )
+                region = region_match.group("region") if region_match else None
+                fake.requests.append(
+                    (match.group("model_id"), match.group("action"), body)
+                )
+                if not fake.admit(region):
+                    self._throttle()
+                    return
+                try:
+                    if random.random() < fake.error_probability:
+                        with fake._lock:
+                            fake.errors += 1
+                        self._fail()
+                    elif match.group("action") == "invoke":
+                        self._invoke(body)
+                    else:
+                        self._invoke_with_response_stream(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client aborted the response.
+                    self.close_connection = True
+                finally:
+                    fake.leave(region)
+
+            def _throttle(self):
+                payload = json.dumps(
+                    {"message": "Too many requests, please wait before trying again."}
+                ).encode()
+                self.send_response(429)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("x-amzn-ErrorType", "ThrottlingException")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _fail(self):
+                payload = json.dumps({"message": "Internal server error"}).encode()
+                self.send_response(500)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("x-amzn-ErrorType", "InternalServerException")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _invoke(self, body):
+                parts = []
+                stop_reason = None
+                for text, stop_reason in fake.generate(body):
+                    parts.append(text)
+                payload = json.dumps(
+                    {"completion": "".join(parts), "stop_reason": stop_reason}
+                ).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _invoke_with_response_stream(self, body):
+                self.send_response(200)
+                self.send_header("Content-Type", "application/vnd.amazon.eventstream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                output_chars = 0
+                interruption = None
+                if random.random() < fake.stream_throttle_probability:
+                    interruption = ("throttlingException", "Too many requests")
+                elif random.random() < fake.stream_error_probability:
+                    interruption = ("internalServerException", "Internal server error")
+                for text, stop_reason in fake.generate(body):
+                    if interruption and output_chars:
+                        error_type, message = interruption
+                        with fake._lock:
+                            if error_type == "throttlingException":
+                                fake.throttled += 1
+                            else:
+                                fake.errors += 1
+                        self._write_chunk(
+                            encode_event({"message": message}, error_type, "exception")
+                        )
+                        break
+                    output_chars += len(text)
+                    metrics = None
+                    if stop_reason:
+                        metrics = {
+                            "inputTokenCount": len(body.get("prompt", ""))
+                            // CHARS_PER_TOKEN,
+                            "outputTokenCount": output_chars // CHARS_PER_TOKEN,
+                        }
+                    self._write_chunk(
+                        encode_event(completion_chunk(text, stop_reason, metrics))
+                    )
+                self._write_chunk(b"")
+
+            def _write_chunk(self, data):
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+            def log_message(self, *_):
+                pass
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    args = parser.parse_args()
+    fake = FakeBedrock(tokens_per_second=args.tokens_per_second, port=args.port)
+    print(f"Serving fake Bedrock runtime on {fake.endpoint_url}")
+    fake.server.serve_forever()
@@ -0,0 +1,77 @@
+"""Measure fingerprinting throughput and how many distinct issues a stream of stateful error messages collapses to.
+
+Usage: python benchmarks/fingerprint_throughput.py [--messages 100000] [--distinct 20]
+"""
+import argparse
+import hashlib
+import os
+import random
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from fingerprint import Fingerprinter  # noqa: E402
+
+PYTHON_TRACE = (
+    "[ERROR] {timestamp} {request_id} KeyError: 'order_items' (order_id={n}) at 0x{address:x}\n"
+    "Traceback (most recent call last):\n"
+    '  File "/var/task/handlers/handler_{bug}.py", line {line}, in handler\n'
+    '    order_items = body["order_items"]\n'
+    '  File "/var/task/services/orders.py", line 42, in load_order\n'
+    "    return table.get_item(Key={{'id': {n}}})\n"
+)
+NODE_TRACE = (
+    "{timestamp}\t{request_id}\tERROR\tTypeError: Cannot read properties of undefined (reading 'id') for user {n}\n"
+    "    at handler_{bug} (file:///var/task/index.mjs:{line}:17)\n"
+    "    at Runtime.handleOnceNonStreaming (file:///var/runtime/index.mjs:1173:29)\n"
+)
+
+
+def make_messages(count, distinct):
+    rng = random.Random(0)
+    messages = []
+    for i in range(count):
+        bug = rng.randrange(distinct)
+        template = PYTHON_TRACE if bug % 2 == 0 else NODE_TRACE
+        messages.append(
+            template.format(
+                timestamp=f"2024-01-01T12:{i % 60:02d}:{rng.randrange(60):02d}.{i % 1000:03d}Z",
+                request_id=uuid.UUID(int=rng.getrandbits(128)),
+                n=rng.randrange(10**6),
+                address=rng.getrandbits(48),
+                bug=bug,
+                line=10 + bug,
+            )
+        )
+    return messages
+
+
+def measure(name, fingerprint, messages):
+    start = time.perf_counter()
+    fingerprints = {fingerprint(message) for message in messages}
+    duration = time.perf_counter() - start
+    print(
+        f"{name:>18}: {len(messages) / duration:>10,.0f} messages/s, {len(fingerprints):>7,} distinct issues"
+    )
+
+
+def run(count, distinct):
+    messages = make_messages(count, distinct)
+    print(f"{count:,} messages from {distinct} distinct bugs")
+    measure(
+        "raw md5",
+        lambda m: hashlib.md5(m.encode(), usedforsecurity=False).hexdigest(),
+        messages,
+    )
+    measure("fingerprint/message", Fingerprinter(mode="message").fingerprint, messages)
+    measure("fingerprint/frames", Fingerprinter(mode="frames").fingerprint, messages)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--distinct", type=int, default=20)
+    args = parser.parse_args()
+    run(args.messages, args.distinct)
@@ -0,0 +1,134 @@
+"""Compare the generated output of full-file and search/replace edit responses for typical small fixes.
+
+Fixes are simulated on the Python modules of a source tree, the standard library by default: each wraps one
+statement in a try/except. Generation time is estimated from the output tokens at --tokens-per-second, since output
+tokens dominate model latency. Search texts are also perturbed (lost indentation, a changed character) to measure
+how often the fuzzy matching still applies the edit.
+
+Usage: python benchmarks/fix_output.py [--fixes 200] [--tokens-per-second 40] [--repo-dir DIR]
+"""
+import argparse
+import ast
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from patching import PatchError, apply_edits  # noqa: E402
+from source_context import estimate_tokens  # noqa: E402
+
+
+def statement_lines(source):
+    """Single line statements inside functions, which a fix can wrap."""
+    return [
+        node.lineno
+        for function in ast.walk(ast.parse(source))
+        if isinstance(function, (ast.FunctionDef, ast.AsyncFunctionDef))
+        for node in function.body
+        if isinstance(node, (ast.Assign, ast.Expr, ast.Return))
+        and node.lineno == node.end_lineno
+    ]
+
+
+def make_fix(rng, source):
+    """Wrap a random statement in a try/except. Returns the edit and the fixed source."""
+    lines = source.splitlines(keepends=True)
+    index = rng.choice(statement_lines(source)) - 1
+    # Enough preceding lines for the search text to be unique.
+    start = index
+    while start > 0 and source.count("".join(lines[start : index + 1])) > 1:
+        start -= 1
+    statement = lines[index]
+    indent = statement[: len(statement) - len(statement.lstrip())]
+    search = "".join(lines[start : index + 1])
+    replace = "".join(lines[start:index]) + (
+        f"{indent}try:\n{indent}    {statement.lstrip()}"
+        f"{indent}except KeyError:\n{indent}    return None\n"
+    )
+    fixed = "".join(lines[:start]) + replace + "".join(lines[index + 1 :])
+    return {"search": search, "replace": replace}, fixed
+
+
+def perturb(rng, search):
+    """Simulate a sloppy copy of the search text by the model."""
+    lines = search.splitlines(keepends=True)
+    if rng.random() < 0.5:
+        return "".join(line.lstrip(" ") for line in lines)
+    i = rng.randrange(len(lines))
+    line = lines[i]
+    if len(line.strip()) > 1:
+        j = rng.randrange(len(line) - len(line.lstrip()), len(line.rstrip()))
+        lines[i] = line[:j] + ("'" if line[j] == '"' else '"') + line[j + 1 :]
+    return "".join(lines)
+
+
+def load_sources(repo_dir):
+    sources = {}
+    for filename in sorted(os.listdir(repo_dir)):
+        if not filename.endswith(".py"):
+            continue
+        try:
+            with open(os.path.join(repo_dir, filename), "r") as f:
+                source = f.read()
+            if statement_lines(source):
+                sources[filename] = source
+        except (SyntaxError, UnicodeDecodeError):
+            continue
+    return sources
+
+
+def run(fix_count, tokens_per_second, repo_dir):
+    logging.disable(logging.INFO)
+    sources = load_sources(repo_dir)
+    rng = random.Random(0)
+    files_tokens = []
+    edits_tokens = []
+    apply_durations = []
+    exact = fuzzy = 0
+    for filename in rng.choices(sorted(sources), k=fix_count):
+        source = sources[filename]
+        edit, fixed = make_fix(rng, source)
+        files_tokens.append(
+            estimate_tokens(json.dumps({"filename": filename, "contents": fixed}))
+        )
+        edits_tokens.append(
+            estimate_tokens(json.dumps({"filename": filename, "edits": [edit]}))
+        )
+
+        start = time.perf_counter()
+        exact += apply_edits(source, [edit], filename) == fixed
+        apply_durations.append(time.perf_counter() - start)
+        try:
+            sloppy_edit = {
+                "search": perturb(rng, edit["search"]),
+                "replace": edit["replace"],
+            }
+            fuzzy += apply_edits(source, [sloppy_edit], filename) == fixed
+        except PatchError:
+            pass
+
+    print(f"{fix_count} fixes over {len(sources)} modules in {repo_dir}")
+    for name, tokens in (("files", files_tokens), ("edits", edits_tokens)):
+        median = statistics.median(tokens)
+        print(
+            f"{name:<5} output tokens: median {median:>8,.0f}, max {max(tokens):>8,}, "
+            f"median generation {median / tokens_per_second:>7.1f} s"
+        )
+    print(
+        f"edits applied: {exact}/{fix_count} exact, {fuzzy}/{fix_count} with perturbed search text, "
+        f"median apply {statistics.median(apply_durations) * 1000:.2f} ms"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--fixes", type=int, default=200)
+    parser.add_argument("--tokens-per-second", type=float, default=40)
+    parser.add_argument("--repo-dir", default=os.path.dirname(ast.__file__))
+    args = parser.parse_args()
+    run(args.fixes, args.tokens_per_second, args.repo_dir)
@@ -0,0 +1,167 @@
+"""Measure the end-to-end latency of fix_code.handler with its setup stages run one at a time and overlapped.
+
+Runs the handler against local stand-ins: a fake SSM Parameter Store, a local bare git remote, the fake Bedrock
+endpoint and a fake GitHub API. Every round fixes a batch of messages, alternating between STAGE_MAX_WORKERS=1 (the
+setup stages in sequence, as before the stage graph) and the overlapped stage graph. The stages of each message run
+in sequence, and their durations are taken from the metrics of the message.
+
+Usage: python benchmarks/fix_pipeline.py [--rounds 5] [--messages 1] [--first-token-delay 1.0] [--stage-max-workers 4]
+"""
+import argparse
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from fake_bedrock import FakeBedrock  # noqa: E402
+from local_services import FakeGitHub, FakeSSM, create_remote  # noqa: E402
+
+PARAMETER_STORE_PREFIX = "/self-healing-code/"
+SOURCE = """import json
+
+
+def handler(event, context):
+    body = json.loads(event["body"])
+    order_items = body["order_items"]
+    return {"statusCode": 200, "body": json.dumps(order_items)}
+"""
+STACK_TRACE = """[ERROR] KeyError: 'order_items'
+Traceback (most recent call last):
+  File "/var/task/handlers/create_order.py", line 6, in handler
+    order_items = body["order_items"]
+"""
+COMPLETION = r"""
+    "description": "Default to an empty list when the order has no items",
+    "title": "Handle orders without items",
+    "source_code": [
+        {
+            "filename": "handlers/create_order.py",
+            "edits": [{"search": "    order_items = body[\"order_items\"]\n", "replace": "    order_items = body.get(\"order_items\", [])\n"}]
+        }
+    ]
+}"""
+
+
+def close_pulls(github):
+    for pull in github.pulls:
+        pull["state"] = "closed"
+
+
+def run(rounds, messages, first_token_delay, stage_max_workers):
+    logging.disable(logging.INFO)
+    workdir = tempfile.mkdtemp()
+    os.environ.update(
+        PARAMETER_STORE_PREFIX=PARAMETER_STORE_PREFIX,
+        REPO_CACHE_DIR=os.path.join(workdir, "repo-cache"),
+        AWS_ACCESS_KEY_ID="fake",
+        AWS_SECRET_ACCESS_KEY="fake",
+        AWS_DEFAULT_REGION="us-east-1",
+        # The fake GitHub API has no secondary rate limit to pace pull requests for, and lists new pull requests
+        # right away, so that the ones closed after each round aren't indexed as still open.
+        GITHUB_WRITE_INTERVAL="0",
+        GITHUB_LISTING_LAG="0",
+    )
+    remote_url = create_remote(
+        os.path.join(workdir, "remote.git"), {"handlers/create_order.py": SOURCE}
+    )
+    with FakeBedrock(
+        respond=lambda body: COMPLETION,
+        first_token_delay=first_token_delay,
+        tokens_per_second=100,
+    ) as bedrock, FakeGitHub() as github:
+        parameters = {
+            "model_provider": "bedrock",
+            "repo_url": remote_url,
+            "repo_name": "remote",
+            "repo_api_url": github.repo_api_url(),
+            "repo_api_key": "fake",
+            "repo_ssh_private_key": "fake",
+            "cloudwatch_log_group_name": "/aws/lambda/demo",
+        }
+        with FakeSSM(
+            {PARAMETER_STORE_PREFIX + name: value for name, value in parameters.items()}
+        ) as ssm:
+            os.environ["AWS_ENDPOINT_URL_SSM"] = ssm.endpoint_url
+            os.environ["BEDROCK_ENDPOINT_URL"] = bedrock.endpoint_url
+            from handlers import fix_code
+
+            timings = defaultdict(lambda: defaultdict(list))
+
+            class TimedStageGraph(fix_code.StageGraph):
+                def run(self):
+                    try:
+                        return super().run()
+                    finally:
+                        for name, duration in self.timings.items():
+                            timings[(fix_code.STAGE_MAX_WORKERS, "setup")][name].append(
+                                duration
+                            )
+
+            class TimedMetrics(fix_code.Metrics):
+                def flush(self):
+                    if "message_id" in self.properties:
+                        for name, value in self.values.items():
+                            if name.endswith("_duration"):
+                                timings[(fix_code.STAGE_MAX_WORKERS, "message")][
+                                    name[: -len("_duration")]
+                                ].append(value / 1000)
+                    super().flush()
+
+            fix_code.StageGraph = TimedStageGraph
+            fix_code.Metrics = TimedMetrics
+            event = {
+                "Records": [
+                    {"messageId": f"{i:08d}-0000", "body": STACK_TRACE}
+                    for i in range(messages)
+                ]
+            }
+            modes = {"sequential": 1, "stage graph": stage_max_workers}
+            totals = defaultdict(list)
+            # The first run clones the repo and loads the botocore models, and is left out.
+            fix_code.handler(event, None)
+            close_pulls(github)
+            timings.clear()
+            for _ in range(rounds):
+                for mode, workers in modes.items():
+                    fix_code.STAGE_MAX_WORKERS = workers
+                    start = time.perf_counter()
+                    response = fix_code.handler(event, None)
+                    totals[mode].append(time.perf_counter() - start)
+                    assert not response["batchItemFailures"], response
+                    # Messages of issues with an open pull request are skipped, so every round fixes them again.
+                    close_pulls(github)
+
+    print(
+        f"{rounds} rounds of {messages} message(s), {first_token_delay:.1f} s to first token, "
+        f"{len(github.pulls)} pull requests"
+    )
+    print(f"{'':<12} {'end to end':>12}")
+    for mode, durations in totals.items():
+        print(f"{mode:<12} {statistics.median(durations):>10.3f} s")
+    for graph in ("setup", "message"):
+        print(f"\nmedian {graph} stage durations (s)")
+        names = list(timings[(1, graph)])
+        print(f"{'':<20}" + "".join(f" {mode:>12}" for mode in modes))
+        for name in names:
+            print(
+                f"{name:<20}"
+                + "".join(
+                    f" {statistics.median(timings[(workers, graph)][name]):>12.3f}"
+                    for workers in modes.values()
+                )
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--messages", type=int, default=1)
+    parser.add_argument("--first-token-delay", type=float, default=1.0)
+    parser.add_argument("--stage-max-workers", type=int, default=4)
+    args = parser.parse_args()
+    run(args.rounds, args.messages, args.first_token_delay, args.stage_max_workers)
@@ -0,0 +1,110 @@
+"""Compare the legacy Python/Node frame regex with the multi-language frame parser over a large trace corpus.
+
+Usage: python benchmarks/frame_parsing.py [--traces 20000] [--frames 15]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from stack_trace import FrameParser  # noqa: E402
+
+# The pattern fix_code matched file paths with before the frame parser.
+LEGACY_PATTERN = re.compile(r'(?:File "([^"]+)"|at \S+ \(file://([^:]+):\d+:\d+\))')
+
+FRAME_FORMATS = {
+    "python": (
+        "Traceback (most recent call last):\n",
+        '  File "/var/task/{module}/{name}.py", line {line}, in {function}\n'
+        "    result = {function}(event)\n",
+    ),
+    "node": (
+        "TypeError: Cannot read properties of undefined\n",
+        "    at {function} (file:///var/task/{module}/{name}.mjs:{line}:{column})\n",
+    ),
+    "java": (
+        'Exception in thread "main" java.lang.IllegalStateException: failed\n',
+        "\tat com.example.{module}.{Name}.{function}({Name}.java:{line})\n",
+    ),
+    "go": (
+        "panic: runtime error: index out of range [3] with length 3\n\ngoroutine 1 [running]:\n",
+        "example.com/app/{module}.{Name}({arg})\n\t/app/{module}/{name}.go:{line} +0x1d\n",
+    ),
+    "dotnet": (
+        "System.InvalidOperationException: failed\n",
+        "   at Example.{Module}.{Name}.{Function}(String id) in C:\\src\\{Module}\\{Name}.cs:line {line}\n",
+    ),
+    "ruby": (
+        "/app/{module}/{name}.rb:{line}:in `{function}': failed (RuntimeError)\n",
+        "\tfrom /app/{module}/{name}.rb:{line}:in `{function}'\n",
+    ),
+}
+
+
+def make_trace(rng, language, frame_count):
+    header, frame = FRAME_FORMATS[language]
+    lines = []
+    for _ in range(frame_count + 1):
+        name = f"module_{rng.randrange(1000)}"
+        module = f"pkg{rng.randrange(50)}"
+        function = f"handle_{rng.randrange(100)}"
+        lines.append(
+            (header if not lines else frame).format(
+                module=module,
+                Module=module.title(),
+                name=name,
+                Name=name.title().replace("_", ""),
+                function=function,
+                Function=function.title().replace("_", ""),
+                line=rng.randrange(1, 500),
+                column=rng.randrange(1, 80),
+                arg=f"0x{rng.randrange(1 << 32):x}",
+            )
+        )
+    return "".join(lines)
+
+
+def run(trace_count, frame_count):
+    rng = random.Random(0)
+    languages = sorted(FRAME_FORMATS)
+    traces = [
+        (language, make_trace(rng, language, frame_count))
+        for language in (rng.choice(languages) for _ in range(trace_count))
+    ]
+    size = sum(len(trace) for _, trace in traces)
+    print(f"{trace_count:,} traces, {size / 1e6:.1f} MB, {frame_count} frames each")
+
+    start = time.perf_counter()
+    legacy = {language: 0 for language in languages}
+    for language, trace in traces:
+        legacy[language] += len(LEGACY_PATTERN.findall(trace))
+    legacy_duration = time.perf_counter() - start
+
+    parser = FrameParser()
+    start = time.perf_counter()
+    parsed = {language: 0 for language in languages}
+    for language, trace in traces:
+        parsed[language] += len(parser.parse(trace))
+    parse_duration = time.perf_counter() - start
+
+    print(
+        f"legacy regex: {trace_count / legacy_duration:>10,.0f} traces/s, {size / legacy_duration / 1e6:>6.1f} MB/s"
+    )
+    print(
+        f"frame parser: {trace_count / parse_duration:>10,.0f} traces/s, {size / parse_duration / 1e6:>6.1f} MB/s"
+    )
+    print(f"{'language':<8} {'legacy':>8} {'parser':>8}  (frames found)")
+    for language in languages:
+        print(f"{language:<8} {legacy[language]:>8,} {parsed[language]:>8,}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--traces", type=int, default=20000)
+    parser.add_argument("--frames", type=int, default=15)
+    args = parser.parse_args()
+    run(args.traces, args.frames)
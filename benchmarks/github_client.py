@@ -0,0 +1,149 @@
+"""Open pull requests for a burst of fixes against the fake GitHub API, with bare requests as create_pull_request did
+and with the pooled, rate limit aware GitHubProvider.
+
+Every issue is fixed by several concurrent messages, as when an error is reported again before its fix is merged.
+The fake API enforces a secondary rate limit on pull request creation, and optionally a primary rate limit.
+
+Usage: python benchmarks/github_client.py [--issues 10] [--fixes-per-issue 2] [--workers 8] [--secondary-limit 8]
+    [--secondary-limit-window 5] [--rate-limit 5000] [--rate-limit-window 60] [--write-interval 1.0]
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from local_services import FakeGitHub  # noqa: E402
+from source_code import GitHubProvider, parse_issue_key  # noqa: E402
+
+HEADERS = {
+    "Authorization": "Bearer fake",
+    "Accept": "application/vnd.github+json",
+    "X-GitHub-Api-Version": "2022-11-28",
+}
+
+
+def legacy_create_pull_request(repo_url, branch, title, description, issue_key):
+    """A bare request on a new connection, as create_pull_request did. Failures are only logged."""
+    data = {"title": title, "body": description, "head": branch, "base": "main"}
+    response = requests.post(
+        f"{repo_url}/pulls", json=data, headers=HEADERS, timeout=30
+    )
+    if response.status_code != 201:
+        raise Exception(response.text)
+
+
+def pooled_create_pull_request(provider):
+    def create_pull_request(repo_url, branch, title, description, issue_key):
+        provider.create_pull_request(branch, title, description, issue_key)
+
+    return create_pull_request
+
+
+def measure(create_pull_request, github, issues, fixes_per_issue, workers):
+    fixes = [
+        (f"{issue:032x}", fix)
+        for fix in range(fixes_per_issue)
+        for issue in range(issues)
+    ]
+
+    def fix(issue_fix):
+        issue_key, i = issue_fix
+        try:
+            create_pull_request(
+                github.repo_api_url(),
+                f"fix-code-{issue_key[-4:]}-{i}",
+                f"Fix issue {issue_key[-4:]}",
+                "Fix",
+                issue_key,
+            )
+            return True
+        except Exception:
+            return False
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        succeeded = sum(executor.map(fix, fixes))
+    duration = time.perf_counter() - start
+    # The legacy client doesn't tag pull requests, so they are matched to issues by title.
+    pulls_per_issue = Counter(
+        parse_issue_key(pull["body"]) or pull["title"] for pull in github.pulls
+    )
+    return {
+        "seconds": duration,
+        "failed fixes": len(fixes) - succeeded,
+        "pull requests": len(github.pulls),
+        "duplicates": sum(count - 1 for count in pulls_per_issue.values()),
+        "throttled": github.throttled,
+        "connections": github.connections,
+    }
+
+
+def run(
+    issues,
+    fixes_per_issue,
+    workers,
+    secondary_limit,
+    secondary_limit_window,
+    rate_limit,
+    rate_limit_window,
+    write_interval,
+):
+    logging.disable(logging.INFO)
+    print(
+        f"{issues} issues fixed {fixes_per_issue} times each by {workers} workers, secondary limit "
+        f"{secondary_limit} pull requests per {secondary_limit_window} s, primary limit {rate_limit} requests per "
+        f"{rate_limit_window} s"
+    )
+    clients = {
+        "requests.post": lambda: legacy_create_pull_request,
+        "GitHubProvider": lambda: pooled_create_pull_request(
+            GitHubProvider("fake", github.repo_api_url(), write_interval=write_interval)
+        ),
+    }
+    results = {}
+    for name, client in clients.items():
+        with FakeGitHub(
+            latency=0.05,
+            rate_limit=rate_limit,
+            rate_limit_window=rate_limit_window,
+            secondary_limit=secondary_limit,
+            secondary_limit_window=secondary_limit_window,
+            retry_after=secondary_limit_window,
+        ) as github:
+            results[name] = measure(client(), github, issues, fixes_per_issue, workers)
+    print(f"{'':<16}" + "".join(f" {name:>15}" for name in results))
+    for metric in results["GitHubProvider"]:
+        print(
+            f"{metric:<16}"
+            + "".join(f" {result[metric]:>15.4g}" for result in results.values())
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--issues", type=int, default=10)
+    parser.add_argument("--fixes-per-issue", type=int, default=2)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--secondary-limit", type=int, default=8)
+    parser.add_argument("--secondary-limit-window", type=int, default=5)
+    parser.add_argument("--rate-limit", type=int, default=5000)
+    parser.add_argument("--rate-limit-window", type=int, default=60)
+    parser.add_argument("--write-interval", type=float, default=1.0)
+    args = parser.parse_args()
+    run(
+        args.issues,
+        args.fixes_per_issue,
+        args.workers,
+        args.secondary_limit,
+        args.secondary_limit_window,
+        args.rate_limit,
+        args.rate_limit_window,
+        args.write_interval,
+    )
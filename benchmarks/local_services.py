@@ -0,0 +1,592 @@
+"""Local stand-ins for the services the handlers talk to besides Bedrock: SSM Parameter Store, the GitHub REST API,
+the target git repo, DynamoDB and SQS.
+
+FakeSSM serves GetParameters; point boto3 at it with the AWS_ENDPOINT_URL_SSM environment variable and any fake AWS
+credentials. FakeGitHub serves the repo and pull request endpoints under `/repos/<owner>/<repo>`, with GitHub's
+primary and secondary rate limits, conditional requests and pagination. `create_remote` creates a local bare repo to
+clone from over file://. FakeDynamoDB and FakeSQS are in-memory clients, to be assigned in place of a handler's
+boto3 clients; FakeDynamoDB records the changes of a table as DynamoDB Streams records.
+
+Usage: python benchmarks/local_services.py [--latency 0.05]
+"""
+import argparse
+import copy
+import hashlib
+import json
+import os
+import re
+import subprocess
+import threading
+import time
+import urllib.parse
+import uuid
+from collections import Counter, defaultdict
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class LocalService:
+    """Threaded HTTP server answering JSON requests after `latency` seconds. Counts the connections it accepts."""
+
+    def __init__(self, latency=0.0, port=0):
+        self.latency = latency
+        self.requests = []
+        self.connections = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler_class())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def endpoint_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def handle(self, method, path, headers, body):
+        """Return the status code and JSON payload of the response to a request, and optionally its headers."""
+        raise NotImplementedError
+
+    def _handler_class(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                service.connections += 1
+
+            def _respond(self):
+                length = int(self.headers.get("Content-Length", 0))
+                raw_body = self.rfile.read(length)
+                body = json.loads(raw_body) if raw_body else None
+                service.requests.append((self.command, self.path, body))
+                time.sleep(service.latency)
+                status, payload, *headers = service.handle(
+                    self.command, self.path, self.headers, body
+                )
+                data = b"" if status == 304 else json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers[0] if headers else {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PATCH = _respond
+
+            def log_message(self, *_):
+                pass
+
+        return Handler
+
+
+class FakeSSM(LocalService):
+    """Parameter Store holding `parameters`, a dict of names to values."""
+
+    def __init__(self, parameters, latency=0.02, port=0):
+        super().__init__(latency, port)
+        self.parameters = parameters
+
+    def handle(self, method, path, headers, body):
+        target = headers.get("X-Amz-Target", "")
+        if target != "AmazonSSM.GetParameters":
+            return 400, {"__type": "UnknownOperationException", "message": target}
+        found = [name for name in body["Names"] if name in self.parameters]
+        return 200, {
+            "Parameters": [
+                {"Name": name, "Value": self.parameters[name], "Type": "SecureString"}
+                for name in found
+            ],
+            "InvalidParameters": [
+                name for name in body["Names"] if name not in self.parameters
+            ],
+        }
+
+
+class FakeGitHub(LocalService):
+    """GitHub REST API storing the pull requests created on any repo.
+
+    Every response counts against a primary rate limit of `rate_limit` requests per `rate_limit_window` seconds,
+    except conditional requests answered with 304 Not Modified, and carries the X-RateLimit-* headers. More than
+    `secondary_limit` pull requests created within `secondary_limit_window` seconds trip a secondary rate limit,
+    answered with a 403 and a Retry-After of `retry_after` seconds. `throttled` counts the throttled requests.
+    """
+
+    REPO_PATH = re.compile(
+        r"^/repos/(?P<repo>[^/]+/[^/?]+)(?P<pulls>/pulls)?(?:\?(?P<query>.*))?$"
+    )
+
+    def __init__(
+        self,
+        latency=0.1,
+        port=0,
+        default_branch="main",
+        rate_limit=5000,
+        rate_limit_window=3600,
+        secondary_limit=None,
+        secondary_limit_window=60,
+        retry_after=1,
+    ):
+        super().__init__(latency, port)
+        self.pulls = []
+        self.default_branch = default_branch
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.secondary_limit = secondary_limit
+        self.secondary_limit_window = secondary_limit_window
+        self.retry_after = retry_after
+        self.throttled = 0
+        self._window_start = time.time()
+        self._used = 0
+        self._writes = []
+        self._lock = threading.Lock()
+
+    def repo_api_url(self, repo="owner/repo"):
+        return f"{self.endpoint_url}/repos/{repo}"
+
+    def handle(self, method, path, headers, body):
+        match = self.REPO_PATH.match(path)
+        if not match:
+            return 404, {"message": "Not Found"}
+        with self._lock:
+            now = time.time()
+            if now - self._window_start >= self.rate_limit_window:
+                self._window_start, self._used = now, 0
+            reset = int(self._window_start + self.rate_limit_window)
+            if self._used >= self.rate_limit:
+                self.throttled += 1
+                return (
+                    403,
+                    {"message": "API rate limit exceeded"},
+                    self._limit_headers(reset),
+                )
+            if not match.group("pulls"):
+                self._used += 1
+                return (
+                    200,
+                    {
+                        "full_name": match.group("repo"),
+                        "default_branch": self.default_branch,
+                    },
+                    self._limit_headers(reset),
+                )
+            if method == "GET":
+                return self._list_pulls(match, headers, reset)
+            self._used += 1
+            self._writes = [
+                t for t in self._writes if now - t < self.secondary_limit_window
+            ]
+            if (
+                self.secondary_limit is not None
+                and len(self._writes) >= self.secondary_limit
+            ):
+                self.throttled += 1
+                return (
+                    403,
+                    {"message": "You have exceeded a secondary rate limit."},
+                    {
+                        **self._limit_headers(reset),
+                        "Retry-After": str(self.retry_after),
+                    },
+                )
+            self._writes.append(now)
+            if body["base"] != self.default_branch:
+                return (
+                    422,
+                    {
+                        "message": "Validation Failed",
+                        "errors": [{"field": "base", "code": "invalid"}],
+                    },
+                    self._limit_headers(reset),
+                )
+            if any(pull["head"] == body["head"] for pull in self.pulls):
+                return (
+                    422,
+                    {"message": f"A pull request already exists for {body['head']}."},
+                    self._limit_headers(reset),
+                )
+            number = len(self.pulls) + 1
+            pull = {
+                **body,
+                "number": number,
+                "state": "open",
+                "html_url": f"https://github.com/{match.group('repo')}/pull/{number}",
+            }
+            self.pulls.append(pull)
+            return 201, pull, self._limit_headers(reset)
+
+    def _list_pulls(self, match, headers, reset):
+        query = urllib.parse.parse_qs(match.group("query") or "")
+        state = query.get("state", ["open"])[0]
+        per_page = int(query.get("per_page", ["30"])[0])
+        page = int(query.get("page", ["1"])[0])
+        # Newest first, as GitHub lists them by default.
+        pulls = [
+            pull
+            for pull in reversed(self.pulls)
+            if state == "all" or pull["state"] == state
+        ]
+        response_headers = self._limit_headers(reset)
+        etag = (
+            f'"{hashlib.md5(json.dumps(pulls).encode()).hexdigest()}-{page}-{per_page}"'
+        )
+        response_headers["ETag"] = etag
+        if headers.get("If-None-Match") == etag:
+            return 304, None, response_headers
+        self._used += 1
+        response_headers["X-RateLimit-Remaining"] = str(
+            max(0, self.rate_limit - self._used)
+        )
+        if page * per_page < len(pulls):
+            url = f"{self.repo_api_url(match.group('repo'))}/pulls?state={state}&per_page={per_page}&page={page + 1}"
+            response_headers["Link"] = f'<{url}>; rel="next"'
+        return 200, pulls[(page - 1) * per_page : page * per_page], response_headers
+
+    def _limit_headers(self, reset):
+        return {
+            "X-RateLimit-Limit": str(self.rate_limit),
+            "X-RateLimit-Remaining": str(max(0, self.rate_limit - self._used)),
+            "X-RateLimit-Reset": str(reset),
+        }
+
+
+class ConditionalCheckFailedException(Exception):
+    """Raised by FakeDynamoDB when the condition of a write isn't met."""
+
+
+class FakeDynamoDB:
+    """In-memory DynamoDB client serving the item operations of the handlers, on tables keyed by `pk` and `sk`.
+
+    Update expressions may SET attributes to a value or to `if_not_exists(name, value)`, and ADD to numbers. Condition
+    expressions may be `attribute_not_exists(name)`, `name = :value` or `name < :value`, joined by OR. Every write to
+    one of `stream_tables` appends a record, as Lambda receives it from a NEW_AND_OLD_IMAGES stream, to
+    `streams[table]`. `calls` counts the calls of each operation.
+    """
+
+    UPDATE_CLAUSE = re.compile(
+        r"\b(SET|ADD)\s+(.+?)(?=\s+\b(?:SET|ADD)\b|$)", re.DOTALL
+    )
+    # Commas which aren't between the parentheses of a function call.
+    SEPARATOR = re.compile(r",\s*(?![^()]*\))")
+    IF_NOT_EXISTS = re.compile(r"^if_not_exists\((\w+),\s*(:\w+)\)$")
+    ATTRIBUTE_NOT_EXISTS = re.compile(r"^attribute_not_exists\((\w+)\)$")
+    EQUALS = re.compile(r"^(\w+)\s*=\s*(:\w+)$")
+    LESS_THAN = re.compile(r"^(\w+)\s*<\s*(:\w+)$")
+
+    class exceptions:
+        ConditionalCheckFailedException = ConditionalCheckFailedException
+
+    def __init__(self, stream_tables=(), clock=time.time):
+        self.tables = defaultdict(dict)
+        self.streams = {table: [] for table in stream_tables}
+        self.clock = clock
+        self.calls = Counter()
+        self._sequence_number = 0
+        self._lock = threading.Lock()
+
+    def get_item(self, TableName, Key, **_):
+        with self._lock:
+            self.calls["GetItem"] += 1
+            item = self.tables[TableName].get(self._key(Key))
+            return {"Item": copy.deepcopy(item)} if item else {}
+
+    def batch_get_item(self, RequestItems):
+        with self._lock:
+            self.calls["BatchGetItem"] += 1
+            responses = {}
+            for table, request in RequestItems.items():
+                items = [
+                    self.tables[table].get(self._key(key)) for key in request["Keys"]
+                ]
+                responses[table] = [copy.deepcopy(item) for item in items if item]
+            return {"Responses": responses, "UnprocessedKeys": {}}
+
+    def put_item(
+        self, TableName, Item, ConditionExpression=None, ExpressionAttributeValues=None
+    ):
+        with self._lock:
+            self.calls["PutItem"] += 1
+            key = self._key(Item)
+            old = self.tables[TableName].get(key)
+            if ConditionExpression and not self._matches(
+                ConditionExpression, old, ExpressionAttributeValues or {}
+            ):
+                raise ConditionalCheckFailedException(ConditionExpression)
+            self._write(TableName, key, old, copy.deepcopy(Item))
+            return {}
+
+    def update_item(
+        self,
+        TableName,
+        Key,
+        UpdateExpression,
+        ExpressionAttributeValues,
+        ConditionExpression=None,
+        **_,
+    ):
+        with self._lock:
+            self.calls["UpdateItem"] += 1
+            key = self._key(Key)
+            old = self.tables[TableName].get(key)
+            if ConditionExpression and not self._matches(
+                ConditionExpression, old, ExpressionAttributeValues
+            ):
+                raise ConditionalCheckFailedException(ConditionExpression)
+            item = copy.deepcopy(old or Key)
+            values = ExpressionAttributeValues
+            for action, assignments in self.UPDATE_CLAUSE.findall(UpdateExpression):
+                for assignment in self.SEPARATOR.split(assignments.strip()):
+                    if action == "SET":
+                        name, value = (
+                            part.strip() for part in assignment.split("=", 1)
+                        )
+                        match = self.IF_NOT_EXISTS.match(value)
+                        if match:
+                            item[name] = item.get(
+                                match.group(1), values.get(match.group(2))
+                            )
+                        else:
+                            item[name] = values[value]
+                    else:
+                        name, value = assignment.split()
+                        total = Decimal(item.get(name, {"N": "0"})["N"]) + Decimal(
+                            values[value]["N"]
+                        )
+                        item[name] = {"N": str(total)}
+            self._write(TableName, key, old, item)
+            return {}
+
+    def drain_stream(self, table, max_records=None):
+        """Remove and return the oldest `max_records` stream records of a table, or all of them."""
+        with self._lock:
+            stream = self.streams[table]
+            count = len(stream) if max_records is None else max_records
+            records, stream[:] = stream[:count], stream[count:]
+            return records
+
+    def _key(self, item):
+        return item["pk"]["S"], item["sk"]["S"]
+
+    def _matches(self, condition, item, values):
+        if " OR " in condition:
+            return any(
+                self._matches(part.strip(), item, values)
+                for part in condition.split(" OR ")
+            )
+        match = self.ATTRIBUTE_NOT_EXISTS.match(condition)
+        if match:
+            return item is None or match.group(1) not in item
+        match = self.EQUALS.match(condition)
+        if match:
+            return (
+                item is not None and item.get(match.group(1)) == values[match.group(2)]
+            )
+        match = self.LESS_THAN.match(condition)
+        if match:
+            return (
+                item is not None
+                and match.group(1) in item
+                and Decimal(item[match.group(1)]["N"])
+                < Decimal(values[match.group(2)]["N"])
+            )
+        raise ValueError(f"Unsupported condition expression: {condition}")
+
+    def _write(self, table, key, old, item):
+        self.tables[table][key] = item
+        if table not in self.streams:
+            return
+        self._sequence_number += 1
+        record = {
+            "eventID": uuid.uuid4().hex,
+            "eventName": "INSERT" if old is None else "MODIFY",
+            "eventSource": "aws:dynamodb",
+            "dynamodb": {
+                "ApproximateCreationDateTime": self.clock(),
+                "Keys": {"pk": item["pk"], "sk": item["sk"]},
+                "NewImage": copy.deepcopy(item),
+                "SequenceNumber": str(self._sequence_number),
+                "StreamViewType": "NEW_AND_OLD_IMAGES",
+            },
+        }
+        if old is not None:
+            record["dynamodb"]["OldImage"] = copy.deepcopy(old)
+        self.streams[table].append(record)
+
+
+class FakeSQS:
+    """In-memory SQS client of standard queues, created on their first message.
+
+    Received messages are hidden for their visibility timeout and deleted by receipt handle. `lambda_records`
+    receives messages in the form of the records of an SQS event, as the Lambda event source mapping does. `calls`
+    counts the calls of each operation.
+    """
+
+    def __init__(self, clock=time.time):
+        self.queues = defaultdict(list)
+        self.clock = clock
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def send_message(self, QueueUrl, MessageBody, MessageAttributes=None):
+        with self._lock:
+            self.calls["SendMessage"] += 1
+            return {"MessageId": self._send(QueueUrl, MessageBody, MessageAttributes)}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        with self._lock:
+            self.calls["SendMessageBatch"] += 1
+            successful = [
+                {
+                    "Id": entry["Id"],
+                    "MessageId": self._send(
+                        QueueUrl, entry["MessageBody"], entry.get("MessageAttributes")
+                    ),
+                }
+                for entry in Entries
+            ]
+            return {"Successful": successful, "Failed": []}
+
+    def receive_message(
+        self,
+        QueueUrl,
+        MaxNumberOfMessages=1,
+        VisibilityTimeout=30,
+        MessageAttributeNames=(),
+        AttributeNames=(),
+        **_,
+    ):
+        with self._lock:
+            self.calls["ReceiveMessage"] += 1
+            now = self.clock()
+            messages = []
+            for message in self.queues[QueueUrl]:
+                if len(messages) == MaxNumberOfMessages:
+                    break
+                if message["visible_at"] > now:
+                    continue
+                message["visible_at"] = now + VisibilityTimeout
+                message["ReceiptHandle"] = uuid.uuid4().hex
+                received = {
+                    key: message[key] for key in ("MessageId", "ReceiptHandle", "Body")
+                }
+                if MessageAttributeNames and message["MessageAttributes"]:
+                    received["MessageAttributes"] = copy.deepcopy(
+                        message["MessageAttributes"]
+                    )
+                if AttributeNames:
+                    received["Attributes"] = {
+                        "SentTimestamp": str(round(message["sent_at"] * 1000))
+                    }
+                messages.append(received)
+            return {"Messages": messages} if messages else {}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        with self._lock:
+            self.calls["DeleteMessageBatch"] += 1
+            receipt_handles = {entry["ReceiptHandle"] for entry in Entries}
+            self.queues[QueueUrl] = [
+                message
+                for message in self.queues[QueueUrl]
+                if message.get("ReceiptHandle") not in receipt_handles
+            ]
+            return {
+                "Successful": [{"Id": entry["Id"]} for entry in Entries],
+                "Failed": [],
+            }
+
+    def lambda_records(self, queue_url, max_messages=10, visibility_timeout=900):
+        """Receive up to `max_messages` messages as the records of an SQS event."""
+        response = self.receive_message(
+            QueueUrl=queue_url,
+            MaxNumberOfMessages=max_messages,
+            VisibilityTimeout=visibility_timeout,
+            MessageAttributeNames=["All"],
+            AttributeNames=["All"],
+        )
+        return [
+            {
+                "messageId": message["MessageId"],
+                "receiptHandle": message["ReceiptHandle"],
+                "body": message["Body"],
+                "attributes": message["Attributes"],
+                "messageAttributes": {
+                    name: {
+                        "stringValue": attribute["StringValue"],
+                        "dataType": attribute["DataType"],
+                    }
+                    for name, attribute in message.get("MessageAttributes", {}).items()
+                },
+                "eventSource": "aws:sqs",
+            }
+            for message in response.get("Messages", [])
+        ]
+
+    def message_count(self, queue_url):
+        """Return the number of messages in a queue, received or not."""
+        with self._lock:
+            return len(self.queues[queue_url])
+
+    def _send(self, queue_url, body, attributes):
+        message_id = str(uuid.uuid4())
+        self.queues[queue_url].append(
+            {
+                "MessageId": message_id,
+                "Body": body,
+                "MessageAttributes": copy.deepcopy(attributes or {}),
+                "sent_at": self.clock(),
+                "visible_at": 0,
+            }
+        )
+        return message_id
+
+
+def create_remote(directory, files):
+    """Create a bare git repo in `directory` whose main branch holds `files`, a dict of paths to contents.
+
+    Returns the file:// URL of the repo.
+    """
+    work_dir = f"{directory}.work"
+    os.makedirs(work_dir)
+    for path, contents in files.items():
+        file_path = os.path.join(work_dir, path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "w") as f:
+            f.write(contents)
+
+    def git(*args, cwd=work_dir):
+        subprocess.run(["git", *args], cwd=cwd, check=True, capture_output=True)
+
+    git("init", "-b", "main")
+    git("add", "-A")
+    git("-c", "user.name=bench", "-c", "user.email=bench@local", "commit", "-m", "init")
+    git("clone", "--bare", work_dir, directory, cwd=None)
+    # Partial clones of the cache need the remote to serve filtered packs.
+    git("config", "uploadpack.allowFilter", "true", cwd=directory)
+    git("config", "uploadpack.allowAnySHA1InWant", "true", cwd=directory)
+    return f"file://{os.path.abspath(directory)}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=0.05)
+    args = parser.parse_args()
+    ssm = FakeSSM({"/demo/repo_name": "demo"}, latency=args.latency).start()
+    github = FakeGitHub(latency=args.latency).start()
+    print(f"Serving fake SSM on {ssm.endpoint_url}")
+    print(f"Serving fake GitHub API on {github.repo_api_url()}")
+    threading.Event().wait()
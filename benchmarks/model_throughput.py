@@ -0,0 +1,158 @@
+"""Measure the sustained fix throughput of concurrent Lambdas under a Bedrock concurrency quota, with botocore's
+retries as before and with the model call governor.
+
+Each simulated Lambda has its own Claude provider, invoking the fake Bedrock endpoint from several workers, as
+fix_code does for a batch. The fake endpoint throttles the requests of a region beyond its concurrency quota, and
+fails an --error-probability fraction of the requests with a server error, half of them in the middle of the
+response stream. A fix which fails is redelivered after --redelivery-delay seconds, as SQS redelivers its message,
+until every fix is done.
+
+Usage: python benchmarks/model_throughput.py [--lambdas 4] [--workers 4] [--fixes 48] [--quota 4]
+    [--fallback-quota 2] [--first-token-delay 2.0] [--tokens-per-second 50] [--redelivery-delay 10]
+    [--error-probability 0.0]
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.client import Config
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from fake_bedrock import FakeBedrock  # noqa: E402
+from providers.bedrock import Claude  # noqa: E402
+
+FALLBACK_REGION = "us-west-2"
+
+
+class Ungoverned:
+    """Calls the model directly, leaving retries to botocore, as Claude did."""
+
+    def call(self, function, metrics=None):
+        return function(0)
+
+    def stats(self):
+        return {}
+
+
+def botocore_provider(endpoint_url):
+    provider = Claude(endpoint_url=endpoint_url, governor=Ungoverned())
+    # The client config Claude used: botocore's default retries.
+    provider.clients[0] = boto3.client(
+        "bedrock-runtime",
+        region_name=provider.targets[0][0],
+        config=Config(connect_timeout=10, read_timeout=30),
+        endpoint_url=endpoint_url,
+    )
+    return provider
+
+
+def measure(create_provider, fake, lambdas, workers, fixes, redelivery_delay):
+    providers = [create_provider(fake.endpoint_url) for _ in range(lambdas)]
+    fake.throttled = 0
+    fake.errors = 0
+    fake.peak_concurrency.clear()
+
+    def fix(i):
+        """Fix until it succeeds, and return the number of redeliveries."""
+        redeliveries = 0
+        while True:
+            try:
+                providers[i % lambdas].fix_code(
+                    "KeyError: 'order_items'", {"src/foo.py": "x = 1\n"}, "edits"
+                )
+                return redeliveries
+            except Exception:
+                redeliveries += 1
+                time.sleep(redelivery_delay)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=lambdas * workers) as executor:
+        redeliveries = sum(executor.map(fix, range(fixes)))
+    duration = time.perf_counter() - start
+    invocations = [m for provider in providers for m in provider.invocations]
+    return {
+        "seconds": duration,
+        "fixes/s": fixes / duration,
+        "redeliveries": redeliveries,
+        "throttled": fake.throttled,
+        "server errors": fake.errors,
+        "on fallback": sum(1 for m in invocations if m.get("target")),
+        "mean call s": sum(m["duration"] for m in invocations) / len(invocations),
+    }
+
+
+def run(
+    lambdas,
+    workers,
+    fixes,
+    quota,
+    fallback_quota,
+    first_token_delay,
+    tokens_per_second,
+    redelivery_delay,
+    error_probability,
+):
+    logging.disable(logging.WARNING)
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "fake")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "fake")
+    print(
+        f"{fixes} fixes by {lambdas} Lambdas x {workers} workers, concurrency quota {quota} "
+        f"({fallback_quota} in {FALLBACK_REGION}), {first_token_delay:.1f} s to first token, "
+        f"{error_probability:.0%} server errors"
+    )
+    scenarios = {
+        "botocore": botocore_provider,
+        "governor": lambda endpoint_url: Claude(endpoint_url=endpoint_url),
+        "governor+fallback": lambda endpoint_url: Claude(
+            endpoint_url=endpoint_url,
+            fallbacks=((FALLBACK_REGION, "anthropic.claude-v2"),),
+        ),
+    }
+    results = {}
+    with FakeBedrock(
+        first_token_delay=first_token_delay,
+        tokens_per_second=tokens_per_second,
+        max_concurrency={"us-east-1": quota, FALLBACK_REGION: fallback_quota},
+        error_probability=error_probability / 2,
+        stream_error_probability=error_probability / 2,
+    ) as fake:
+        for name, create_provider in scenarios.items():
+            results[name] = measure(
+                create_provider, fake, lambdas, workers, fixes, redelivery_delay
+            )
+    print(f"{'':<14}" + "".join(f" {name:>18}" for name in results))
+    for metric in results["botocore"]:
+        print(
+            f"{metric:<14}"
+            + "".join(f" {result[metric]:>18.3g}" for result in results.values())
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--lambdas", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--fixes", type=int, default=48)
+    parser.add_argument("--quota", type=int, default=4)
+    parser.add_argument("--fallback-quota", type=int, default=2)
+    parser.add_argument("--first-token-delay", type=float, default=2.0)
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--redelivery-delay", type=float, default=10)
+    parser.add_argument("--error-probability", type=float, default=0.0)
+    args = parser.parse_args()
+    run(
+        args.lambdas,
+        args.workers,
+        args.fixes,
+        args.quota,
+        args.fallback_quota,
+        args.first_token_delay,
+        args.tokens_per_second,
+        args.redelivery_delay,
+        args.error_probability,
+    )
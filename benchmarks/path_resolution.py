@@ -0,0 +1,85 @@
+"""Compare the legacy basename scan with the path index when resolving stack frame paths in a large repo.
+
+Usage: python benchmarks/path_resolution.py [--files 100000] [--frames 20]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from path_index import PathIndex  # noqa: E402
+
+COMMON_BASENAMES = ("__init__.py", "handler.py", "index.js", "utils.py")
+
+
+def make_repo_paths(count):
+    rng = random.Random(0)
+    paths = []
+    for i in range(count):
+        depth = rng.randrange(1, 6)
+        directories = [f"pkg{rng.randrange(200)}" for _ in range(depth)]
+        if rng.random() < 0.3:
+            basename = rng.choice(COMMON_BASENAMES)
+        else:
+            basename = f"module_{i}.py"
+        paths.append("/".join(["src", *directories, basename]))
+    return sorted(set(paths))
+
+
+def legacy_find_partial_matches(primary_paths, secondary_paths):
+    """The basename scan fix_code used before the path index."""
+    results = []
+    for primary_path in primary_paths:
+        primary_filename = os.path.basename(primary_path)
+        for secondary_path in secondary_paths:
+            secondary_filename = os.path.basename(secondary_path)
+            if primary_filename == secondary_filename:
+                results.append(secondary_path)
+    return results
+
+
+def run(files, frame_count):
+    paths = make_repo_paths(files)
+    rng = random.Random(1)
+    frames = [
+        "/var/task/" + path[len("src/") :] for path in rng.sample(paths, frame_count)
+    ]
+
+    start = time.perf_counter()
+    legacy = legacy_find_partial_matches(frames, paths)
+    legacy_duration = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = PathIndex(paths)
+    build_duration = time.perf_counter() - start
+
+    # The first lookup of a shared basename builds its suffix trie.
+    start = time.perf_counter()
+    resolved = [path for frame in frames for path in index.resolve(frame)]
+    first_duration = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for frame in frames:
+        index.resolve(frame)
+    resolve_duration = time.perf_counter() - start
+
+    print(f"{len(paths):,} repo files, {frame_count} frames")
+    print(
+        f"legacy scan:  {legacy_duration * 1000:>9.2f} ms, {len(legacy):>6,} files matched"
+    )
+    print(f"index build:  {build_duration * 1000:>9.2f} ms (once per commit)")
+    print(
+        f"first lookup: {first_duration / frame_count * 1e6:>9.2f} us/frame, {len(resolved):>6,} files matched"
+    )
+    print(f"warm lookup:  {resolve_duration / frame_count * 1e6:>9.2f} us/frame")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=100000)
+    parser.add_argument("--frames", type=int, default=20)
+    args = parser.parse_args()
+    run(args.files, args.frames)
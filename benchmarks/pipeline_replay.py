@@ -0,0 +1,516 @@
+"""Replay synthetic CloudWatch Logs through detect_error, triage, schedule and fix_code, offline, and compare the run
+with a stored baseline.
+
+Generates gzip and base64 encoded subscription payloads of a varying number of log events, each event an error of
+one of the issues of the workload, in Python, Node.js or Java. `--duplicate-ratio` is the fraction of the events
+repeating an issue of an earlier event. Every round runs the handlers in a new process against local stand-ins: an
+in-memory DynamoDB whose issue table changes are fed to triage as stream records, in-memory SQS queues delivered to
+schedule and fix_code as the Lambda event source mappings deliver them, the fake SSM Parameter Store, the fake
+Bedrock endpoint scripted to fix each issue, a local bare git remote of the services raising the errors and the fake
+GitHub API.
+
+Reports the log events processed per second, the p50 and p99 latency of every handler and of the stages they report
+in their metrics, and the peak memory, each the median of `--rounds` rounds. `--save-baseline` stores the results in
+a JSON file; `--baseline` compares the run with a stored one and exits with status 1 when a latency, memory or
+throughput metric regressed by more than `--tolerance`.
+
+Usage: python benchmarks/pipeline_replay.py [--payloads 40] [--events-per-payload 1 100] [--duplicate-ratio 0.99]
+    [--languages python node java] [--repo-files 200] [--fix-batch-size 10] [--first-token-delay 0.2]
+    [--tokens-per-second 200] [--seed 0] [--rounds 3] [--trace-memory] [--baseline FILE] [--save-baseline FILE]
+    [--tolerance 0.2]
+"""
+import argparse
+import base64
+import contextlib
+import gzip
+import io
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from fake_bedrock import FakeBedrock  # noqa: E402
+from local_services import (  # noqa: E402
+    FakeDynamoDB,
+    FakeGitHub,
+    FakeSQS,
+    FakeSSM,
+    create_remote,
+)
+
+PARAMETER_STORE_PREFIX = "/self-healing-code/"
+ISSUE_TABLE = "issues"
+SCHEDULER_TABLE = "scheduler"
+PENDING_QUEUE_URL = "https://sqs.us-east-1.amazonaws.com/123456789012/pending"
+WORKER_QUEUE_URL = "https://sqs.us-east-1.amazonaws.com/123456789012/worker"
+# Records of a triage invocation, the batch size of the stream event source mapping.
+STREAM_BATCH_SIZE = 100
+LOG_GROUP = "/aws/lambda/orders"
+# Stages taking microseconds vary by multiples of their duration from run to run.
+MIN_LATENCY_CHANGE_MS = 1
+
+# The source file of an issue, the error it raises, and the edit fixing it, by language. `{i}` is the issue number.
+LANGUAGES = {
+    "python": {
+        "filename": "app/service_{i}.py",
+        "source": "import json\n\n\ndef handle_{i}(event, context):\n    body = json.loads(event['body'])\n"
+        "    value = body['key_{i}']\n    return {{'statusCode': 200, 'body': json.dumps(value)}}\n",
+        "trace": "[ERROR] KeyError: 'key_{i}'\nTraceback (most recent call last):\n"
+        '  File "/var/task/app/service_{i}.py", line 6, in handle_{i}\n'
+        "    value = body['key_{i}']\nRequestId: {request_id}",
+        "search": "    value = body['key_{i}']\n",
+        "replace": "    value = body.get('key_{i}')\n",
+    },
+    "node": {
+        "filename": "src/service_{i}.js",
+        "source": "exports.handle{i} = async (event) => {{\n  const body = JSON.parse(event.body);\n"
+        "  const value = body.items_{i}.length;\n  return {{ statusCode: 200, body: JSON.stringify(value) }};\n}};\n",
+        "trace": "{request_id}\tERROR\tInvoke Error\tTypeError: Cannot read properties of undefined (reading "
+        "'length')\n    at exports.handle{i} (/var/task/src/service_{i}.js:3:35)\n"
+        "    at Runtime.handleOnceNonStreaming (file:///var/runtime/index.mjs:1173:29)",
+        "search": "  const value = body.items_{i}.length;\n",
+        "replace": "  const value = (body.items_{i} || []).length;\n",
+    },
+    "java": {
+        "filename": "src/main/java/com/example/Service{i}.java",
+        "source": "package com.example;\n\nimport java.util.Map;\n\npublic class Service{i} {{\n"
+        '    public int handle(Map<String, String> body) {{\n        return body.get("key_{i}").length();\n'
+        "    }}\n}}\n",
+        "trace": '{request_id} ERROR java.lang.NullPointerException: Cannot invoke "String.length()"\n'
+        "\tat com.example.Service{i}.handle(Service{i}.java:7)\n"
+        "\tat java.base/java.lang.Thread.run(Thread.java:833)",
+        "search": '        return body.get("key_{i}").length();\n',
+        "replace": '        return body.getOrDefault("key_{i}", "").length();\n',
+    },
+}
+ISSUE_FILE_PATTERN = re.compile(r"(?:service_|Service)(?P<issue>\d+)\.(?:py|js|java)")
+
+
+class Context:
+    """The part of the Lambda context the handlers use."""
+
+    def __init__(self):
+        self.aws_request_id = str(uuid.uuid4())
+
+
+class MetricsCollector(io.TextIOBase):
+    """Stdout replacement collecting the durations of the EMF documents written by the handlers, by function and
+    metric. Other output is passed through."""
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.durations = defaultdict(lambda: defaultdict(list))
+        self.documents = []
+        self._buffer = ""
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        with self._lock:
+            self._buffer += text
+            *lines, self._buffer = self._buffer.split("\n")
+        for line in lines:
+            if line.startswith('{"_aws"'):
+                self._collect(json.loads(line))
+            else:
+                self.stdout.write(line + "\n")
+        return len(text)
+
+    def _collect(self, document):
+        self.documents.append(document)
+        for metric in document["_aws"]["CloudWatchMetrics"][0]["Metrics"]:
+            if metric["Unit"] == "Milliseconds":
+                self.durations[document["Function"]][metric["Name"]].append(
+                    document[metric["Name"]]
+                )
+
+
+def make_workload(payloads, events_per_payload, duplicate_ratio, languages, seed):
+    """Return the languages of the issues, and the issue numbers of the log events of each payload."""
+    rng = random.Random(seed)
+    sizes = [rng.randint(*events_per_payload) for _ in range(payloads)]
+    events = sum(sizes)
+    issue_count = max(1, round(events * (1 - duplicate_ratio)))
+    issue_languages = [languages[i % len(languages)] for i in range(issue_count)]
+    sequence = list(range(issue_count)) + [
+        rng.randrange(issue_count) for _ in range(events - issue_count)
+    ]
+    rng.shuffle(sequence)
+    batches = []
+    for size in sizes:
+        batches.append(sequence[:size])
+        sequence = sequence[size:]
+    return issue_languages, batches
+
+
+def encode_payload(messages, timestamp):
+    """Encode log messages as a CloudWatch Logs subscription payload."""
+    data = {
+        "messageType": "DATA_MESSAGE",
+        "owner": "123456789012",
+        "logGroup": LOG_GROUP,
+        "logStream": "2024/01/01/[$LATEST]0123456789abcdef",
+        "subscriptionFilters": ["errors"],
+        "logEvents": [
+            {"id": str(i), "timestamp": timestamp + i, "message": message}
+            for i, message in enumerate(messages)
+        ],
+    }
+    return base64.b64encode(gzip.compress(json.dumps(data).encode())).decode()
+
+
+def repo_files(issue_languages, filler_files):
+    """Return the files of the target repo: the source of every issue and `filler_files` other modules."""
+    files = {}
+    for i, language in enumerate(issue_languages):
+        filename = LANGUAGES[language]["filename"].format(i=i)
+        files[filename] = LANGUAGES[language]["source"].format(i=i)
+    for i in range(filler_files):
+        filename = f"lib/module_{i // 50}/helpers_{i}.py"
+        files[filename] = f"def helper_{i}():\n    return {i}\n"
+    return files
+
+
+def scripted_fix(issue_languages):
+    """Return the response of the fake model: the edit fixing the issue whose file is in the prompt."""
+
+    def respond(body):
+        issue = int(ISSUE_FILE_PATTERN.search(body["prompt"]).group("issue"))
+        language = LANGUAGES[issue_languages[issue]]
+        completion = {
+            "description": f"Handle the missing value of issue {issue}",
+            "title": f"Fix issue {issue}",
+            "source_code": [
+                {
+                    "filename": language["filename"].format(i=issue),
+                    "edits": [
+                        {
+                            "search": language["search"].format(i=issue),
+                            "replace": language["replace"].format(i=issue),
+                        }
+                    ],
+                }
+            ],
+        }
+        # The prompt ends with the opening brace of the JSON document.
+        return json.dumps(completion, indent=4)[1:]
+
+    return respond
+
+
+def percentile(values, q):
+    """Return the nearest-rank `q` percentile of values."""
+    values = sorted(values)
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+class Pipeline:
+    """Runs the handlers against the stand-ins, delivering the output of each to the next one."""
+
+    def __init__(self, handlers, dynamodb, sqs, fix_batch_size):
+        self.handlers = handlers
+        self.dynamodb = dynamodb
+        self.sqs = sqs
+        self.fix_batch_size = fix_batch_size
+        self.latencies = defaultdict(list)
+        self.fix_failures = 0
+
+    def invoke(self, name, event):
+        start = time.perf_counter()
+        try:
+            return self.handlers[name].handler(event, Context())
+        finally:
+            self.latencies[name].append(time.perf_counter() - start)
+
+    def process(self, payload):
+        """Process a subscription payload, and deliver the changes and messages it causes until the queues are
+        empty."""
+        self.invoke("detect_error", {"awslogs": {"data": payload}})
+        while True:
+            records = self.dynamodb.drain_stream(ISSUE_TABLE, STREAM_BATCH_SIZE)
+            if not records:
+                break
+            self.invoke("triage", {"Records": records})
+        if self.sqs.message_count(PENDING_QUEUE_URL):
+            self.invoke("schedule", {})
+        while True:
+            records = self.sqs.lambda_records(WORKER_QUEUE_URL, self.fix_batch_size)
+            if not records:
+                break
+            response = self.invoke("fix_code", {"Records": records})
+            failed = {
+                failure["itemIdentifier"] for failure in response["batchItemFailures"]
+            }
+            self.fix_failures += len(failed)
+            # The event source mapping deletes the messages which didn't fail; failed ones wait for their visibility
+            # timeout, which outlasts the replay.
+            self.sqs.delete_message_batch(
+                QueueUrl=WORKER_QUEUE_URL,
+                Entries=[
+                    {"Id": str(i), "ReceiptHandle": record["receiptHandle"]}
+                    for i, record in enumerate(records)
+                    if record["messageId"] not in failed
+                ],
+            )
+
+
+def replay(args, workdir):
+    """Replay the workload of `args`, and return the results as a flat dict of metric names to values."""
+    issue_languages, batches = make_workload(
+        args.payloads,
+        args.events_per_payload,
+        args.duplicate_ratio,
+        args.languages,
+        args.seed,
+    )
+    remote_url = create_remote(
+        os.path.join(workdir, "remote.git"),
+        repo_files(issue_languages, args.repo_files),
+    )
+    now = round(time.time() * 1000)
+    payloads = [
+        encode_payload(
+            [
+                LANGUAGES[issue_languages[issue]]["trace"].format(
+                    i=issue, request_id=uuid.uuid4()
+                )
+                for issue in batch
+            ],
+            now,
+        )
+        for batch in batches
+    ]
+    os.environ.update(
+        AWS_ACCESS_KEY_ID="fake",
+        AWS_SECRET_ACCESS_KEY="fake",
+        AWS_DEFAULT_REGION="us-east-1",
+        ISSUE_TABLE=ISSUE_TABLE,
+        SCHEDULER_TABLE=SCHEDULER_TABLE,
+        PENDING_QUEUE_URL=PENDING_QUEUE_URL,
+        WORKER_QUEUE_URL=WORKER_QUEUE_URL,
+        PARAMETER_STORE_PREFIX=PARAMETER_STORE_PREFIX,
+        REPO_CACHE_DIR=os.path.join(workdir, "repo-cache"),
+        # The budgets of the scheduler aren't measured, so they don't hold any issue back.
+        MODEL_CALLS_PER_HOUR="1000000",
+        PULL_REQUESTS_PER_HOUR="1000000",
+        GITHUB_WRITE_INTERVAL="0",
+    )
+    dynamodb = FakeDynamoDB(stream_tables=(ISSUE_TABLE,))
+    sqs = FakeSQS()
+    with FakeBedrock(
+        respond=scripted_fix(issue_languages),
+        first_token_delay=args.first_token_delay,
+        tokens_per_second=args.tokens_per_second,
+    ) as bedrock, FakeGitHub(latency=0.02) as github:
+        parameters = {
+            "model_provider": "bedrock",
+            "repo_url": remote_url,
+            "repo_name": "remote",
+            "repo_api_url": github.repo_api_url(),
+            "repo_api_key": "fake",
+            "repo_ssh_private_key": "fake",
+            "cloudwatch_log_group_name": LOG_GROUP,
+        }
+        with FakeSSM(
+            {PARAMETER_STORE_PREFIX + name: value for name, value in parameters.items()}
+        ) as ssm:
+            os.environ["AWS_ENDPOINT_URL_SSM"] = ssm.endpoint_url
+            os.environ["BEDROCK_ENDPOINT_URL"] = bedrock.endpoint_url
+            from handlers import detect_error, fix_code, schedule, triage
+
+            detect_error.dynamodb_client = dynamodb
+            triage.sqs_client = sqs
+            schedule.sqs_client = sqs
+            schedule.dynamodb_client = dynamodb
+            for bucket in (schedule.model_call_bucket, schedule.pull_request_bucket):
+                bucket.dynamodb_client = dynamodb
+            pipeline = Pipeline(
+                {
+                    "detect_error": detect_error,
+                    "triage": triage,
+                    "schedule": schedule,
+                    "fix_code": fix_code,
+                },
+                dynamodb,
+                sqs,
+                args.fix_batch_size,
+            )
+            collector = MetricsCollector(sys.stdout)
+            if args.trace_memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(collector):
+                for payload in payloads:
+                    pipeline.process(payload)
+            duration = time.perf_counter() - start
+            traced_peak = (
+                tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+            )
+            tracemalloc.stop()
+
+    events = sum(len(batch) for batch in batches)
+    fixes = [
+        document
+        for document in collector.documents
+        if document["Function"] == "fix_code" and "outcome" in document
+    ]
+    payload_bytes = sum(len(payload) for payload in payloads)
+    results = {
+        "log events": events,
+        "issues": len(issue_languages),
+        "mean payload KB": payload_bytes / len(payloads) / 1024,
+        "pull requests": len(github.pulls),
+        "fix failures": pipeline.fix_failures,
+        "fixes with correlation ID": sum(
+            1 for document in fixes if document.get("correlation_id")
+        ),
+        "end to end s": duration,
+        "pipeline events/s": events / duration,
+        "detect_error events/s": events / sum(pipeline.latencies["detect_error"]),
+        # Linux reports the peak resident set size in kilobytes.
+        "peak RSS MB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    if traced_peak is not None:
+        results["peak traced MB"] = traced_peak / 1024 / 1024
+    for name, latencies in pipeline.latencies.items():
+        results[f"{name} calls"] = len(latencies)
+        for q in (50, 99):
+            results[f"{name} p{q} ms"] = percentile(latencies, q) * 1000
+        for metric, durations in collector.durations[name].items():
+            stage = metric[: -len("_duration")]
+            for q in (50, 99):
+                results[f"{name}.{stage} p{q} ms"] = percentile(durations, q)
+    return results
+
+
+def replay_round(args):
+    logging.disable(logging.INFO)
+    workdir = tempfile.mkdtemp()
+    try:
+        return replay(args, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def regression(metric, baseline, current, tolerance):
+    """Return 1 if the metric regressed beyond the tolerance, -1 if it improved beyond it, and 0 otherwise. Counts
+    aren't judged, and neither are latencies changing by less than MIN_LATENCY_CHANGE_MS.
+    """
+    if metric.endswith(" ms") and abs(current - baseline) < MIN_LATENCY_CHANGE_MS:
+        return 0
+    if metric.endswith("/s"):
+        change = (baseline - current) / baseline if baseline else 0
+    elif metric.endswith((" ms", " s", " MB")):
+        change = (current - baseline) / baseline if baseline else 0
+    else:
+        return 0
+    return 1 if change > tolerance else -1 if change < -tolerance else 0
+
+
+def compare(results, workload, baseline_path, tolerance):
+    """Print the results next to the baseline's, and return the number of regressed metrics."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    if baseline["workload"] != workload:
+        print(
+            f"Warning: the workload of {baseline_path} differs: {baseline['workload']}"
+        )
+    print(f"{'':<36} {'baseline':>10} {'current':>10} {'change':>8}")
+    regressions = 0
+    for metric, value in results.items():
+        if metric not in baseline["results"]:
+            print(f"{metric:<36} {'':>10} {value:>10.4g}")
+            continue
+        baseline_value = baseline["results"][metric]
+        change = (
+            f"{(value - baseline_value) / baseline_value:+.0%}"
+            if baseline_value
+            else ""
+        )
+        verdict = regression(metric, baseline_value, value, tolerance)
+        regressions += verdict == 1
+        flag = {1: "  regressed", -1: "  improved", 0: ""}[verdict]
+        print(f"{metric:<36} {baseline_value:>10.4g} {value:>10.4g} {change:>8}{flag}")
+    return regressions
+
+
+def run(args):
+    logging.disable(logging.INFO)
+    workload = {
+        name: getattr(args, name)
+        for name in (
+            "payloads",
+            "events_per_payload",
+            "duplicate_ratio",
+            "languages",
+            "repo_files",
+            "fix_batch_size",
+            "first_token_delay",
+            "tokens_per_second",
+            "seed",
+            "trace_memory",
+            "rounds",
+        )
+    }
+    # Every round starts from a cold interpreter, as a new Lambda container does, and has its own peak memory.
+    context = multiprocessing.get_context("spawn")
+    rounds = []
+    for _ in range(args.rounds):
+        with context.Pool(1) as pool:
+            rounds.append(pool.apply(replay_round, (args,)))
+    results = {
+        metric: statistics.median(result[metric] for result in rounds)
+        for metric in rounds[0]
+        if all(metric in result for result in rounds)
+    }
+    print(
+        f"{results['log events']} log events of {results['issues']} issues ({'/'.join(args.languages)}) in "
+        f"{args.payloads} payloads of {args.events_per_payload[0]}-{args.events_per_payload[1]} events, "
+        f"{args.first_token_delay:.1f} s to first token, median of {args.rounds} rounds"
+    )
+    regressions = 0
+    if args.baseline:
+        regressions = compare(results, workload, args.baseline, args.tolerance)
+    else:
+        for metric, value in results.items():
+            print(f"{metric:<36} {value:>10.4g}")
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({"workload": workload, "results": results}, f, indent=2)
+        print(f"Saved baseline to {args.save_baseline}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--payloads", type=int, default=40)
+    parser.add_argument("--events-per-payload", type=int, nargs=2, default=[1, 100])
+    parser.add_argument("--duplicate-ratio", type=float, default=0.99)
+    parser.add_argument(
+        "--languages", nargs="+", choices=list(LANGUAGES), default=list(LANGUAGES)
+    )
+    parser.add_argument("--repo-files", type=int, default=200)
+    parser.add_argument("--fix-batch-size", type=int, default=10)
+    parser.add_argument("--first-token-delay", type=float, default=0.2)
+    parser.add_argument("--tokens-per-second", type=float, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--trace-memory", action="store_true")
+    parser.add_argument("--baseline")
+    parser.add_argument("--save-baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    sys.exit(1 if run(parser.parse_args()) else 0)
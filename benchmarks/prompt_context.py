@@ -0,0 +1,128 @@
+"""Measure prompt size, and optionally model latency, with whole files and with the token-budgeted source context.
+
+Sample traces are generated from the Python modules of a source tree, the standard library by default, with frames
+on random lines inside functions. Passing --invoke also sends both prompts to Bedrock and reports the latency, which
+needs AWS credentials with access to the model.
+
+Usage: python benchmarks/prompt_context.py [--traces 20] [--frames 3] [--budget 20000] [--repo-dir DIR] [--invoke]
+"""
+import argparse
+import ast
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from providers.bedrock import Claude  # noqa: E402
+from source_context import build_source_context, estimate_tokens  # noqa: E402
+from stack_trace import innermost_first, parse_frames  # noqa: E402
+
+
+def function_lines(path):
+    """Lines inside the functions of a module."""
+    with open(path, "r") as f:
+        tree = ast.parse(f.read())
+    return [
+        line
+        for node in ast.walk(tree)
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))
+        for line in range(node.body[0].lineno, node.end_lineno + 1)
+    ]
+
+
+def load_modules(repo_dir):
+    modules = {}
+    for filename in sorted(os.listdir(repo_dir)):
+        if not filename.endswith(".py"):
+            continue
+        try:
+            lines = function_lines(os.path.join(repo_dir, filename))
+        except (SyntaxError, UnicodeDecodeError):
+            continue
+        if lines:
+            modules[filename] = lines
+    return modules
+
+
+def make_trace(rng, modules, frame_count):
+    lines = ["Traceback (most recent call last):\n"]
+    for filename in rng.sample(sorted(modules), frame_count):
+        line = rng.choice(modules[filename])
+        lines.append(f'  File "/var/task/{filename}", line {line}, in handler\n')
+    lines.append("KeyError: 'order_items'\n")
+    return "".join(lines)
+
+
+def file_frames(trace):
+    frames = {}
+    for frame in innermost_first(parse_frames(trace)):
+        frames.setdefault(os.path.basename(frame.path), []).append(frame)
+    return frames
+
+
+def full_source_map(repo_dir, filenames):
+    source_code_map = {}
+    for filename in filenames:
+        with open(os.path.join(repo_dir, filename), "r") as f:
+            source_code_map[filename] = f.read()
+    return source_code_map
+
+
+def measure_latency(provider, prompt):
+    start = time.perf_counter()
+    provider._invoke(prompt)
+    return time.perf_counter() - start
+
+
+def run(trace_count, frame_count, budget, repo_dir, invoke):
+    logging.disable(logging.INFO)
+    modules = load_modules(repo_dir)
+    rng = random.Random(0)
+    traces = [make_trace(rng, modules, frame_count) for _ in range(trace_count)]
+    provider = Claude()
+
+    results = {"whole files": [], "source context": []}
+    latencies = {"whole files": [], "source context": []}
+    for trace in traces:
+        frames = file_frames(trace)
+        context = build_source_context(repo_dir, frames, budget)
+        prompts = {
+            "whole files": provider._create_prompt(
+                trace, full_source_map(repo_dir, frames)
+            ),
+            "source context": provider._create_prompt(
+                trace,
+                {filename: excerpt.text for filename, excerpt in context.items()},
+            ),
+        }
+        for name, prompt in prompts.items():
+            results[name].append(estimate_tokens(prompt))
+            if invoke:
+                latencies[name].append(measure_latency(provider, prompt))
+
+    print(
+        f"{trace_count} traces of {frame_count} frames over {len(modules)} modules in {repo_dir}, budget {budget:,} tokens"
+    )
+    for name, tokens in results.items():
+        line = (
+            f"{name:<15} prompt tokens: median {statistics.median(tokens):>8,.0f}, "
+            f"max {max(tokens):>8,}, over budget {sum(t > budget for t in tokens):>3}"
+        )
+        if invoke:
+            line += f", median latency {statistics.median(latencies[name]):>6.1f} s"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--traces", type=int, default=20)
+    parser.add_argument("--frames", type=int, default=3)
+    parser.add_argument("--budget", type=int, default=20000)
+    parser.add_argument("--repo-dir", default=os.path.dirname(ast.__file__))
+    parser.add_argument("--invoke", action="store_true")
+    args = parser.parse_args()
+    run(args.traces, args.frames, args.budget, args.repo_dir, args.invoke)
@@ -0,0 +1,164 @@
+"""Compare the legacy clean_result chain with the single-pass response parser, for parse success rate and speed.
+
+Without --corpus, raw responses are synthesized from Python modules of the standard library, in the forms models
+return them: valid JSON, raw newlines and tabs in strings, unescaped quotes and backslashes in code, code fences
+and prose around the object, trailing commas, and the object continuing the brace opened by the prompt. A response
+counts as parsed when the file contents come back unchanged. --corpus takes a directory of raw responses (*.txt)
+instead, which count as parsed when they validate against the response schema.
+
+Usage: python benchmarks/response_parsing.py [--responses 2000] [--corpus DIR]
+"""
+import argparse
+import ast
+import glob
+import json
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from providers import Model, ModelResponseError  # noqa: E402
+
+
+def legacy_remove_newlines(json_string):
+    result = json_string
+    result = re.sub('(?<!")\\n', "", result)
+    result = re.sub("\\n(?= *})", "", result)
+    return result
+
+
+def legacy_parse(content):
+    """The response cleaning `Model` did before the single-pass parser, including the brace `_invoke` added."""
+    if not content.startswith("{"):
+        content = "{" + content
+    cleaned_result = content.replace("```", "")
+    cleaned_result = legacy_remove_newlines(cleaned_result)
+    cleaned_result = cleaned_result.strip()
+    cleaned_result = cleaned_result.rstrip(",")
+    cleaned_result = cleaned_result.replace("\n", "\\n")
+    return json.loads(cleaned_result)
+
+
+def raw_string(value, escape_quotes):
+    """A string literal as a model writes it: escaping some characters but leaving newlines and tabs raw."""
+    value = value.replace("\\", "\\\\") if escape_quotes else value
+    return '"' + (value.replace('"', '\\"') if escape_quotes else value) + '"'
+
+
+def make_response(rng, contents):
+    description = "Handle the missing key instead of raising a KeyError"
+    kind = rng.choice(
+        [
+            "valid",
+            "raw newlines",
+            "raw code",
+            "fenced",
+            "trailing comma",
+            "continuation",
+        ]
+    )
+    if kind == "valid":
+        text = json.dumps(
+            {
+                "description": description,
+                "title": "Fix KeyError",
+                "source_code": [{"filename": "src/app.py", "contents": contents}],
+            },
+            indent=4,
+        )
+    else:
+        text = (
+            "{\n"
+            f'    "description": "{description}",\n'
+            '    "title": "Fix KeyError",\n'
+            '    "source_code": [\n'
+            "        {\n"
+            '            "filename": "src/app.py",\n'
+            f'            "contents": {raw_string(contents, kind != "raw code")}\n'
+            f"        }}{',' if kind == 'trailing comma' else ''}\n"
+            "    ]\n"
+            "}"
+        )
+    if kind == "fenced":
+        text = f"Here is the fix:\n\n```json\n{text}\n```\n"
+    elif kind == "continuation":
+        text = text[1:]
+    return kind, text
+
+
+def synthesize(count):
+    sources = []
+    stdlib = os.path.dirname(ast.__file__)
+    for path in sorted(glob.glob(os.path.join(stdlib, "*.py")))[:100]:
+        with open(path, "r", errors="replace") as f:
+            lines = f.read().splitlines(keepends=True)
+        sources.append(lines)
+    rng = random.Random(0)
+    corpus = []
+    for _ in range(count):
+        lines = rng.choice(sources)
+        start = rng.randrange(max(1, len(lines) - 60))
+        contents = "".join(lines[start : start + rng.randrange(5, 60)])
+        kind, text = make_response(rng, contents)
+        corpus.append((kind, text, contents))
+    return corpus
+
+
+def load_corpus(directory):
+    corpus = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.txt"))):
+        with open(path, "r") as f:
+            corpus.append((os.path.basename(path), f.read(), None))
+    return corpus
+
+
+class ParsingModel(Model):
+    """A model which only parses responses."""
+
+    def prompt_version(self, output_mode="files"):
+        return ""
+
+
+def parses(parse, text, contents):
+    try:
+        result = parse(text)
+    except (ValueError, ModelResponseError):
+        return False
+    if contents is None:
+        return True
+    return result["source_code"][0]["contents"] == contents
+
+
+def run(count, corpus_dir):
+    corpus = load_corpus(corpus_dir) if corpus_dir else synthesize(count)
+    model = ParsingModel()
+    parsers = {"legacy": legacy_parse, "single pass": model.parse_result}
+    size = sum(len(text) for _, text, _ in corpus)
+    print(f"{len(corpus):,} responses, {size / 1e6:.1f} MB")
+
+    kinds = sorted({kind for kind, _, _ in corpus}) if not corpus_dir else []
+    header = f"{'parser':<12} {'parsed':>8} {'MB/s':>8}"
+    print(header + "".join(f" {kind[:14]:>15}" for kind in kinds))
+    for name, parse in parsers.items():
+        start = time.perf_counter()
+        results = [
+            (kind, parses(parse, text, contents)) for kind, text, contents in corpus
+        ]
+        duration = time.perf_counter() - start
+        parsed = sum(ok for _, ok in results)
+        line = f"{name:<12} {parsed / len(corpus):>8.1%} {size / duration / 1e6:>8.1f}"
+        for kind in kinds:
+            of_kind = [ok for k, ok in results if k == kind]
+            line += f" {sum(of_kind) / len(of_kind):>15.1%}"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--responses", type=int, default=2000)
+    parser.add_argument("--corpus")
+    args = parser.parse_args()
+    run(args.responses, args.corpus)
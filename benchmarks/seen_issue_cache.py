@@ -0,0 +1,78 @@
+"""Replay a burst of identical tracebacks and compare DynamoDB writes with and without the seen-issue cache.
+
+Usage: python benchmarks/seen_issue_cache.py [--invocations 1000] [--distinct 3] [--interval 0.05]
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from issue_cache import SeenIssueCache  # noqa: E402
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def replay(cache, invocations, distinct, interval, clock):
+    """Replay `invocations` payloads, each holding one occurrence of every distinct traceback."""
+    writes = 0
+
+    def write(issues):
+        nonlocal writes
+        writes += len(issues)
+
+    for i in range(invocations):
+        clock.now = i * interval
+        issues = {
+            f"issue-{n}": {
+                "message": f"Traceback {n}",
+                "occurrences": 1,
+                "first_seen": i,
+                "last_seen": i,
+            }
+            for n in range(distinct)
+        }
+        new_issues = {
+            issue_hash: issue
+            for issue_hash, issue in issues.items()
+            if not cache.absorb(issue_hash, issue)
+        }
+        write(new_issues)
+        for issue_hash, issue in new_issues.items():
+            cache.add(issue_hash, issue["message"])
+        cache.flush(write)
+    cache.flush(write, force=True)
+    return writes
+
+
+def run(invocations, distinct, interval):
+    clock = FakeClock()
+    disabled = SeenIssueCache(max_size=0, clock=clock)
+    baseline = replay(disabled, invocations, distinct, interval, clock)
+
+    clock = FakeClock()
+    cache = SeenIssueCache(clock=clock)
+    cached = replay(cache, invocations, distinct, interval, clock)
+
+    print(f"Replayed {invocations} invocations x {distinct} distinct tracebacks")
+    print(f"Writes without cache: {baseline}")
+    print(f"Writes with cache:    {cached}")
+    print(f"Write reduction:      {1 - cached / baseline:.1%}")
+    print(f"Cache stats:          {cache.stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--invocations", type=int, default=1000)
+    parser.add_argument("--distinct", type=int, default=3)
+    parser.add_argument(
+        "--interval", type=float, default=0.05, help="Seconds between invocations"
+    )
+    args = parser.parse_args()
+    run(args.invocations, args.distinct, args.interval)
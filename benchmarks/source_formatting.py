@@ -0,0 +1,128 @@
+"""Compare formatting every returned file serially with black against the change-only, parallel formatter pipeline.
+
+The working tree holds large standard library modules. The model's response returns some of them modified and some
+unchanged, plus JavaScript and YAML files, which black can't format.
+
+Usage: python benchmarks/source_formatting.py [--modified 4] [--unchanged 4] [--rounds 3]
+"""
+import argparse
+import ast
+import glob
+import logging
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from source_code import update_source_code  # noqa: E402
+
+ADDED_FUNCTION = """
+
+def get_order_items(body):
+    return body.get("order_items", [])
+"""
+OTHER_FILES = {
+    "web/app.js": "export function orderItems(body) {\n  return body.order_items ?? [];\n}\n",
+    "template.yaml": "Resources:\n  Orders:\n    Type: AWS::DynamoDB::Table\n",
+}
+
+
+def legacy_update_source_code(files, repo_dir):
+    """Format every file with black in sequence and write every file, as update_source_code did."""
+    from black import FileMode, format_str
+
+    for file in files:
+        contents = format_str(file["contents"], mode=FileMode())
+        with open(os.path.join(repo_dir, file["filename"]), "w") as f:
+            f.write(contents)
+
+
+def make_tree(repo_dir, modified, unchanged):
+    """Write large stdlib modules to the tree, and return the files of a model response."""
+    stdlib = os.path.dirname(ast.__file__)
+    paths = sorted(
+        glob.glob(os.path.join(stdlib, "*.py")), key=os.path.getsize, reverse=True
+    )
+    files = []
+    for i, path in enumerate(paths[: modified + unchanged]):
+        with open(path, "r") as f:
+            contents = f.read()
+        filename = f"src/module_{i}.py"
+        os.makedirs(os.path.join(repo_dir, "src"), exist_ok=True)
+        with open(os.path.join(repo_dir, filename), "w") as f:
+            f.write(contents)
+        if i < modified:
+            contents += ADDED_FUNCTION
+        files.append({"filename": filename, "contents": contents})
+    for filename, contents in OTHER_FILES.items():
+        files.append({"filename": filename, "contents": contents})
+    return files
+
+
+def measure(update, files, modified, unchanged):
+    repo_dir = tempfile.mkdtemp()
+    try:
+        make_tree(repo_dir, modified, unchanged)
+        before = {}
+        for file in files:
+            path = os.path.join(repo_dir, file["filename"])
+            before[file["filename"]] = (
+                os.stat(path).st_mtime_ns if os.path.exists(path) else None
+            )
+        start = time.perf_counter()
+        try:
+            update(files, repo_dir)
+            outcome = "ok"
+        except Exception as e:
+            outcome = type(e).__name__
+        duration = time.perf_counter() - start
+        written = 0
+        for file in files:
+            path = os.path.join(repo_dir, file["filename"])
+            if (
+                os.path.exists(path)
+                and os.stat(path).st_mtime_ns != before[file["filename"]]
+            ):
+                written += 1
+        return duration, written, outcome
+    finally:
+        shutil.rmtree(repo_dir)
+
+
+def run(modified, unchanged, rounds):
+    logging.disable(logging.INFO)
+    repo_dir = tempfile.mkdtemp()
+    files = make_tree(repo_dir, modified, unchanged)
+    shutil.rmtree(repo_dir)
+    python_files = [file for file in files if file["filename"].endswith(".py")]
+    size = sum(len(file["contents"]) for file in python_files)
+    print(
+        f"{len(python_files)} Python files ({modified} modified, {size / 1e6:.1f} MB) and "
+        f"{len(files) - len(python_files)} other files, {os.cpu_count()} CPUs"
+    )
+    print(f"{'':<26} {'seconds':>8} {'written':>8}  outcome")
+    scenarios = {
+        "legacy, Python files": (legacy_update_source_code, python_files),
+        "legacy, all files": (legacy_update_source_code, files),
+        "pipeline, all files": (update_source_code, files),
+    }
+    for name, (update, scenario_files) in scenarios.items():
+        results = [
+            measure(update, scenario_files, modified, unchanged) for _ in range(rounds)
+        ]
+        duration = statistics.median(result[0] for result in results)
+        _, written, outcome = results[-1]
+        print(f"{name:<26} {duration:>8.2f} {written:>8}  {outcome}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--modified", type=int, default=4)
+    parser.add_argument("--unchanged", type=int, default=4)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+    run(args.modified, args.unchanged, args.rounds)
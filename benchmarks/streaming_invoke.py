@@ -0,0 +1,77 @@
+"""Compare how long blocking and streaming model invocations take to succeed or fail, against a fake Bedrock endpoint.
+
+Scenarios cover a valid response, a refusal in prose, JSON which breaks part way and a response running into the
+token limit. Blocking invocations only fail after the whole completion was generated. Streaming invocations abort a
+response without a JSON object in its first STREAM_MAX_PREAMBLE characters, such as a refusal, right away. A response
+whose JSON breaks after the object started is read on for the parser to repair, until it ends, exceeds the token
+limit or repeats itself.
+
+Usage: python benchmarks/streaming_invoke.py [--tokens-per-second 200] [--first-token-delay 1.0]
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from fake_bedrock import DEFAULT_COMPLETION, FakeBedrock  # noqa: E402
+from providers.bedrock import Claude  # noqa: E402
+
+SCENARIOS = {
+    "valid": DEFAULT_COMPLETION,
+    "refusal": "I apologize, but I cannot determine the fix from this stack trace. "
+    * 100,
+    "broken json": '"description": "Fix the KeyError", "title": "Fix KeyError" '
+    + '"source_code": []} '
+    + "x" * 8000,
+    "runaway": '"description": "'
+    + "The handler fails when the key is missing. " * 2000,
+}
+
+
+def measure(provider, completion):
+    start = time.perf_counter()
+    try:
+        provider.fix_code("KeyError: 'order_items'", {"src/foo.py": "x = 1\n"}, "edits")
+        outcome = "ok"
+    except Exception as e:
+        outcome = type(e).__name__
+    return time.perf_counter() - start, outcome
+
+
+def run(tokens_per_second, first_token_delay):
+    logging.disable(logging.INFO)
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "fake")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "fake")
+    with FakeBedrock(
+        first_token_delay=first_token_delay, tokens_per_second=tokens_per_second
+    ) as fake:
+        blocking = Claude(endpoint_url=fake.endpoint_url, streaming=False)
+        streaming = Claude(endpoint_url=fake.endpoint_url)
+        print(
+            f"{tokens_per_second:,.0f} tokens/s, {first_token_delay:.1f} s to first token"
+        )
+        print(f"{'scenario':<12} {'blocking':>18} {'streaming':>26}")
+        for name, completion in SCENARIOS.items():
+            fake.respond = lambda body, completion=completion: completion
+            blocking_duration, blocking_outcome = measure(blocking, completion)
+            streaming_duration, streaming_outcome = measure(streaming, completion)
+            print(
+                f"{name:<12} {blocking_duration:>6.2f} s {blocking_outcome:<10}"
+                f" {streaming_duration:>6.2f} s {streaming_outcome:<18}"
+            )
+        metrics = streaming.invocations[0]
+        print(
+            f"valid streaming response: {metrics['time_to_first_token']:.2f} s to first token, "
+            f"{metrics['tokens_per_second']:,.0f} tokens/s"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tokens-per-second", type=float, default=200)
+    parser.add_argument("--first-token-delay", type=float, default=1.0)
+    args = parser.parse_args()
+    run(args.tokens_per_second, args.first_token_delay)
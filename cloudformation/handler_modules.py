@@ -0,0 +1,61 @@
+"""Print the source files a Lambda handler imports from src/, directly or indirectly, one per line.
+
+Imports inside functions count too, so modules which are imported lazily are still packaged.
+
+Usage: python cloudformation/handler_modules.py src handlers/detect_error.py
+"""
+import ast
+import os
+import sys
+
+
+def module_path(source_dir, module_name):
+    """Return the path of a module relative to source_dir, or None if it isn't part of the source."""
+    parts = module_name.split(".")
+    for path in (
+        os.path.join(*parts) + ".py",
+        os.path.join(*parts, "__init__.py"),
+    ):
+        if os.path.isfile(os.path.join(source_dir, path)):
+            return path
+    return None
+
+
+def imported_modules(source_dir, path):
+    """Return the names of the modules imported by a source file."""
+    with open(os.path.join(source_dir, path), "r") as f:
+        tree = ast.parse(f.read(), path)
+    names = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names.append(node.module)
+            # `from package import module` imports a submodule.
+            names.extend(f"{node.module}.{alias.name}" for alias in node.names)
+    return names
+
+
+def handler_modules(source_dir, handler_path):
+    """Return the sorted source files of the handler and every module of source_dir it imports."""
+    paths = set()
+    pending = [handler_path]
+    while pending:
+        path = pending.pop()
+        if path in paths:
+            continue
+        paths.add(path)
+        for name in imported_modules(source_dir, path):
+            # Importing a submodule runs the __init__ of its parent packages.
+            parts = name.split(".")
+            for i in range(1, len(parts) + 1):
+                imported_path = module_path(source_dir, ".".join(parts[:i]))
+                if imported_path:
+                    pending.append(imported_path)
+    return sorted(paths)
+
+
+if __name__ == "__main__":
+    source_dir, handler_path = sys.argv[1:3]
+    for path in handler_modules(source_dir, handler_path):
+        print(path)
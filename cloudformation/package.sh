@@ -21,3 +21,16 @@ deactivate
 # Copy source code
 echo "Copying source code into deployment package"
 rsync -av --exclude '__pycache__/' ../src/ package/
+
+# Build a trimmed package for each function which doesn't need the fix path dependencies: only boto3, pinned as in
+# the full package, and the source modules the handler imports.
+echo "Creating trimmed deployment packages"
+mkdir -p light-dependencies
+grep -E '^boto3==' ../src/requirements.txt > light-requirements.txt
+python3 -m pip install -q -r light-requirements.txt -t light-dependencies --upgrade
+for function in detect_error triage schedule; do
+    mkdir -p "package-${function}"
+    rsync -a light-dependencies/ "package-${function}/"
+    python3 ../cloudformation/handler_modules.py ../src "handlers/${function}.py" > "${function}-modules.txt"
+    rsync -a --files-from="${function}-modules.txt" ../src/ "package-${function}/"
+done
@@ -0,0 +1,189 @@
+import hashlib
+import random
+import time
+
+from fingerprint import Fingerprinter
+
+# 32 MinHash permutations split into 16 LSH bands of 2 rows. Issues with a Jaccard similarity of 0.5 share at least
+# one band with a probability of ~99%, at 0.2 with ~48%; candidates are then verified against the cluster signature.
+NUM_PERMUTATIONS = 32
+BANDS = 16
+ROWS_PER_BAND = NUM_PERMUTATIONS // BANDS
+DEFAULT_SIMILARITY_THRESHOLD = 0.5
+
+MERSENNE_PRIME = (1 << 61) - 1
+_random = random.Random(1)
+PERMUTATIONS = [
+    (_random.randrange(1, MERSENNE_PRIME), _random.randrange(0, MERSENNE_PRIME))
+    for _ in range(NUM_PERMUTATIONS)
+]
+
+
+def shingles(message, fingerprinter):
+    """Build the set of features an error message is compared on.
+
+    For stack traces these are the exception type, each frame and each caller/callee pair of frames, so the same
+    frames reached through a different call path still overlap heavily. Otherwise word trigrams of the normalized
+    message are used.
+    """
+    exception_type, frames = fingerprinter.frames(message)
+    if frames:
+        features = {f"type:{exception_type}"}
+        features.update(f"frame:{frame}" for frame in frames)
+        features.update(f"call:{a}>{b}" for a, b in zip(frames, frames[1:]))
+        return features
+
+    words = fingerprinter.normalize(message).split()
+    if len(words) < 3:
+        return {" ".join(words)}
+    return {" ".join(words[i : i + 3]) for i in range(len(words) - 2)}
+
+
+def minhash(features):
+    """Compute the MinHash signature of a set of features."""
+    hashes = [
+        int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), "big")
+        for feature in features
+    ]
+    return [min((a * h + b) % MERSENNE_PRIME for h in hashes) for a, b in PERMUTATIONS]
+
+
+def estimate_similarity(signature, other_signature):
+    """Estimate the Jaccard similarity of two feature sets from their MinHash signatures."""
+    matches = sum(1 for a, b in zip(signature, other_signature) if a == b)
+    return matches / len(signature)
+
+
+def band_keys(signature):
+    """Return the LSH band keys of a signature. Similar signatures are likely to share at least one key."""
+    keys = []
+    for band in range(BANDS):
+        rows = signature[band * ROWS_PER_BAND : (band + 1) * ROWS_PER_BAND]
+        digest = hashlib.md5(
+            ",".join(map(str, rows)).encode(), usedforsecurity=False
+        ).hexdigest()
+        keys.append(f"band#{band}#{digest}")
+    return keys
+
+
+class ClusterIndex:
+    """Locality sensitive hashing index of issue clusters, stored in a DynamoDB table.
+
+    Items:
+    - `cluster#<id>` / `cluster#<id>`: the cluster representative, its MinHash signature and, once it was enqueued,
+      `enqueued_at`
+    - `cluster#<id>` / `member#<issue>`: an issue attached to the cluster
+    - `band#<n>#<hash>` / `band`: maps an LSH band key to the cluster that first claimed it
+
+    Looking up an issue costs a single BatchGetItem on its band keys plus one for the candidate clusters, regardless
+    of how many issues are indexed.
+    """
+
+    def __init__(
+        self,
+        dynamodb,
+        table_name,
+        similarity_threshold=DEFAULT_SIMILARITY_THRESHOLD,
+        fingerprinter=None,
+    ):
+        self.dynamodb = dynamodb
+        self.table_name = table_name
+        self.table = dynamodb.Table(table_name)
+        self.similarity_threshold = similarity_threshold
+        self.fingerprinter = fingerprinter or Fingerprinter()
+
+    def assign(self, issue_hash, message):
+        """Attach an issue to the most similar known cluster, or create a new cluster for it.
+
+        Returns the cluster ID and whether the issue is the representative of a newly created cluster.
+        """
+        signature = minhash(shingles(message, self.fingerprinter))
+        keys = band_keys(signature)
+        bands = {
+            item["pk"]: item["cluster_id"]
+            for item in self._batch_get([{"pk": key, "sk": "band"} for key in keys])
+        }
+
+        cluster_id, similarity = self._best_match(signature, set(bands.values()))
+        # An issue matching its own cluster is being retried, and is still that cluster's representative. Its cluster
+        # item is kept as is, with the mark of an earlier enqueue.
+        created = cluster_id is None
+        cluster_id = cluster_id or issue_hash
+        is_new = cluster_id == issue_hash
+        with self.table.batch_writer() as batch:
+            if created:
+                batch.put_item(
+                    Item={
+                        "pk": f"cluster#{cluster_id}",
+                        "sk": f"cluster#{cluster_id}",
+                        "representative": issue_hash,
+                        "signature": ",".join(map(str, signature)),
+                    }
+                )
+            batch.put_item(
+                Item={
+                    "pk": f"cluster#{cluster_id}",
+                    "sk": f"member#{issue_hash}",
+                    "similarity": str(1.0 if is_new else similarity),
+                }
+            )
+            # Only unclaimed band keys are written, so an existing mapping is never stolen by another cluster.
+            for key in keys:
+                if key not in bands:
+                    batch.put_item(
+                        Item={"pk": key, "sk": "band", "cluster_id": cluster_id}
+                    )
+        return cluster_id, is_new
+
+    def mark_enqueued(self, cluster_id):
+        """Mark the representative of a cluster as enqueued, and return whether it wasn't already.
+
+        Stream records are redelivered from the first failed one on, so a representative may be assigned again after
+        it was enqueued.
+        """
+        try:
+            self.table.update_item(
+                Key={"pk": f"cluster#{cluster_id}", "sk": f"cluster#{cluster_id}"},
+                UpdateExpression="SET enqueued_at = :enqueued_at",
+                ConditionExpression="attribute_not_exists(enqueued_at)",
+                ExpressionAttributeValues={":enqueued_at": int(time.time())},
+            )
+        except self.dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def unmark_enqueued(self, cluster_id):
+        """Remove the enqueue mark of a cluster whose representative could not be enqueued, so it is on retry."""
+        self.table.update_item(
+            Key={"pk": f"cluster#{cluster_id}", "sk": f"cluster#{cluster_id}"},
+            UpdateExpression="REMOVE enqueued_at",
+        )
+
+    def _best_match(self, signature, cluster_ids):
+        best_cluster_id, best_similarity = None, 0.0
+        if not cluster_ids:
+            return best_cluster_id, best_similarity
+
+        clusters = self._batch_get(
+            [
+                {"pk": f"cluster#{cluster_id}", "sk": f"cluster#{cluster_id}"}
+                for cluster_id in cluster_ids
+            ]
+        )
+        for cluster in clusters:
+            cluster_signature = [int(v) for v in cluster["signature"].split(",")]
+            similarity = estimate_similarity(signature, cluster_signature)
+            if similarity >= self.similarity_threshold and similarity > best_similarity:
+                best_cluster_id = cluster["representative"]
+                best_similarity = similarity
+        return best_cluster_id, best_similarity
+
+    def _batch_get(self, keys):
+        """Fetch items by key, retrying any unprocessed keys."""
+        items = []
+        request = {self.table_name: {"Keys": keys}}
+        while request:
+            response = self.dynamodb.batch_get_item(RequestItems=request)
+            items.extend(response["Responses"].get(self.table_name, []))
+            request = response.get("UnprocessedKeys")
+        return items
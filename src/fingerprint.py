@@ -0,0 +1,119 @@
+import hashlib
+import re
+from collections import namedtuple
+
+from stack_trace import FrameParser
+
+# `first_chars` optionally lists the characters a match can start with (as a regex character class body). When every
+# rule declares it, positions that cannot start any match are skipped with a single lookahead.
+Rule = namedtuple(
+    "Rule", ["name", "pattern", "replacement", "first_chars"], defaults=(None,)
+)
+
+HEX_CHARS = "0-9a-fA-F"
+
+# Rules are tried left to right at each position, so more specific tokens must come before the generic ones.
+DEFAULT_RULES = (
+    Rule(
+        "uuid",
+        r"\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b",
+        "<uuid>",
+        HEX_CHARS,
+    ),
+    Rule("xray_trace_id", r"\b1-[0-9a-f]{8}-[0-9a-f]{24}\b", "<trace-id>", "1"),
+    Rule(
+        "iso_timestamp",
+        r"\b\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:[.,]\d+)?(?:Z|[+-]\d{2}:?\d{2})?",
+        "<timestamp>",
+        "0-9",
+    ),
+    Rule("hex_address", r"\b0x[0-9a-fA-F]+\b", "<address>", "0"),
+    Rule("hex_id", r"\b[0-9a-fA-F]{16,}\b", "<hex>", HEX_CHARS),
+    Rule("number", r"\b\d+(?:\.\d+)?\b", "<num>", "0-9"),
+)
+
+FINGERPRINT_MODES = ("message", "frames")
+
+EXCEPTION_TYPE_PATTERN = re.compile(r"\b([A-Za-z_][\w.]*(?:Error|Exception))\b")
+# A line stating an exception: its type at the start, after an optional log level, then its message. In chained
+# Python tracebacks the last of these lines is the exception finally raised. Java's "Caused by:" lines don't match.
+EXCEPTION_LINE_PATTERN = re.compile(
+    r"^[ \t]*(?:\[[A-Z]+\][ \t]*)?((?:[A-Za-z_][\w.$]*)?(?:Error|Exception))(?::|[ \t]*$)",
+    re.MULTILINE,
+)
+
+
+class Fingerprinter:
+    """Derive a stable fingerprint for an error log message.
+
+    Stateful tokens (request IDs, timestamps, addresses, numbers...) are masked so that every occurrence of the same
+    error maps to the same fingerprint. All rules are compiled into a single alternation so a message is normalized
+    in one pass. In "frames" mode the signature is the exception type plus the stack frames stripped of line and
+    column numbers, falling back to the normalized message when the message holds no recognizable frames.
+    """
+
+    def __init__(self, rules=DEFAULT_RULES, mode="frames", frame_parser=None):
+        if mode not in FINGERPRINT_MODES:
+            raise ValueError(f"Invalid fingerprint mode: {mode}")
+        self.mode = mode
+        self.rules = list(rules)
+        self.frame_parser = frame_parser or FrameParser()
+        self._compile()
+
+    def add_rule(self, name, pattern, replacement, first_chars=None):
+        """Register an additional masking rule, tried after the existing ones.
+
+        The pattern must not define named groups of its own.
+        """
+        self.rules.append(Rule(name, pattern, replacement, first_chars))
+        self._compile()
+
+    def normalize(self, message):
+        """Mask the stateful tokens in a message."""
+        return self._rules_pattern.sub(self._replace, message)
+
+    def frames(self, message):
+        """Return the exception type and the stack frames (`path:function`) found in a message.
+
+        The type is taken from the last exception line, or else from the first exception type mentioned.
+        """
+        match = None
+        for match in EXCEPTION_LINE_PATTERN.finditer(message):
+            pass
+        match = match or EXCEPTION_TYPE_PATTERN.search(message)
+        exception_type = match.group(1) if match else None
+        frames = [
+            f"{frame.path}:{frame.function}"
+            for frame in self.frame_parser.parse(message)
+        ]
+        return exception_type, frames
+
+    def signature(self, message):
+        """Return the text a message is fingerprinted on."""
+        if self.mode == "frames":
+            exception_type, frames = self.frames(message)
+            if frames:
+                # Frame paths and function names are code locations, so they are kept as-is.
+                return "\n".join([str(exception_type), *frames])
+        return self.normalize(message)
+
+    def fingerprint(self, message):
+        """Return the hex digest fingerprint of a message."""
+        return hashlib.md5(
+            self.signature(message).encode(), usedforsecurity=False
+        ).hexdigest()
+
+    def _compile(self):
+        pattern = "|".join(
+            f"(?P<rule{i}>{rule.pattern})" for i, rule in enumerate(self.rules)
+        )
+        if all(rule.first_chars for rule in self.rules):
+            first_chars = "".join(rule.first_chars for rule in self.rules)
+            pattern = f"(?=[{first_chars}])(?:{pattern})"
+        self._rules_pattern = re.compile(pattern)
+        self._replacements = {
+            f"rule{i}": rule.replacement for i, rule in enumerate(self.rules)
+        }
+
+    def _replace(self, match):
+        return self._replacements[match.lastgroup]
@@ -0,0 +1,224 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+from fingerprint import DEFAULT_RULES, Fingerprinter
+from issue_cache import EVICTION_POLICIES
+from utils import get_logger
+
+logger = get_logger()
+
+DEFAULT_TTL = 7 * 24 * 3600
+# DynamoDB items are limited to 400 KB. Larger results are not cached.
+MAX_ITEM_BYTES = 390 * 1024
+
+# Line numbers are part of the key: with identical source files, the same error raised at another line is a
+# different bug. Other stateful tokens such as request IDs and timestamps are masked, so re-triggered issues hit.
+trace_fingerprinter = Fingerprinter(
+    rules=[rule for rule in DEFAULT_RULES if rule.name != "number"], mode="message"
+)
+
+
+def fix_key(stack_trace, model_id, prompt_version, source_code_map):
+    """Build the content-addressed cache key of a model result.
+
+    The key covers everything the result depends on: the trace fingerprint, the model, the prompt and the hash of
+    each file sent to the model.
+    """
+    file_hashes = sorted(
+        (filename, hashlib.sha256(contents.encode()).hexdigest())
+        for filename, contents in source_code_map.items()
+    )
+    parts = [
+        trace_fingerprinter.fingerprint(stack_trace),
+        model_id,
+        prompt_version,
+        *(f"{filename}:{file_hash}" for filename, file_hash in file_hashes),
+    ]
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+
+def encode_result(result):
+    return zlib.compress(json.dumps(result, separators=(",", ":")).encode())
+
+
+def decode_result(data):
+    return json.loads(zlib.decompress(data))
+
+
+class FixResultCache(ABC):
+    """Base class of the model result caches.
+
+    Results are stored encoded, so every `get` returns a fresh copy which the caller can modify.
+    """
+
+    def __init__(self):
+        self._stats_lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "puts": 0, "errors": 0}
+
+    def get(self, key):
+        """Return the cached result for `key`, or None. Lookup errors count as misses."""
+        try:
+            data = self._get(key)
+        except Exception as e:
+            logger.warning(f"Failed to look up cached fix {key}: {e!r}")
+            self._count("errors")
+            data = None
+        self._count("hits" if data is not None else "misses")
+        return decode_result(data) if data is not None else None
+
+    def put(self, key, result):
+        """Cache a result. Failing to cache is logged, never raised."""
+        data = encode_result(result)
+        try:
+            self._put(key, data)
+        except Exception as e:
+            logger.warning(f"Failed to cache fix {key}: {e!r}")
+            self._count("errors")
+            return
+        self._count("puts")
+
+    def get_or_create(self, key, create):
+        """Return the cached result for `key`, calling `create` and caching its result on a miss."""
+        result = self.get(key)
+        if result is not None:
+            logger.info(f"Using cached fix {key}")
+            return result
+        result = create()
+        self.put(key, result)
+        return result
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    @abstractmethod
+    def _get(self, key):
+        pass
+
+    @abstractmethod
+    def _put(self, key, data):
+        pass
+
+
+class DynamoDBFixResultCache(FixResultCache):
+    """Model results stored in a DynamoDB table, shared by every Lambda instance.
+
+    Items expire through the table's TTL on `expires_at`. DynamoDB deletes expired items lazily, so expiry is also
+    checked on read.
+    """
+
+    def __init__(self, dynamodb_client, table_name, ttl=DEFAULT_TTL, clock=time.time):
+        super().__init__()
+        self.dynamodb_client = dynamodb_client
+        self.table_name = table_name
+        self.ttl = ttl
+        self.clock = clock
+
+    def _get(self, key):
+        response = self.dynamodb_client.get_item(
+            TableName=self.table_name,
+            Key={"pk": {"S": f"fix#{key}"}},
+            ProjectionExpression="#result, expires_at",
+            ExpressionAttributeNames={"#result": "result"},
+        )
+        item = response.get("Item")
+        if not item or int(item["expires_at"]["N"]) <= self.clock():
+            return None
+        return item["result"]["B"]
+
+    def _put(self, key, data):
+        if len(data) > MAX_ITEM_BYTES:
+            logger.info(
+                f"Not caching fix {key}, {len(data)} bytes exceed the item size"
+            )
+            return
+        self.dynamodb_client.put_item(
+            TableName=self.table_name,
+            Item={
+                "pk": {"S": f"fix#{key}"},
+                "result": {"B": data},
+                "expires_at": {"N": str(int(self.clock() + self.ttl))},
+            },
+        )
+
+
+class LocalFixResultCache(FixResultCache):
+    """Size and TTL bounded in-memory cache of model results, optionally persisted to a local file.
+
+    Meant for tests and local runs. With `path`, the cache is loaded from and written through to that file, so it
+    survives across processes.
+    """
+
+    def __init__(
+        self,
+        path=None,
+        max_size=256,
+        ttl=DEFAULT_TTL,
+        eviction_policy="lru",
+        clock=time.time,
+    ):
+        if eviction_policy not in EVICTION_POLICIES:
+            raise ValueError(f"Invalid eviction policy: {eviction_policy}")
+        super().__init__()
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.eviction_policy = eviction_policy
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            self._load()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, data = entry
+            if expires_at <= self.clock():
+                del self._entries[key]
+                return None
+            if self.eviction_policy == "lru":
+                self._entries.move_to_end(key)
+            return data
+
+    def _put(self, key, data):
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl, data)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            if self.path:
+                self._save()
+
+    def _load(self):
+        with open(self.path, "r") as f:
+            entries = json.load(f)
+        now = self.clock()
+        for key, expires_at, data in entries[-self.max_size :]:
+            if expires_at > now:
+                self._entries[key] = (expires_at, bytes.fromhex(data))
+
+    def _save(self):
+        entries = [
+            [key, expires_at, data.hex()]
+            for key, (expires_at, data) in self._entries.items()
+        ]
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
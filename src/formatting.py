@@ -0,0 +1,112 @@
+import os
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import get_logger
+
+logger = get_logger()
+
+# Formatter of each file extension. Files of other types are written as the model returned them.
+FORMATTERS = {".py": "black", ".pyi": "black"}
+# The source of each formatter, reading the contents from stdin and writing the formatted contents to stdout. Runs in
+# this process, or in a separate one to format several large files on several cores. Lambda has no shared memory for
+# multiprocessing, so the separate processes are plain subprocesses.
+FORMATTER_SCRIPTS = {
+    "black": """
+import sys
+from black import FileMode, format_str
+
+contents = sys.stdin.buffer.read().decode()
+sys.stdout.buffer.write(format_str(contents, mode=FileMode()).encode())
+"""
+}
+# Starting a process and importing the formatter in it costs ~0.2 s, so only larger files are formatted separately.
+SUBPROCESS_MIN_CHARS = 20000
+FORMAT_MAX_WORKERS = os.cpu_count() or 1
+# Threads importing the formatter's package for the first time at once can see it partially initialized, when the
+# import system breaks what it takes for a deadlock between the locks of its submodules.
+_import_lock = threading.Lock()
+
+
+def formatter_for(filename):
+    """Return the name of the formatter of a file, or None."""
+    return FORMATTERS.get(os.path.splitext(filename)[1].lower())
+
+
+def format_contents(formatter, contents):
+    """Format contents in this process."""
+    if formatter == "black":
+        with _import_lock:
+            from black import FileMode, format_str
+
+        return format_str(contents, mode=FileMode())
+    raise ValueError(f"Unknown formatter: {formatter}")
+
+
+def format_in_subprocess(formatter, contents):
+    """Format contents in a separate process."""
+    process = subprocess.run(
+        [sys.executable, "-c", FORMATTER_SCRIPTS[formatter]],
+        input=contents.encode(),
+        capture_output=True,
+        # The Lambda runtime adds the function's directory to sys.path, not to PYTHONPATH.
+        env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)},
+    )
+    if process.returncode:
+        error = process.stderr.decode(errors="replace").strip().splitlines()
+        raise ValueError(
+            f"Failed to format with {formatter}: {error[-1] if error else ''}"
+        )
+    return process.stdout.decode()
+
+
+def changed_files(files, repo_dir, format_code=True, max_workers=FORMAT_MAX_WORKERS):
+    """Return the file objects whose (formatted) contents differ from the working tree, in order.
+
+    Files identical to the working tree are neither formatted nor returned. When several large files need formatting,
+    they are formatted in parallel processes.
+    """
+    current = {file["filename"]: _read(repo_dir, file["filename"]) for file in files}
+    pending = [
+        file
+        for file in files
+        if format_code
+        and formatter_for(file["filename"])
+        and file["contents"] != current[file["filename"]]
+    ]
+    large = [file for file in pending if len(file["contents"]) >= SUBPROCESS_MIN_CHARS]
+    in_subprocess = (
+        {id(file) for file in large} if len(large) > 1 and max_workers > 1 else set()
+    )
+
+    def format_file(file):
+        formatter = formatter_for(file["filename"])
+        if id(file) in in_subprocess:
+            return format_in_subprocess(formatter, file["contents"])
+        return format_contents(formatter, file["contents"])
+
+    formatted = {}
+    if pending:
+        with ThreadPoolExecutor(
+            max_workers=max(1, min(max_workers, len(pending)))
+        ) as executor:
+            formatted = dict(zip(map(id, pending), executor.map(format_file, pending)))
+
+    changed = []
+    for file in files:
+        contents = formatted.get(id(file), file["contents"])
+        if contents == current[file["filename"]]:
+            logger.info(f"{file['filename']} is unchanged, skipping")
+            continue
+        changed.append({**file, "contents": contents})
+    return changed
+
+
+def _read(repo_dir, filename):
+    try:
+        with open(os.path.join(repo_dir, filename), "r", newline="") as f:
+            return f.read()
+    except (FileNotFoundError, UnicodeDecodeError):
+        return None
@@ -1,67 +1,172 @@
-import gzip
-import hashlib
-import json
 import os
-import unicodedata
-from base64 import b64decode
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 
+from fingerprint import Fingerprinter
+from instrumentation import Metrics, correlation_id_of, log_payload
+from issue_cache import SeenIssueCache
+from log_events import iter_log_events
 from utils import get_logger
 
 logger = get_logger()
 
 ISSUE_TABLE = os.environ["ISSUE_TABLE"]
-dynamodb = boto3.resource("dynamodb")
-dynamodb_table = dynamodb.Table(ISSUE_TABLE)
+PUT_ISSUE_MAX_WORKERS = int(os.environ.get("PUT_ISSUE_MAX_WORKERS", "10"))
+# boto3 clients are thread-safe (resources are not), so the worker pool shares a single client.
+dynamodb_client = boto3.client("dynamodb")
+fingerprinter = Fingerprinter(mode=os.environ.get("FINGERPRINT_MODE", "frames"))
 
+# Survives across warm invocations so repeat occurrences of a recently written issue skip DynamoDB.
+seen_issue_cache = SeenIssueCache(
+    max_size=int(os.environ.get("ISSUE_CACHE_MAX_SIZE", "1024")),
+    ttl=float(os.environ.get("ISSUE_CACHE_TTL_SECONDS", "300")),
+    eviction_policy=os.environ.get("ISSUE_CACHE_EVICTION_POLICY", "lru"),
+    max_flush_delay=float(os.environ.get("ISSUE_CACHE_MAX_FLUSH_DELAY_SECONDS", "60")),
+)
 
-def handler(event, _):
+
+def handler(event, context):
     """Lambda handlder for the detect_error function.
 
     This function will process CloudWatch logs via subscription filter events.
-    It will infer uniqueness of a given error log by hashing the error message as the partition key and storing in DynamoDB.
+    It will infer uniqueness of a given error log by fingerprinting the error message as the partition key and storing
+    in DynamoDB.
+    Log events are collapsed by hash first, so each distinct issue in a payload costs a single write, and issues
+    written recently by this container only bump an in-memory counter which is flushed later.
+    The ID of this invocation is stored on new issues as their correlation ID, which follows them to fix_code.
     """
-    logger.info(f"Processing event:", event)
-    data = decode_data(event["awslogs"]["data"])
-    data = json.loads(data)
-    log_events = data["logEvents"]
-    for log_event in log_events:
-        message = log_event["message"]
-        issue_hash = create_hash(message).hexdigest()
-        put_issue(issue_hash, message)
+    correlation_id = correlation_id_of(context)
+    metrics = Metrics("detect_error", correlation_id)
+    log_payload("Processing event", event)
+    try:
+        data = event["awslogs"]["data"]
+        metrics.put_size("payload", len(data))
+        with metrics.stage("parse"):
+            issues = group_log_events(iter_log_events(data))
+        occurrences = sum(issue["occurrences"] for issue in issues.values())
+        metrics.put("log_events", occurrences)
+        metrics.put("issues", len(issues))
+        logger.info(f"Collapsed {occurrences} log events into {len(issues)} issues")
 
+        new_issues = {
+            issue_hash: issue
+            for issue_hash, issue in issues.items()
+            if not seen_issue_cache.absorb(issue_hash, issue)
+        }
+        metrics.put("issues_written", len(new_issues))
+        with metrics.stage("put_issues"):
+            put_issues(new_issues, correlation_id=correlation_id)
+        for issue_hash, issue in new_issues.items():
+            seen_issue_cache.add(issue_hash, issue["message"])
 
-def put_issue(issue_hash, message):
-    """Store the issue_hash and message in DynamoDB.
+        with metrics.stage("flush"):
+            seen_issue_cache.flush(
+                lambda issues: put_issues(issues, correlation_id=correlation_id)
+            )
+        logger.info(f"Seen issue cache stats: {seen_issue_cache.stats()}")
+    finally:
+        metrics.flush()
 
-    The use of update_item ensures that the dependant DynamoDB Stream can identify whether the item is new or existing.
+
+def group_log_events(log_events):
+    """Collapse log events by issue fingerprint.
+
+    Returns a map of issue hash to the message, the number of occurrences and the first/last seen timestamps.
     """
-    logger.info(f"Updating issue {issue_hash} in DB")
-    update_expression = "SET message = :message"
-    expression_attribute_values = {":message": message}
-    dynamodb_table.update_item(
-        Key={
-            "pk": issue_hash,
-            "sk": issue_hash,
-        },
-        UpdateExpression=update_expression,
-        ExpressionAttributeValues=expression_attribute_values,
-    )
+    issues = {}
+    for log_event in log_events:
+        message = log_event["message"]
+        timestamp = log_event.get("timestamp", round(time.time() * 1000))
+        issue_hash = fingerprinter.fingerprint(message)
+        issue = issues.get(issue_hash)
+        if issue is None:
+            issues[issue_hash] = {
+                "message": message,
+                "occurrences": 1,
+                "first_seen": timestamp,
+                "last_seen": timestamp,
+            }
+        else:
+            issue["occurrences"] += 1
+            issue["first_seen"] = min(issue["first_seen"], timestamp)
+            issue["last_seen"] = max(issue["last_seen"], timestamp)
+    return issues
 
 
-def create_hash(error_message):
-    """Create a hash for an error message
+def put_issues(issues, max_workers=PUT_ISSUE_MAX_WORKERS, correlation_id=None):
+    """Store a map of issues in DynamoDB using a bounded pool of concurrent writers.
 
-    Assumed that the error message does not contain stateful information (i.e. date/time, variables).
+    Any failed write is re-raised so the subscription payload is retried.
     """
-    return hashlib.md5(error_message.encode(), usedforsecurity=False)
+    if not issues:
+        return
+    if len(issues) == 1:
+        issue_hash, issue = next(iter(issues.items()))
+        put_issue(issue_hash, **issue, correlation_id=correlation_id)
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                put_issue, issue_hash, **issue, correlation_id=correlation_id
+            )
+            for issue_hash, issue in issues.items()
+        ]
+        for future in futures:
+            future.result()
+
 
+def put_issue(
+    issue_hash,
+    message,
+    occurrences=1,
+    first_seen=None,
+    last_seen=None,
+    correlation_id=None,
+):
+    """Store the issue_hash and message in DynamoDB.
 
-def decode_data(encoded_zipped_data):
-    """Decode zipped CloudWatch log record and convert to string."""
-    zipped_data = b64decode(encoded_zipped_data)
-    data = gzip.decompress(zipped_data)
-    data = unicodedata.normalize("NFKD", data.decode("utf-8")).encode("ascii", "ignore")
-    data = data.decode("utf-8")
-    return data
+    The use of update_item ensures that the dependant DynamoDB Stream can identify whether the item is new or existing.
+    The occurrence counter is incremented atomically and first_seen is kept from the write which created the item.
+    last_seen only moves forward: when payloads arrive out of order, the write is repeated without it. The
+    correlation ID of the write which created the item is kept.
+    """
+    logger.info(f"Updating issue {issue_hash} in DB ({occurrences} occurrences)")
+    now = round(time.time() * 1000)
+    first_seen = now if first_seen is None else first_seen
+    last_seen = now if last_seen is None else last_seen
+    update_expression = (
+        "SET message = :message, first_seen = if_not_exists(first_seen, :first_seen)"
+    )
+    values = {
+        ":message": {"S": message},
+        ":first_seen": {"N": str(first_seen)},
+        ":occurrences": {"N": str(occurrences)},
+    }
+    if correlation_id:
+        update_expression += (
+            ", correlation_id = if_not_exists(correlation_id, :correlation_id)"
+        )
+        values[":correlation_id"] = {"S": correlation_id}
+    key = {
+        "pk": {"S": issue_hash},
+        "sk": {"S": issue_hash},
+    }
+    try:
+        dynamodb_client.update_item(
+            TableName=ISSUE_TABLE,
+            Key=key,
+            UpdateExpression=f"{update_expression}, last_seen = :last_seen ADD occurrences :occurrences",
+            ConditionExpression="attribute_not_exists(last_seen) OR last_seen < :last_seen",
+            ExpressionAttributeValues={**values, ":last_seen": {"N": str(last_seen)}},
+        )
+    except dynamodb_client.exceptions.ConditionalCheckFailedException:
+        logger.info(f"Issue {issue_hash} was seen later already, keeping its last_seen")
+        dynamodb_client.update_item(
+            TableName=ISSUE_TABLE,
+            Key=key,
+            UpdateExpression=f"{update_expression} ADD occurrences :occurrences",
+            ExpressionAttributeValues=values,
+        )
@@ -1,11 +1,23 @@
 import os
-import re
+import shutil
 import tempfile
 import time
-
-from providers.bedrock import Claude
-from source_code import GitHubProvider, clone_repo, create_branch, update_source_code
-from utils import get_config, get_logger
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+from fingerprint import Fingerprinter
+from fix_cache import DEFAULT_TTL, DynamoDBFixResultCache, fix_key
+from instrumentation import CORRELATION_ID_ATTRIBUTE, Metrics, log_payload
+from patching import PatchError, apply_file_edits
+from path_index import get_path_index
+from providers import get_provider
+from repo_cache import RepoCache
+from source_code import create_branch, get_git_provider, update_source_code
+from source_context import build_source_context
+from stages import StageGraph
+from stack_trace import innermost_first, parse_frames
+from utils import ConfigCache, get_logger
 
 logger = get_logger()
 
@@ -20,65 +32,346 @@ PARAMETER_NAMES = (
 )
 PARAMETER_STORE_PREFIX = os.environ["PARAMETER_STORE_PREFIX"]
 MODEL_AWS_REGION = "us-east-1"
+# Overrides the Bedrock runtime endpoint, i.e. to run against a local stand-in.
+BEDROCK_ENDPOINT_URL = os.environ.get("BEDROCK_ENDPOINT_URL")
+# Regions and model IDs to fall back to, in order, when the model is throttled, e.g.
+# "us-west-2:anthropic.claude-v2,eu-central-1:anthropic.claude-v2:1".
+BEDROCK_FALLBACKS = tuple(
+    tuple(fallback.strip().split(":", 1))
+    for fallback in os.environ.get("BEDROCK_FALLBACKS", "").split(",")
+    if fallback.strip()
+)
+# Arguments of each model provider.
+PROVIDER_OPTIONS = {
+    "bedrock": {
+        "model_aws_region": MODEL_AWS_REGION,
+        "endpoint_url": BEDROCK_ENDPOINT_URL,
+        "fallbacks": BEDROCK_FALLBACKS,
+    }
+}
+# Seconds the config is reused for, and how much longer a stale config is used while it is refreshed.
+CONFIG_TTL = int(os.environ.get("CONFIG_TTL", "300"))
+CONFIG_MAX_STALE = int(os.environ.get("CONFIG_MAX_STALE", "3600"))
 
 SSH_PRIVATE_KEY_FILENAME = "ssh_private_key"
+REPO_CACHE_DIR = os.environ.get("REPO_CACHE_DIR", "/tmp/repo-cache")
+# Estimated tokens of source code included in the prompt.
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "20000"))
+# "edits" asks the model for search/replace edits, falling back to "files" (full file contents) when they don't apply.
+FIX_OUTPUT_MODE = os.environ.get("FIX_OUTPUT_MODE", "edits")
+# Maximum number of fixes of a batch processed concurrently.
+FIX_MAX_WORKERS = int(os.environ.get("FIX_MAX_WORKERS", "4"))
+# Maximum number of independent setup stages of a batch run concurrently. 1 runs the stages one at a time.
+STAGE_MAX_WORKERS = int(os.environ.get("STAGE_MAX_WORKERS", "4"))
+# Model results are cached in this table, so redelivered and re-triggered issues don't invoke the model again.
+FIX_CACHE_TABLE = os.environ.get("FIX_CACHE_TABLE")
+FIX_CACHE_TTL = int(os.environ.get("FIX_CACHE_TTL", DEFAULT_TTL))
+
+# Survives across warm invocations so the target repo is only cloned on a cold start.
+repo_cache = RepoCache(REPO_CACHE_DIR)
+config_cache = ConfigCache(
+    PARAMETER_STORE_PREFIX, PARAMETER_NAMES, ttl=CONFIG_TTL, max_stale=CONFIG_MAX_STALE
+)
+# Issues are keyed as detect_error keys them. The key tags pull requests, so an issue with an open fix isn't fixed
+# again.
+issue_fingerprinter = Fingerprinter(mode=os.environ.get("FINGERPRINT_MODE", "frames"))
+fix_cache = (
+    DynamoDBFixResultCache(boto3.client("dynamodb"), FIX_CACHE_TABLE, FIX_CACHE_TTL)
+    if FIX_CACHE_TABLE
+    else None
+)
 
 
 def handler(event, context):
     """Lambda handler for the fix_code function.
 
-    Takes the stack trace from the event and prompts GenAI to provide a fix.
+    Takes the stack traces from a batch of messages and prompts GenAI to provide fixes.
     This Lambda will:
-    - Parse a stack trace from the event
-    - Retrieve the source code from git repo
-    - Create a prompt including the stack trace and minified source code to send to AI model
-    - Create a pull request to fix the code
+    - Retrieve the config and sync the cached git repo once for the batch, reusing both across warm invocations
+    - Fix the stack trace of each message concurrently, on its own branch, unless its issue has an open pull request:
+        - Parse the stack trace and check out only the relevant files
+        - Create a prompt including the stack trace and the code around its frames, within a token budget
+        - Reuse the cached model result when the same error was already fixed against identical source files
+        - Create a pull request to fix the code
+    Messages which could not be fixed are reported as batch item failures, so the rest of the batch is not retried.
+    The setup of the batch and the fix of each message emit their own metrics, those of a fix carrying the correlation
+    ID of its issue.
     """
-    logger.info(f"Processing event: {event}")
-    error_context = event["Records"][0]["body"]
-
-    logger.info(f"Retrieving config")
-    config = get_config(PARAMETER_STORE_PREFIX, PARAMETER_NAMES)
-
-    # Select a model provider to perform the code generation
-    if config["model_provider"] == "bedrock":
-        provider = Claude(model_aws_region=MODEL_AWS_REGION)
-    else:
-        raise Exception(f"Invalid model provider: {config['model_provider']}")
-    logger.info(f"Using model provider: {config['model_provider']}")
+    log_payload("Processing event", event)
+    records = event["Records"]
+    metrics = Metrics("fix_code")
+    metrics.put("messages", len(records))
 
-    # Prepare SSH credentials for cloning the target repo
     tmpdir = tempfile.mkdtemp()
-    ssh_private_key = os.path.join(tmpdir, "ssh_private_key")
-    write_ssh_key(config["repo_ssh_private_key"], ssh_private_key)
-
-    # Clone the target repo
-    git_provider = GitHubProvider(config["repo_api_key"], config["repo_api_url"])
-    target_repo_dir = os.path.join(tmpdir, context.aws_request_id, config["repo_name"])
-    repo = clone_repo(config["repo_url"], target_repo_dir, ssh_private_key)
+    try:
+        # Independent setup stages overlap: the model client is built while the config is retrieved and the repo
+        # synced.
+        ssh_private_key = os.path.join(tmpdir, "ssh_private_key")
+        setup = StageGraph("setup", STAGE_MAX_WORKERS, metrics_prefix="setup_")
+        setup.add("config", config_cache.get)
+        # Bedrock is the usual model provider, so its client is created while the config is retrieved.
+        setup.add(
+            "bedrock", lambda: get_provider("bedrock", **PROVIDER_OPTIONS["bedrock"])
+        )
+        setup.add(
+            "provider",
+            lambda config, bedrock: get_provider(
+                config["model_provider"],
+                **PROVIDER_OPTIONS.get(config["model_provider"], {}),
+            ),
+            "config",
+            "bedrock",
+        )
+        # Prepare SSH credentials for cloning the target repo
+        setup.add(
+            "ssh_private_key",
+            lambda config: write_ssh_key(
+                config["repo_ssh_private_key"], ssh_private_key
+            ),
+            "config",
+        )
+        setup.add(
+            "git_provider",
+            lambda config: get_git_provider(
+                config["repo_api_key"], config["repo_api_url"]
+            ),
+            "config",
+        )
+        # Index the open fix pull requests once for the batch
+        setup.add(
+            "pull_requests",
+            lambda git_provider: git_provider.open_pull_requests(),
+            "git_provider",
+        )
+        # Clone or refresh the cached copy of the target repo. Every message targets the configured repo, so the
+        # whole batch shares a single sync.
+        setup.add(
+            "cached_repo",
+            lambda config, ssh_private_key: repo_cache.sync(
+                config["repo_url"], ssh_private_key
+            ),
+            "config",
+            "ssh_private_key",
+        )
+        # GitPython repo objects are not thread safe, so the cached repo is only read here, before fixes run
+        # concurrently.
+        setup.add(
+            "path_index", lambda cached_repo: get_path_index(cached_repo), "cached_repo"
+        )
+        try:
+            with metrics.activate():
+                stages = setup.run()
+        except Exception:
+            # The config may hold a rotated credential, or an outdated repo or provider.
+            config_cache.invalidate()
+            metrics.put("failures", len(records))
+            metrics.flush()
+            raise
+
+        # Model calls dominate the time of a fix, so fixes run concurrently.
+        with ThreadPoolExecutor(
+            max_workers=min(FIX_MAX_WORKERS, len(records))
+        ) as executor:
+            futures = {
+                record["messageId"]: executor.submit(
+                    fix_message,
+                    record,
+                    stages["config"],
+                    stages["provider"],
+                    stages["git_provider"],
+                    stages["path_index"],
+                    ssh_private_key,
+                    tmpdir,
+                )
+                for record in records
+            }
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    failures = []
+    for message_id, future in futures.items():
+        try:
+            future.result()
+        except Exception:
+            logger.exception(f"Failed to fix message {message_id}")
+            failures.append(message_id)
+    if failures and len(failures) == len(records):
+        config_cache.invalidate()
+    metrics.put("failures", len(failures))
+    metrics.flush()
+    return {
+        "batchItemFailures": [{"itemIdentifier": message_id} for message_id in failures]
+    }
+
+
+def fix_message(
+    record, config, provider, git_provider, path_index, ssh_private_key, tmpdir
+):
+    """Fix the stack trace of an SQS message, emitting the metrics of the fix with the correlation ID of the issue."""
+    correlation_id = (
+        record.get("messageAttributes", {})
+        .get(CORRELATION_ID_ATTRIBUTE, {})
+        .get("stringValue")
+    )
+    metrics = Metrics("fix_code", correlation_id)
+    metrics.set_property("message_id", record["messageId"])
+    sent = record.get("attributes", {}).get("SentTimestamp")
+    if sent:
+        metrics.put_duration("queue_wait", max(0, time.time() - int(sent) / 1000))
+    outcome = "failed"
+    try:
+        with metrics.activate():
+            outcome = fix_issue(
+                record,
+                config,
+                provider,
+                git_provider,
+                path_index,
+                ssh_private_key,
+                tmpdir,
+                metrics,
+            )
+    finally:
+        metrics.set_property("outcome", outcome)
+        metrics.put(outcome, 1)
+        metrics.flush()
+
+
+def fix_issue(
+    record,
+    config,
+    provider,
+    git_provider,
+    path_index,
+    ssh_private_key,
+    tmpdir,
+    metrics,
+):
+    """Fix the stack trace of an SQS message in its own worktree, and open a pull request from its own branch.
+    Return the outcome: "skipped", "unchanged" or "fixed". Every stage of the fix is timed in `metrics`.
+    """
+    error_context = record["body"]
+    message_id = record["messageId"]
+    issue_key = issue_fingerprinter.fingerprint(error_context)
+    pull_request = git_provider.find_pull_request(issue_key, refresh=False)
+    if pull_request:
+        logger.info(
+            f"Pull request {pull_request['html_url']} already fixes issue {issue_key}, skipping"
+        )
+        return "skipped"
+    target_repo_dir = os.path.join(tmpdir, message_id, config["repo_name"])
+
+    # The stages of a fix depend on each other, so they run in sequence and are timed individually.
+    try:
+        # Extract the files relevant to the error from stack trace
+        with metrics.stage("file_frames"):
+            file_frames = get_frames_by_file(error_context, path_index)
+        # Check out only the relevant files into a worktree isolated from other runs
+        with metrics.stage("repo"):
+            repo = repo_cache.add_worktree(
+                config["repo_url"], target_repo_dir, ssh_private_key, list(file_frames)
+            )
+        # Select the code around the frames of the stack trace, within the token budget
+        with metrics.stage("source_context"):
+            source_context = build_source_context(
+                target_repo_dir, file_frames, CONTEXT_TOKEN_BUDGET
+            )
+        # Trigger the code generation
+        with metrics.stage("result"):
+            result = generate_fix(
+                provider, error_context, source_context, repo, ssh_private_key
+            )
+        # Modify the local cloned repo with the generated code
+        with metrics.stage("update_source_code"):
+            files = update_source_code(result["source_code"], target_repo_dir)
+        # Create a branch and commit/push the code to the source repo. The message ID keeps the branches of a batch
+        # apart.
+        with metrics.stage("branch_name"):
+            branch_name = push_branch(
+                f"fix-code-{round(time.time())}-{message_id[:8]}",
+                repo,
+                result,
+                [file["filename"] for file in files],
+                ssh_private_key,
+            )
+        # Create a pull request, unless a concurrent fix of the same issue just did
+        with metrics.stage("pull_request"):
+            open_pull_request(git_provider, branch_name, result, issue_key)
+        return "fixed" if branch_name else "unchanged"
+    finally:
+        if os.path.exists(target_repo_dir):
+            repo_cache.remove_worktree(config["repo_url"], target_repo_dir)
+
+
+def push_branch(branch_name, repo, result, filenames, ssh_private_key):
+    """Commit the files changed by the fix to a new branch and push it. Return the branch name, or None if the fix
+    changed nothing."""
+    if not create_branch(
+        branch_name, repo, result["description"], filenames, ssh_private_key
+    ):
+        logger.info("No changes were made, exiting.")
+        return None
+    return branch_name
 
-    # Extract filenames relevant to the error from stack trace
-    filenames = get_filenames_from_stack_trace(error_context, repo)
 
-    # Create a map of relevant filenames with the actual filenames in the target repo
-    source_code_map = create_source_code_map(target_repo_dir, filenames)
+def open_pull_request(git_provider, branch_name, result, issue_key):
+    """Open a pull request from the branch of a fix, and return it. Return None if the fix changed nothing.
 
-    # Trigger the code generation
-    result = provider.fix_code(error_context, source_code_map)
+    The index of open pull requests was refreshed in setup, so it isn't refreshed again.
+    """
+    if not branch_name:
+        return None
+    return git_provider.create_pull_request(
+        branch_name, result["title"], result["description"], issue_key, refresh=False
+    )
 
-    # Modify the local cloned repo with the generated code
-    update_source_code(result["source_code"], target_repo_dir)
 
-    # Create a branch and commit/push the code to the source repo
-    branch_name = f"fix-code-{round(time.time())}"
-    branch_created = create_branch(branch_name, repo, result["description"])
-    if not branch_created:
-        logger.info("No changes were made, exiting.")
-        return
+def generate_fix(provider, error_context, source_context, repo, ssh_private_key):
+    """Prompt the model for a fix and return it with the full contents of the modified files.
 
-    # Create a pull request
-    git_provider.create_pull_request(
-        branch_name, result["title"], result["description"]
+    The files the fix modifies are checked out in the worktree, so that edits can be applied to them.
+    """
+    source_code_map = {
+        filename: excerpt.text for filename, excerpt in source_context.items()
+    }
+    if FIX_OUTPUT_MODE == "edits":
+        result = cached_fix_code(provider, error_context, source_code_map, "edits")
+        repo_cache.sparse_checkout_add(
+            repo, [file["filename"] for file in result["source_code"]], ssh_private_key
+        )
+        try:
+            result["source_code"] = apply_file_edits(
+                repo.working_tree_dir, result["source_code"]
+            )
+            return result
+        except PatchError as e:
+            logger.warning(f"Failed to apply edits, requesting full files: {e!r}")
+
+    result = cached_fix_code(provider, error_context, source_code_map, "files")
+    # Restore the lines left out of excerpts in the files returned by the model
+    for file in result["source_code"]:
+        if file["filename"] in source_context:
+            excerpt = source_context[file["filename"]]
+            file["contents"] = excerpt.expand(file["contents"])
+    repo_cache.sparse_checkout_add(
+        repo, [file["filename"] for file in result["source_code"]], ssh_private_key
+    )
+    return result
+
+
+def cached_fix_code(provider, error_context, source_code_map, output_mode):
+    """Prompt the model for a fix, unless the result for the same trace and source files is cached."""
+    if fix_cache is None:
+        return provider.fix_code(error_context, source_code_map, output_mode)
+    key = fix_key(
+        error_context,
+        provider.model_id,
+        provider.prompt_version(output_mode),
+        source_code_map,
+    )
+    return fix_cache.get_or_create(
+        f"{output_mode}#{key}",
+        lambda: provider.fix_code(error_context, source_code_map, output_mode),
     )
 
 
@@ -88,70 +381,22 @@ def write_ssh_key(value, file_path):
     with open(file_path, "w") as f:
         f.write(value)
     os.chmod(file_path, int("600", base=8))
+    return file_path
 
 
-def get_filenames_from_stack_trace(stack_trace, repo):
-    """Perform regex match to match filenames containing repo_name in stack_trace.
-    Return relative paths to files from repo root.
+def get_frames_by_file(stack_trace, path_index):
+    """Parse the frames in stack_trace and match them to files in the repo through its path index.
+    Return a dict of relative paths to files from repo root to their frames, starting with the innermost frame.
     """
-    file_paths_in_repo = [entry.path for entry in repo.commit().tree.traverse()]
-
-    # This regex should work for both Python and Javascript files
-    file_path_pattern = r'(?:File "([^"]+)"|at \S+ \(file://([^:]+):\d+:\d+\))'
-    file_paths = re.findall(file_path_pattern, stack_trace)
-
-    # Extract the non-empty file paths from the matches
-    file_paths = [path[0] if path[0] else path[1] for path in file_paths]
-
-    matching_repo_file_paths = find_partial_matches(file_paths, file_paths_in_repo)
-    return matching_repo_file_paths
-
-
-def find_partial_matches(primary_paths, secondary_paths):
-    """Find and return partial matches between file paths in two lists based on filenames.
-
-    This function compares file paths in the `primary_paths` list to those in the `secondary_paths` list
-    and returns a list of partial matches if matching filenames are found, regardless of the root directory.
-
-    Example:
-        primary_paths = [
-            '/var/task/handlers/create_order.py'
-        ]
-        secondary_paths = [
-            '.gitignore',
-            'README.md',
-            'src',
-            'template.yaml',
-            'src/handlers',
-            'src/requirements.txt',
-            'src/handlers/create_order.py',
-            'src/handlers/sample.py'
-        ]
-        results = find_partial_matches(primary_paths, secondary_paths)
-
-    Returns:
-        ['src/handlers/sample.py'] if a partial match is found, or an empty list if no matches are found.
-    """
-    results = []
-
-    for primary_path in primary_paths:
-        primary_filename = os.path.basename(primary_path)
-        for secondary_path in secondary_paths:
-            secondary_filename = os.path.basename(secondary_path)
-            if primary_filename == secondary_filename:
-                results.append(secondary_path)
-
-    return results
-
-
-def create_source_code_map(repo_dir, filenames):
-    """Create a map of relevant filenames with the actual filenames in the target repo."""
-    logger.info(f"Creating source code map for {filenames}")
-    source_code_map = {}
-    for filename in filenames:
-        with open(os.path.join(repo_dir, filename), "r") as f:
-            source_code_map[filename] = f.read()
-    return source_code_map
+    # Resolve each application frame to the repo files sharing the longest path suffix
+    file_frames = {}
+    for frame in innermost_first(parse_frames(stack_trace)):
+        if frame.is_library:
+            continue
+        for repo_file_path in path_index.resolve(frame.path):
+            file_frames.setdefault(repo_file_path, []).append(frame)
+    logger.info(f"Found frames in {list(file_frames)}")
+    return file_frames
 
 
 if __name__ == "__main__":
@@ -163,6 +408,6 @@ if __name__ == "__main__":
          [ERROR] KeyError: \'order_items\'\nTraceback (most recent call last):\n  File "/var/task/handlers/create_order.py", line 14, in handler\n    order_items = body["order_items"]
          """
     handler(
-        {"Records": [{"body": error}]},
+        {"Records": [{"messageId": "1234", "body": error}]},
         MockContext(),
     )
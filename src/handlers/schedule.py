@@ -0,0 +1,191 @@
+import os
+import time
+
+import boto3
+
+from instrumentation import Metrics
+from messaging import delete_messages, send_messages
+from scheduler import TokenBucket, priority
+from utils import get_logger
+
+PENDING_QUEUE_URL = os.environ["PENDING_QUEUE_URL"]
+WORKER_QUEUE_URL = os.environ["WORKER_QUEUE_URL"]
+ISSUE_TABLE = os.environ["ISSUE_TABLE"]
+SCHEDULER_TABLE = os.environ["SCHEDULER_TABLE"]
+MODEL_CALLS_PER_HOUR = int(os.environ.get("MODEL_CALLS_PER_HOUR", "60"))
+PULL_REQUESTS_PER_HOUR = int(os.environ.get("PULL_REQUESTS_PER_HOUR", "20"))
+MAX_PENDING_MESSAGES = int(os.environ.get("MAX_PENDING_MESSAGES", "100"))
+# Messages which are not dispatched become visible again before the next scheduled run.
+PENDING_VISIBILITY_TIMEOUT = 30
+# BatchGetItem accepts at most 100 keys per call.
+BATCH_GET_MAX_KEYS = 100
+
+logger = get_logger()
+sqs_client = boto3.client("sqs")
+dynamodb_client = boto3.client("dynamodb")
+model_call_bucket = TokenBucket(
+    dynamodb_client,
+    SCHEDULER_TABLE,
+    "model_calls",
+    capacity=MODEL_CALLS_PER_HOUR,
+    refill_per_second=MODEL_CALLS_PER_HOUR / 3600,
+)
+pull_request_bucket = TokenBucket(
+    dynamodb_client,
+    SCHEDULER_TABLE,
+    "pull_requests",
+    capacity=PULL_REQUESTS_PER_HOUR,
+    refill_per_second=PULL_REQUESTS_PER_HOUR / 3600,
+)
+
+
+def handler(event, _):
+    """Lambda handler for the schedule function.
+
+    Runs on a schedule and moves pending issues from the pending queue to the worker queue.
+    Pending issues are ranked by occurrence rate, so the errors firing most often are fixed first, and dispatched
+    within the hourly model call and pull request budgets. Issues which do not fit in the budget stay pending.
+    """
+    metrics = Metrics("schedule")
+    try:
+        dispatch_pending_messages(metrics)
+    finally:
+        metrics.flush()
+
+
+def dispatch_pending_messages(metrics):
+    """Dispatch the highest priority pending issues within the budgets."""
+    with metrics.stage("receive"):
+        pending_messages = receive_pending_messages()
+    metrics.put("pending_messages", len(pending_messages))
+    if not pending_messages:
+        logger.info("No pending issues")
+        return
+    # The age of the oldest pending message shows how far the dispatch lags behind the budgets.
+    sent_timestamps = [
+        int(message["Attributes"]["SentTimestamp"])
+        for message in pending_messages
+        if "SentTimestamp" in message.get("Attributes", {})
+    ]
+    if sent_timestamps:
+        metrics.put_duration(
+            "oldest_pending", max(0, time.time() - min(sent_timestamps) / 1000)
+        )
+
+    # The pending queue may deliver the same issue more than once; duplicates are dropped.
+    messages = {}
+    duplicates = []
+    for message in pending_messages:
+        issue_hash = get_issue_hash(message)
+        if issue_hash in messages:
+            duplicates.append(message["ReceiptHandle"])
+        else:
+            messages[issue_hash] = message
+
+    with metrics.stage("get_issues"):
+        issues = get_issues(messages.keys())
+    ranked_hashes = sorted(
+        messages, key=lambda issue_hash: priority(issues.get(issue_hash, {}))
+    )
+    with metrics.stage("acquire_tokens"):
+        granted = acquire_tokens(len(ranked_hashes))
+    metrics.put("dispatched", granted)
+    dispatched_hashes = ranked_hashes[:granted]
+    logger.info(
+        f"Dispatching {granted} of {len(ranked_hashes)} pending issues: {dispatched_hashes}"
+    )
+
+    entries = [
+        {
+            "Id": str(i),
+            "MessageBody": messages[issue_hash]["Body"],
+            "MessageAttributes": string_attributes(messages[issue_hash]),
+        }
+        for i, issue_hash in enumerate(dispatched_hashes)
+    ]
+    with metrics.stage("send"):
+        failed_ids = set(send_messages(sqs_client, WORKER_QUEUE_URL, entries))
+    metrics.put("failures", len(failed_ids))
+    if failed_ids:
+        logger.info(f"Failed to dispatch {len(failed_ids)} issues, releasing tokens")
+        model_call_bucket.release(len(failed_ids))
+        pull_request_bucket.release(len(failed_ids))
+
+    receipt_handles = duplicates + [
+        messages[issue_hash]["ReceiptHandle"]
+        for i, issue_hash in enumerate(dispatched_hashes)
+        if str(i) not in failed_ids
+    ]
+    with metrics.stage("delete"):
+        delete_messages(sqs_client, PENDING_QUEUE_URL, receipt_handles)
+
+
+def receive_pending_messages(max_messages=MAX_PENDING_MESSAGES):
+    """Receive up to `max_messages` messages from the pending queue."""
+    messages = []
+    while len(messages) < max_messages:
+        response = sqs_client.receive_message(
+            QueueUrl=PENDING_QUEUE_URL,
+            MaxNumberOfMessages=min(10, max_messages - len(messages)),
+            VisibilityTimeout=PENDING_VISIBILITY_TIMEOUT,
+            MessageAttributeNames=["All"],
+            AttributeNames=["SentTimestamp"],
+        )
+        received = response.get("Messages", [])
+        if not received:
+            break
+        messages.extend(received)
+    return messages
+
+
+def get_issue_hash(message):
+    """Return the issue hash of a pending message, falling back to the message ID for messages without one."""
+    attribute = message.get("MessageAttributes", {}).get("issue_hash")
+    return attribute["StringValue"] if attribute else message["MessageId"]
+
+
+def string_attributes(message):
+    """Copy the string message attributes of a received message into the form expected when sending."""
+    return {
+        name: {
+            "DataType": attribute["DataType"],
+            "StringValue": attribute["StringValue"],
+        }
+        for name, attribute in message.get("MessageAttributes", {}).items()
+        if "StringValue" in attribute
+    }
+
+
+def get_issues(issue_hashes):
+    """Fetch the occurrence counters of issues from the issue table, keyed by issue hash."""
+    keys = [
+        {"pk": {"S": issue_hash}, "sk": {"S": issue_hash}}
+        for issue_hash in issue_hashes
+    ]
+    issues = {}
+    for i in range(0, len(keys), BATCH_GET_MAX_KEYS):
+        request = {
+            ISSUE_TABLE: {
+                "Keys": keys[i : i + BATCH_GET_MAX_KEYS],
+                "ProjectionExpression": "pk, occurrences, first_seen, last_seen",
+            }
+        }
+        while request:
+            response = dynamodb_client.batch_get_item(RequestItems=request)
+            for item in response["Responses"].get(ISSUE_TABLE, []):
+                issues[item["pk"]["S"]] = item
+            request = response.get("UnprocessedKeys")
+    return issues
+
+
+def acquire_tokens(count):
+    """Take a model call and a pull request token for up to `count` issues. Returns the number granted."""
+    if count == 0:
+        return 0
+    granted = model_call_bucket.acquire(count)
+    if granted == 0:
+        return 0
+    pull_requests_granted = pull_request_bucket.acquire(granted)
+    if pull_requests_granted < granted:
+        model_call_bucket.release(granted - pull_requests_granted)
+    return pull_requests_granted
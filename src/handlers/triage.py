@@ -1,26 +1,135 @@
 import os
+import time
 
 import boto3
 
+from clustering import DEFAULT_SIMILARITY_THRESHOLD, ClusterIndex
+from instrumentation import CORRELATION_ID_ATTRIBUTE, Metrics, log_payload
+from messaging import send_messages
 from utils import get_logger
 
-WORKER_QUEUE_URL = os.environ.get("WORKER_QUEUE_URL")
+PENDING_QUEUE_URL = os.environ.get("PENDING_QUEUE_URL")
+CLUSTER_INDEX_TABLE = os.environ.get("CLUSTER_INDEX_TABLE")
+CLUSTER_SIMILARITY_THRESHOLD = float(
+    os.environ.get("CLUSTER_SIMILARITY_THRESHOLD", DEFAULT_SIMILARITY_THRESHOLD)
+)
+SEND_MESSAGE_MAX_WORKERS = int(os.environ.get("SEND_MESSAGE_MAX_WORKERS", "10"))
 
 logger = get_logger()
 sqs_client = boto3.client("sqs")
+cluster_index = (
+    ClusterIndex(
+        boto3.resource("dynamodb"),
+        CLUSTER_INDEX_TABLE,
+        similarity_threshold=CLUSTER_SIMILARITY_THRESHOLD,
+    )
+    if CLUSTER_INDEX_TABLE
+    else None
+)
 
 
 def handler(event, _):
     """Lambda handler for the triage function.
 
-    Process DynamoDB Stream events and enqueue any new items to SQS.
+    Process DynamoDB Stream events and enqueue any new items to the pending queue, from which the schedule function
+    dispatches them to the worker queue.
+    New items are clustered with similar known issues, and only the representative of a new cluster is enqueued, once:
+    its cluster is marked as enqueued, so redelivered records are skipped.
+    Records which could not be processed are reported as batch item failures, so the rest of the batch is not
+    retried.
+    The correlation ID stored on the item by detect_error is passed on as a message attribute.
     """
-    logger.info(f"Received event: {event}")
-    for record in event["Records"]:
+    log_payload("Received event", event)
+    metrics = Metrics("triage")
+    try:
+        return process_records(event["Records"], metrics)
+    finally:
+        metrics.flush()
+
+
+def process_records(records, metrics):
+    """Enqueue the new items of stream records, and return the batch item failures."""
+    entries = []
+    failures = []
+    # Clusters marked as enqueued, by the sequence number of their representative's record.
+    marked = {}
+    # The lag of a batch is the one of its oldest record.
+    created_times = [
+        record["dynamodb"]["ApproximateCreationDateTime"]
+        for record in records
+        if record["eventName"] == "INSERT"
+        and "ApproximateCreationDateTime" in record["dynamodb"]
+    ]
+    if created_times:
+        metrics.put_duration("stream_lag", max(0, time.time() - min(created_times)))
+
+    for record in records:
         if record["eventName"] == "INSERT":
             new_image = record["dynamodb"]["NewImage"]
+            sequence_number = record["dynamodb"]["SequenceNumber"]
             message = new_image["message"]["S"]
+            issue_hash = new_image["pk"]["S"]
+            metrics.put("new_items", 1)
+            if cluster_index:
+                try:
+                    with metrics.stage("cluster"):
+                        cluster_id, is_new = cluster_index.assign(issue_hash, message)
+                        enqueue = is_new and cluster_index.mark_enqueued(cluster_id)
+                except Exception:
+                    logger.exception(f"Failed to cluster item (pk: {issue_hash})")
+                    failures.append(sequence_number)
+                    continue
+                if not is_new:
+                    logger.info(
+                        f"Attached item (pk: {issue_hash}) to existing cluster {cluster_id}, skipping"
+                    )
+                    continue
+                if not enqueue:
+                    logger.info(
+                        f"Item (pk: {issue_hash}) of cluster {cluster_id} was already enqueued, skipping"
+                    )
+                    continue
+                marked[sequence_number] = cluster_id
             logger.info(
                 f"Detected new item (pk: {new_image['pk']['S']}, sk: {new_image['sk']['S']}), enqueuing message"
             )
-            sqs_client.send_message(QueueUrl=WORKER_QUEUE_URL, MessageBody=message)
+            attributes = {
+                "issue_hash": {"DataType": "String", "StringValue": issue_hash}
+            }
+            if CORRELATION_ID_ATTRIBUTE in new_image:
+                attributes[CORRELATION_ID_ATTRIBUTE] = {
+                    "DataType": "String",
+                    "StringValue": new_image[CORRELATION_ID_ATTRIBUTE]["S"],
+                }
+            entries.append(
+                {
+                    "Id": sequence_number,
+                    "MessageBody": message,
+                    "MessageAttributes": attributes,
+                }
+            )
+
+    metrics.put("messages", len(entries))
+    with metrics.stage("send"):
+        failed_ids = send_messages(
+            sqs_client,
+            PENDING_QUEUE_URL,
+            entries,
+            max_workers=SEND_MESSAGE_MAX_WORKERS,
+        )
+    # Records which could not be enqueued are retried, and must not be skipped as already enqueued then.
+    for sequence_number in failed_ids:
+        if sequence_number in marked:
+            try:
+                cluster_index.unmark_enqueued(marked[sequence_number])
+            except Exception:
+                logger.exception(
+                    f"Failed to unmark cluster {marked[sequence_number]} as enqueued"
+                )
+    failures.extend(failed_ids)
+    metrics.put("failures", len(failures))
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": sequence_number} for sequence_number in failures
+        ]
+    }
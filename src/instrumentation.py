@@ -0,0 +1,144 @@
+import contextvars
+import json
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from utils import get_logger
+
+logger = get_logger()
+
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "SelfHealingCode")
+# Fraction of the events, prompts and responses logged, and the characters logged of each. Full payloads multiply
+# the CloudWatch Logs ingestion of every invocation.
+PAYLOAD_LOG_SAMPLE_RATE = float(os.environ.get("PAYLOAD_LOG_SAMPLE_RATE", "0.01"))
+PAYLOAD_LOG_MAX_CHARS = int(os.environ.get("PAYLOAD_LOG_MAX_CHARS", "2000"))
+# Name of the message attribute and issue item attribute carrying the correlation ID.
+CORRELATION_ID_ATTRIBUTE = "correlation_id"
+
+_current_metrics = contextvars.ContextVar("metrics", default=None)
+
+
+class Metrics:
+    """Metrics of a handler invocation, or of the part of it processing one item, emitted as a single line in the
+    CloudWatch embedded metric format (EMF).
+
+    Metrics are aggregated per `Function` dimension. Properties, such as the correlation ID, are logged with the
+    metrics without becoming dimensions, so they can be searched with CloudWatch Logs Insights.
+    """
+
+    def __init__(self, function_name, correlation_id=None, clock=time.time):
+        self.function_name = function_name
+        self.clock = clock
+        self.values = {}
+        self.units = {}
+        self.properties = {}
+        if correlation_id:
+            self.properties[CORRELATION_ID_ATTRIBUTE] = correlation_id
+        self._lock = threading.Lock()
+
+    @property
+    def correlation_id(self):
+        return self.properties.get(CORRELATION_ID_ATTRIBUTE)
+
+    def put(self, name, value, unit="Count"):
+        """Set a metric, adding to its value if it was already set."""
+        with self._lock:
+            self.values[name] = self.values.get(name, 0) + value
+            self.units[name] = unit
+
+    def put_max(self, name, value, unit="Count"):
+        """Set a metric, keeping the largest of its values if it was already set."""
+        with self._lock:
+            self.values[name] = max(self.values.get(name, value), value)
+            self.units[name] = unit
+
+    def put_duration(self, name, seconds, aggregate=None):
+        """Set a duration metric, adding to it, or aggregating it with `aggregate`, such as `put_max`."""
+        aggregate = aggregate or self.put
+        aggregate(f"{name}_duration", round(seconds * 1000, 3), "Milliseconds")
+
+    def put_size(self, name, size):
+        self.put(f"{name}_bytes", size, "Bytes")
+
+    def set_property(self, name, value):
+        with self._lock:
+            self.properties[name] = value
+
+    @contextmanager
+    def stage(self, name):
+        """Time the enclosed block as stage `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.put_duration(name, time.perf_counter() - start)
+
+    @contextmanager
+    def activate(self):
+        """Make these the metrics `current_metrics` returns within the enclosed block."""
+        token = _current_metrics.set(self)
+        try:
+            yield self
+        finally:
+            _current_metrics.reset(token)
+
+    def to_emf(self):
+        """Return the EMF document of the metrics."""
+        with self._lock:
+            return {
+                "_aws": {
+                    "Timestamp": round(self.clock() * 1000),
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": METRICS_NAMESPACE,
+                            "Dimensions": [["Function"]],
+                            "Metrics": [
+                                {"Name": name, "Unit": self.units[name]}
+                                for name in self.values
+                            ],
+                        }
+                    ],
+                },
+                "Function": self.function_name,
+                **self.properties,
+                **self.values,
+            }
+
+    def flush(self):
+        """Write the metrics to stdout, where Lambda passes them to CloudWatch, and clear them."""
+        if not self.values:
+            return
+        # EMF documents must be log lines of their own, without the prefix of the logging handler. print writes the
+        # line ending separately, so the lines of concurrent flushes could run together.
+        sys.stdout.write(json.dumps(self.to_emf(), default=str) + "\n")
+        sys.stdout.flush()
+        with self._lock:
+            self.values.clear()
+            self.units.clear()
+
+
+def current_metrics():
+    """Return the metrics activated in this context, or None."""
+    return _current_metrics.get()
+
+
+def correlation_id_of(context):
+    """Return a new correlation ID: the request ID of the Lambda invocation, which prefixes its log lines."""
+    request_id = getattr(context, "aws_request_id", None)
+    return request_id or os.urandom(16).hex()
+
+
+def log_payload(label, payload, sample_rate=None, max_chars=None):
+    """Log a sampled fraction of payloads, such as events, prompts and responses, truncated to `max_chars`."""
+    sample_rate = PAYLOAD_LOG_SAMPLE_RATE if sample_rate is None else sample_rate
+    max_chars = PAYLOAD_LOG_MAX_CHARS if max_chars is None else max_chars
+    if random.random() >= sample_rate:
+        return
+    text = payload if isinstance(payload, str) else json.dumps(payload, default=str)
+    if max_chars and len(text) > max_chars:
+        text = f"{text[:max_chars]}... [{len(text) - max_chars} more characters]"
+    logger.info(f"{label}: {text}")
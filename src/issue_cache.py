@@ -0,0 +1,186 @@
+import threading
+import time
+from collections import OrderedDict
+
+EVICTION_POLICIES = ("lru", "fifo")
+
+
+class SeenIssueCache:
+    """Size and TTL bounded cache of issue hashes recently written to DynamoDB.
+
+    Lives at module level so it survives across warm Lambda invocations. Repeat occurrences of a cached issue are
+    absorbed into an in-memory counter instead of triggering another write. Pending occurrences are flushed in one
+    update when the entry is evicted, expires, or has been pending for longer than `max_flush_delay` seconds.
+
+    Pending counts only live in memory; a container that is shut down before a flush drops them, which bounds the
+    under-count of an issue's occurrences by `max_flush_delay`.
+    """
+
+    def __init__(
+        self,
+        max_size=1024,
+        ttl=300,
+        eviction_policy="lru",
+        max_flush_delay=60,
+        clock=time.monotonic,
+    ):
+        if eviction_policy not in EVICTION_POLICIES:
+            raise ValueError(f"Invalid eviction policy: {eviction_policy}")
+        self.max_size = max_size
+        self.ttl = ttl
+        self.eviction_policy = eviction_policy
+        self.max_flush_delay = max_flush_delay
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._evicted = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "flushes": 0,
+            "flushed_issues": 0,
+            "flush_seconds_total": 0.0,
+            "flush_seconds_max": 0.0,
+        }
+
+    def absorb(self, issue_hash, issue):
+        """Absorb an issue's occurrences if its hash was recently written.
+
+        Returns True on a hit, in which case no write is needed. On a miss the caller must write the issue and then
+        call `add`. Occurrences pending on an expired entry are merged into `issue` so they go out with that write.
+        """
+        if self.max_size <= 0:
+            return False
+        with self._lock:
+            entry = self._entries.get(issue_hash)
+            if entry is not None and self._clock() - entry["written_at"] > self.ttl:
+                del self._entries[issue_hash]
+                self._stats["expirations"] += 1
+                if entry["issue"]["occurrences"]:
+                    _merge(issue, entry["issue"])
+                entry = None
+            if entry is None:
+                self._stats["misses"] += 1
+                return False
+
+            self._stats["hits"] += 1
+            if entry["issue"]["occurrences"] == 0:
+                entry["pending_since"] = self._clock()
+            _merge(entry["issue"], issue)
+            if self.eviction_policy == "lru":
+                self._entries.move_to_end(issue_hash)
+            return True
+
+    def add(self, issue_hash, message):
+        """Record that an issue has just been written, evicting the oldest entries when the cache is full."""
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[issue_hash] = {
+                "written_at": self._clock(),
+                "pending_since": None,
+                "issue": _empty_issue(message),
+            }
+            self._entries.move_to_end(issue_hash)
+            while len(self._entries) > self.max_size:
+                evicted_hash, entry = self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+                if entry["issue"]["occurrences"]:
+                    self._evicted[evicted_hash] = entry["issue"]
+
+    def flush(self, write, force=False):
+        """Write pending occurrences using `write`, which takes a map of issue hash to issue.
+
+        Flushes evicted and expired entries, plus any entry whose occurrences have been pending for longer than
+        `max_flush_delay`. Set `force` to flush every pending occurrence. Pending occurrences are restored if the
+        write fails.
+        """
+        issues = self._take_pending(force)
+        if not issues:
+            return issues
+
+        start = time.perf_counter()
+        try:
+            write(issues)
+        except Exception:
+            with self._lock:
+                for issue_hash, issue in issues.items():
+                    pending = self._evicted.setdefault(
+                        issue_hash, _empty_issue(issue["message"])
+                    )
+                    _merge(pending, issue)
+            raise
+        duration = time.perf_counter() - start
+
+        with self._lock:
+            self._stats["flushes"] += 1
+            self._stats["flushed_issues"] += len(issues)
+            self._stats["flush_seconds_total"] += duration
+            self._stats["flush_seconds_max"] = max(
+                self._stats["flush_seconds_max"], duration
+            )
+        return issues
+
+    def stats(self):
+        """Return hit/miss, eviction and flush latency counters."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def clear(self):
+        """Drop every entry and pending occurrence, and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self._evicted.clear()
+            for key in self._stats:
+                self._stats[key] = type(self._stats[key])()
+
+    def _take_pending(self, force):
+        now = self._clock()
+        with self._lock:
+            issues, self._evicted = self._evicted, {}
+            for issue_hash, entry in list(self._entries.items()):
+                if not entry["issue"]["occurrences"]:
+                    continue
+                expired = now - entry["written_at"] > self.ttl
+                overdue = now - entry["pending_since"] > self.max_flush_delay
+                if not (force or expired or overdue):
+                    continue
+                if expired:
+                    del self._entries[issue_hash]
+                    self._stats["expirations"] += 1
+                message = entry["issue"]["message"]
+                pending = issues.setdefault(issue_hash, _empty_issue(message))
+                _merge(pending, entry["issue"])
+                entry["issue"] = _empty_issue(message)
+                entry["pending_since"] = None
+        return issues
+
+
+def _empty_issue(message):
+    return {
+        "message": message,
+        "occurrences": 0,
+        "first_seen": None,
+        "last_seen": None,
+    }
+
+
+def _merge(target, source):
+    """Add the occurrences and seen window of `source` to `target`."""
+    target["occurrences"] += source["occurrences"]
+    target["first_seen"] = _min(target["first_seen"], source["first_seen"])
+    target["last_seen"] = _max(target["last_seen"], source["last_seen"])
+
+
+def _min(a, b):
+    return b if a is None else a if b is None else min(a, b)
+
+
+def _max(a, b):
+    return b if a is None else a if b is None else max(a, b)
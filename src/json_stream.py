@@ -0,0 +1,274 @@
+import re
+
+NUMBER_CHARS = frozenset("0123456789+-.eE")
+LITERALS = ("true", "false", "null")
+WHITESPACE = frozenset(" \t\r\n")
+
+# Characters which need attention while repairing, inside and outside strings.
+STRING_SPECIAL = re.compile(r'["\\\x00-\x1f]')
+# A run of string characters up to a quote or a backslash not starting a valid escape sequence. Raw control
+# characters in the run are escaped afterwards.
+STRING_RUN = re.compile(r'(?:[^"\\]+|\\["\\/bfnrt]|\\u[0-9a-fA-F]{4})*')
+STRUCTURE_SPECIAL = re.compile(r'["{}\[\],]')
+NON_WHITESPACE = re.compile(r"\S")
+CONTROL_CHARS = re.compile(r"[\x00-\x1f]")
+
+# Parser states, outside strings.
+VALUE = "value"
+KEY = "key"
+COLON = "colon"
+AFTER_VALUE = "after value"
+
+
+class MalformedJson(ValueError):
+    """Raised as soon as streamed text can no longer be the start of a JSON document."""
+
+
+class JsonStreamParser:
+    """Incremental validator of a JSON document received in chunks.
+
+    Tracks the structure of the document as text is fed, so a response which stops being JSON is rejected at the
+    first offending character rather than after the whole response was received, and the end of the document is
+    known without waiting for the end of the stream. Follows the leniency of `Model.clean_result`: raw newlines in
+    strings, trailing commas and code fences are accepted.
+    """
+
+    def __init__(self):
+        self.stack = []
+        self.state = VALUE
+        self.complete = False
+        self.length = 0
+        self._in_string = False
+        self._escape = False
+        self._literal = ""
+
+    def feed(self, text):
+        """Consume a chunk of text. Raises `MalformedJson` when the text can't continue the document."""
+        for char in text:
+            if self.complete:
+                return
+            self.length += 1
+            if self._in_string:
+                self._feed_string(char)
+            elif self._literal:
+                self._feed_literal(char)
+            else:
+                self._feed_structure(char)
+
+    def _feed_string(self, char):
+        if self._escape:
+            self._escape = False
+        elif char == "\\":
+            self._escape = True
+        elif char == '"':
+            self._in_string = False
+            if self.state == KEY:
+                self.state = COLON
+            else:
+                self._end_value()
+
+    def _feed_literal(self, char):
+        if char.isalpha() or char in NUMBER_CHARS:
+            self._literal += char
+            if not _is_literal_prefix(self._literal):
+                self._fail(char)
+            return
+        literal, self._literal = self._literal, ""
+        if literal not in LITERALS and not _is_number(literal):
+            self._fail(char, f"invalid literal {literal!r}")
+        self._end_value()
+        self._feed_structure(char)
+
+    def _feed_structure(self, char):
+        if char in WHITESPACE or char == "`":
+            return
+        if self.state == VALUE:
+            if char == "{":
+                self.stack.append("}")
+                self.state = KEY
+            elif char == "[":
+                self.stack.append("]")
+                self.state = VALUE
+            elif char == '"':
+                self._in_string = True
+            elif char in "tfn-" or char.isdigit():
+                self._literal = char
+            elif char == "]" and self.stack and self.stack[-1] == "]":
+                # An empty array, or a trailing comma.
+                self._close(char)
+            else:
+                self._fail(char)
+        elif self.state == KEY:
+            if char == '"':
+                self._in_string = True
+            elif char == "}":
+                # An empty object, or a trailing comma.
+                self._close(char)
+            else:
+                self._fail(char)
+        elif self.state == COLON:
+            if char != ":":
+                self._fail(char)
+            self.state = VALUE
+        elif self.state == AFTER_VALUE:
+            if char == ",":
+                self.state = KEY if self.stack[-1] == "}" else VALUE
+            elif char in "}]":
+                self._close(char)
+            else:
+                self._fail(char)
+
+    def _close(self, char):
+        if not self.stack or self.stack[-1] != char:
+            self._fail(char)
+        self.stack.pop()
+        self._end_value()
+
+    def _end_value(self):
+        if self.stack:
+            self.state = AFTER_VALUE
+        else:
+            self.complete = True
+
+    def _fail(self, char, reason=None):
+        raise MalformedJson(
+            f"Unexpected {char!r} at offset {self.length - 1}, expecting {self.state}"
+            + (f": {reason}" if reason else "")
+        )
+
+
+def _is_number(literal):
+    try:
+        float(literal)
+    except ValueError:
+        return False
+    return True
+
+
+def _is_literal_prefix(text):
+    if text[0] in "tfn":
+        return any(literal.startswith(text) for literal in LITERALS)
+    return all(char in NUMBER_CHARS for char in text)
+
+
+def extract_json_object(text):
+    """Extract the outermost JSON object of a model response in a single pass, repairing its string literals.
+
+    Text around the object, such as code fences or prose, is dropped, and a response continuing the object opened
+    by the prompt gets its opening brace back. Inside strings, raw control characters and backslashes which don't
+    start an escape sequence are escaped, and so are double quotes which the structure following them shows to be
+    part of the string. Trailing commas are removed. Returns the repaired JSON text.
+    """
+    first = NON_WHITESPACE.search(text)
+    if first and first.group() == '"':
+        text = "{" + text[first.start() :]
+    start = text.find("{")
+    if start == -1:
+        raise MalformedJson("No JSON object in response")
+
+    parts = []
+    stack = []
+    expect_key = False
+    index = start
+    while True:
+        match = STRUCTURE_SPECIAL.search(text, index)
+        if not match:
+            raise MalformedJson("Response ended before the JSON object was closed")
+        char = match.group()
+        parts.append(text[index : match.start()])
+        index = match.end()
+        if char == '"':
+            index = _repair_string(text, index, parts, stack, expect_key)
+            expect_key = False
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+            parts.append(char)
+            expect_key = char == "{"
+        elif char in "}]":
+            if not stack or stack[-1] != char:
+                raise MalformedJson(f"Unexpected {char!r} at offset {match.start()}")
+            stack.pop()
+            _drop_trailing_comma(parts)
+            parts.append(char)
+            if not stack:
+                return "".join(parts)
+        else:
+            parts.append(char)
+            expect_key = stack[-1] == "}"
+
+
+def _repair_string(text, index, parts, stack, is_key):
+    """Copy a string literal starting after its opening quote. Returns the index after its closing quote."""
+    parts.append('"')
+    while True:
+        end = STRING_RUN.match(text, index).end()
+        parts.append(_escape_controls(text[index:end]))
+        if end == len(text):
+            raise MalformedJson("Response ended inside a string")
+        char = text[end]
+        index = end + 1
+        if char == '"':
+            if _closes_string(text, end, stack, is_key):
+                parts.append('"')
+                return index
+            parts.append('\\"')
+        else:
+            # A backslash not starting a valid escape sequence is part of the string.
+            parts.append("\\\\")
+
+
+def _escape_controls(run):
+    if not CONTROL_CHARS.search(run):
+        return run
+    # Raw newlines and tabs are by far the most common.
+    run = run.replace("\n", "\\n").replace("\r", "\\r").replace("\t", "\\t")
+    return CONTROL_CHARS.sub(lambda match: f"\\u{ord(match.group()):04x}", run)
+
+
+def _closes_string(text, index, stack, is_key):
+    """Whether the double quote at `index` ends the string, judging by the structure which follows it."""
+    follower, index = _next_significant(text, index + 1)
+    if is_key:
+        return follower == ":"
+    depth = len(stack)
+    while follower in ("}", "]"):
+        depth -= 1
+        if depth == 0:
+            return True
+        follower, index = _next_significant(text, index + 1)
+    if follower != ",":
+        return False
+    follower, index = _next_significant(text, index + 1)
+    if follower in ("{", "[", "}", "]"):
+        # The next value, or a trailing comma.
+        return True
+    if stack[depth - 1] == "]":
+        return follower == '"' or follower in "tfn-" or follower.isdigit()
+    # In an object, a comma is followed by the next key.
+    return follower == '"' and _is_key(text, index + 1)
+
+
+def _is_key(text, index):
+    """Whether the string starting after the quote at `index` - 1 is followed by a colon."""
+    while True:
+        match = STRING_SPECIAL.search(text, index)
+        if not match:
+            return False
+        index = match.end()
+        if match.group() == "\\":
+            index += 1
+        elif match.group() == '"':
+            return _next_significant(text, index)[0] == ":"
+
+
+def _next_significant(text, index):
+    match = NON_WHITESPACE.search(text, index)
+    return (match.group(), match.start()) if match else ("", len(text))
+
+
+def _drop_trailing_comma(parts):
+    for i in range(len(parts) - 1, -1, -1):
+        if parts[i].strip():
+            if parts[i] == ",":
+                del parts[i]
+            return
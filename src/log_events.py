@@ -0,0 +1,120 @@
+import codecs
+import json
+import re
+import unicodedata
+import zlib
+from base64 import b64decode
+
+# Size of each decompressed slice fed to the JSON scanner.
+CHUNK_SIZE = 64 * 1024
+# wbits for zlib to expect a gzip header and trailer.
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+_decoder = json.JSONDecoder()
+
+
+def iter_log_events(encoded_zipped_data, chunk_size=CHUNK_SIZE):
+    """Yield the log events of a zipped CloudWatch subscription payload one at a time.
+
+    The payload is inflated incrementally and each log event is parsed as soon as it is complete, so the decoded
+    payload is never held in memory as a whole. Messages containing non-ASCII characters are normalized to ASCII.
+    """
+    reader = _JsonReader(_inflate(b64decode(encoded_zipped_data), chunk_size))
+    reader.expect("{")
+    while not reader.consume("}"):
+        reader.consume(",")
+        key = reader.value()
+        reader.expect(":")
+        if key != "logEvents":
+            reader.value()
+            continue
+
+        reader.expect("[")
+        while not reader.consume("]"):
+            reader.consume(",")
+            log_event = reader.value()
+            log_event["message"] = normalize_message(log_event["message"])
+            yield log_event
+
+
+def normalize_message(message):
+    """Strip a message down to ASCII, decomposing accented characters first."""
+    if message.isascii():
+        return message
+    return (
+        unicodedata.normalize("NFKD", message).encode("ascii", "ignore").decode("ascii")
+    )
+
+
+def _inflate(zipped_data, chunk_size):
+    """Incrementally gunzip and decode data into text chunks of at most `chunk_size` bytes."""
+    inflater = zlib.decompressobj(wbits=GZIP_WBITS)
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    data = zipped_data
+    while data:
+        chunk = inflater.decompress(data, chunk_size)
+        data = inflater.unconsumed_tail
+        yield text_decoder.decode(chunk)
+    yield text_decoder.decode(inflater.flush(), final=True)
+
+
+class _JsonReader:
+    """Pull-based scanner over a stream of JSON text chunks.
+
+    Only the unparsed remainder of the stream is buffered; scalar and object values are decoded with the standard
+    library decoder once enough text has arrived to hold them.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buffer = ""
+        self._pos = 0
+        self._exhausted = False
+
+    def value(self):
+        """Decode the next complete JSON value."""
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the next chunk.
+            if end == len(self._buffer) and not self._exhausted and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    def consume(self, char):
+        """Consume `char` if it is the next non-whitespace character."""
+        self._skip_whitespace()
+        if self._buffer[self._pos : self._pos + 1] == char:
+            self._pos += 1
+            return True
+        return False
+
+    def expect(self, char):
+        if not self.consume(char):
+            found = self._buffer[self._pos : self._pos + 1] or "end of data"
+            raise json.JSONDecodeError(
+                f"Expecting '{char}', found '{found}'", self._buffer, self._pos
+            )
+
+    def _skip_whitespace(self):
+        while True:
+            self._pos = WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer) or not self._fill():
+                return
+
+    def _fill(self):
+        """Append the next chunk to the buffer, dropping text that has already been parsed."""
+        for chunk in self._chunks:
+            self._buffer = self._buffer[self._pos :] + chunk
+            self._pos = 0
+            if chunk:
+                return True
+        self._exhausted = True
+        return False
@@ -0,0 +1,91 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import get_logger
+
+logger = get_logger()
+
+# SQS limits a SendMessageBatch/DeleteMessageBatch call to 10 entries and 256 KiB in total.
+BATCH_MAX_ENTRIES = 10
+BATCH_MAX_BYTES = 256 * 1024
+
+
+def send_messages(sqs_client, queue_url, entries, max_workers=10):
+    """Send SQS entries (`Id`, `MessageBody` and optional `MessageAttributes`) in concurrent batches.
+
+    Returns the IDs of the entries which could not be sent.
+    """
+    batches = list(batch_entries(entries))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(
+            executor.map(
+                lambda batch: send_batch(sqs_client, queue_url, batch), batches
+            )
+        )
+    return [entry_id for failed_ids in results for entry_id in failed_ids]
+
+
+def batch_entries(entries, max_entries=BATCH_MAX_ENTRIES, max_bytes=BATCH_MAX_BYTES):
+    """Split SQS entries into batches within the entry count and payload size limits."""
+    batch = []
+    batch_bytes = 0
+    for entry in entries:
+        entry_bytes = entry_size(entry)
+        if batch and (
+            len(batch) == max_entries or batch_bytes + entry_bytes > max_bytes
+        ):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(entry)
+        batch_bytes += entry_bytes
+    if batch:
+        yield batch
+
+
+def entry_size(entry):
+    """Return the size SQS counts towards the payload limit for an entry."""
+    size = len(entry.get("MessageBody", "").encode())
+    for name, attribute in entry.get("MessageAttributes", {}).items():
+        size += len(name.encode()) + len(attribute["DataType"].encode())
+        size += len(attribute.get("StringValue", "").encode())
+    return size
+
+
+def send_batch(sqs_client, queue_url, entries):
+    """Send a batch of entries, retrying failed entries individually.
+
+    Returns the IDs of the entries which still failed.
+    """
+    try:
+        response = sqs_client.send_message_batch(QueueUrl=queue_url, Entries=entries)
+        failed_ids = {failed["Id"] for failed in response.get("Failed", [])}
+        failed_entries = [entry for entry in entries if entry["Id"] in failed_ids]
+    except Exception:
+        logger.exception(f"Failed to send batch of {len(entries)} messages")
+        failed_entries = entries
+
+    failures = []
+    for entry in failed_entries:
+        message = {key: value for key, value in entry.items() if key != "Id"}
+        try:
+            sqs_client.send_message(QueueUrl=queue_url, **message)
+        except Exception:
+            logger.exception(f"Failed to send message {entry['Id']}")
+            failures.append(entry["Id"])
+    return failures
+
+
+def delete_messages(sqs_client, queue_url, receipt_handles):
+    """Delete received messages in batches. Returns the receipt handles which could not be deleted."""
+    failures = []
+    entries = [
+        {"Id": str(i), "ReceiptHandle": receipt_handle}
+        for i, receipt_handle in enumerate(receipt_handles)
+    ]
+    for batch in batch_entries(entries):
+        response = sqs_client.delete_message_batch(QueueUrl=queue_url, Entries=batch)
+        failed_ids = {failed["Id"] for failed in response.get("Failed", [])}
+        failures.extend(
+            entry["ReceiptHandle"] for entry in batch if entry["Id"] in failed_ids
+        )
+    return failures
@@ -0,0 +1,152 @@
+import difflib
+import os
+
+from utils import get_logger
+
+logger = get_logger()
+
+# Minimum similarity of the lines matched by a fuzzy search to the search lines.
+FUZZY_MATCH_THRESHOLD = 0.85
+
+
+class PatchError(Exception):
+    """Raised when an edit can't be located in the file it targets."""
+
+
+def apply_file_edits(repo_dir, files):
+    """Apply the search/replace edits returned by the model to the files in the repo.
+
+    Returns file objects with the "filename" and the patched "contents", ready for `update_source_code`.
+    """
+    patched = []
+    for file in files:
+        file_path = os.path.join(repo_dir, file["filename"])
+        if os.path.exists(file_path):
+            with open(file_path, "r") as f:
+                source = f.read()
+        else:
+            source = None
+        contents = apply_edits(source, file["edits"], file["filename"])
+        patched.append({"filename": file["filename"], "contents": contents})
+    return patched
+
+
+def apply_edits(source, edits, filename):
+    """Apply search/replace edits in order. An edit with an empty search creates the file when it doesn't exist."""
+    for edit in edits:
+        search, replace = edit["search"], edit["replace"]
+        if not search.strip():
+            if source:
+                raise PatchError(f"Edit of existing file {filename} has no search text")
+            source = replace
+            continue
+        if source is None:
+            raise PatchError(f"File {filename} does not exist")
+        source = apply_edit(source, search, replace, filename)
+    return source
+
+
+def apply_edit(source, search, replace, filename):
+    """Replace the one occurrence of `search` in `source`.
+
+    Matches the search text exactly first, then line by line ignoring indentation and trailing whitespace, and
+    finally by similarity of the lines, which tolerates small differences in the lines the model copied.
+    """
+    # Exact matches must start a line, so that a search text without its indentation falls through to the line
+    # matching below rather than matching the end of a line.
+    count = f"\n{source}".count(f"\n{search}")
+    if count == 1:
+        return f"\n{source}".replace(f"\n{search}", f"\n{replace}")[1:]
+    if count > 1:
+        raise PatchError(f"Search text matches {count} times in {filename}")
+
+    lines = source.splitlines(keepends=True)
+    search_lines = _strip_blank_lines(search.splitlines())
+    if not search_lines:
+        raise PatchError(f"Search text of an edit to {filename} is blank")
+
+    stripped = [line.strip() for line in lines]
+    stripped_search = [line.strip() for line in search_lines]
+    size = len(search_lines)
+    starts = [
+        start
+        for start in range(len(lines) - size + 1)
+        if stripped[start : start + size] == stripped_search
+    ]
+    if len(starts) > 1:
+        raise PatchError(
+            f"Search text matches {len(starts)} times in {filename}, ignoring whitespace"
+        )
+    if not starts:
+        start = _fuzzy_find(stripped, stripped_search, filename)
+        logger.info(f"Fuzzy matched an edit to {filename} at line {start + 1}")
+    else:
+        start = starts[0]
+
+    replace_lines = _reindent(replace.splitlines(), search_lines, lines[start])
+    newline = "\n" if lines[start + size - 1].endswith("\n") else ""
+    replacement = "\n".join(replace_lines) + newline if replace_lines else ""
+    return "".join(lines[:start]) + replacement + "".join(lines[start + size :])
+
+
+def _fuzzy_find(stripped, stripped_search, filename):
+    """Find the window of lines most similar to the search lines, which must be a clear best match."""
+    size = len(stripped_search)
+    search_text = "\n".join(stripped_search)
+    matcher = difflib.SequenceMatcher(autojunk=False)
+    matcher.set_seq2(search_text)
+    scores = []
+    for start in range(len(stripped) - size + 1):
+        matcher.set_seq1("\n".join(stripped[start : start + size]))
+        # The cheap upper bounds skip windows which can't reach the threshold.
+        if matcher.real_quick_ratio() < FUZZY_MATCH_THRESHOLD:
+            continue
+        if matcher.quick_ratio() < FUZZY_MATCH_THRESHOLD:
+            continue
+        ratio = matcher.ratio()
+        if ratio >= FUZZY_MATCH_THRESHOLD:
+            scores.append((ratio, start))
+    if not scores:
+        raise PatchError(f"Search text not found in {filename}")
+    scores.sort(reverse=True)
+    # Overlapping windows around the same lines are one match; separate windows scoring as well are ambiguous.
+    best_ratio, best_start = scores[0]
+    for ratio, start in scores[1:]:
+        if ratio == best_ratio and abs(start - best_start) >= size:
+            raise PatchError(f"Search text matches several places in {filename}")
+    return best_start
+
+
+def _strip_blank_lines(lines):
+    start = 0
+    end = len(lines)
+    while start < end and not lines[start].strip():
+        start += 1
+    while end > start and not lines[end - 1].strip():
+        end -= 1
+    return lines[start:end]
+
+
+def _reindent(replace_lines, search_lines, first_matched_line):
+    """Shift the replacement by the difference between the indentation of the search text and the matched lines.
+
+    The replacement is only shifted when it starts at the indentation of the search text, as it is otherwise
+    assumed to be indented correctly already.
+    """
+    replace_lines = _strip_blank_lines(replace_lines)
+    search_indent = _indent(search_lines[0])
+    matched_indent = _indent(first_matched_line)
+    if search_indent == matched_indent:
+        return replace_lines
+    if not replace_lines or _indent(replace_lines[0]) != search_indent:
+        return replace_lines
+    reindented = []
+    for line in replace_lines:
+        if line.startswith(search_indent):
+            line = matched_indent + line[len(search_indent) :]
+        reindented.append(line if line.strip() else "")
+    return reindented
+
+
+def _indent(line):
+    return line[: len(line) - len(line.lstrip())]
@@ -0,0 +1,102 @@
+import os
+import shutil
+import threading
+
+from utils import get_logger
+
+logger = get_logger()
+
+INDEX_DIR_NAME = "path-index"
+
+_FILE = None
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+class PathIndex:
+    """Index of the file paths in a commit, resolving stack frame paths by their longest matching suffix.
+
+    Paths are grouped by basename. Paths sharing a basename are arranged in a trie of their reversed components,
+    built on first use, so `/var/task/handlers/__init__.py` resolves to `src/handlers/__init__.py` rather than every
+    `__init__.py` in the repo. A lookup costs one step per path component, independent of the number of files.
+    """
+
+    def __init__(self, paths):
+        self.by_basename = {}
+        for path in paths:
+            self.by_basename.setdefault(path.rpartition("/")[2], []).append(path)
+        self._tries = {}
+
+    def resolve(self, frame_path):
+        """Return the repo paths sharing the longest suffix with `frame_path`, or an empty list."""
+        components = frame_path.replace("\\", "/").split("/")
+        candidates = self.by_basename.get(components[-1])
+        if not candidates or len(candidates) == 1:
+            return list(candidates or [])
+
+        node = self._trie(components[-1], candidates)
+        for component in reversed(components[:-1]):
+            if component not in node:
+                break
+            node = node[component]
+        return _files_under(node)
+
+    def _trie(self, basename, candidates):
+        trie = self._tries.get(basename)
+        if trie is None:
+            trie = {}
+            for path in candidates:
+                node = trie
+                for component in reversed(path.split("/")[:-1]):
+                    node = node.setdefault(component, {})
+                node[_FILE] = path
+            self._tries[basename] = trie
+        return trie
+
+
+def _files_under(node):
+    files = []
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        for component, child in node.items():
+            if component is _FILE:
+                files.append(child)
+            else:
+                stack.append(child)
+    return sorted(files)
+
+
+def get_path_index(repo, rev="HEAD"):
+    """Return the path index of a commit, building it once per commit.
+
+    Indexes are kept in memory for warm invocations and the file list is stored in the repo's git directory, so
+    reopening a cached clone doesn't need another tree listing.
+    """
+    sha = repo.commit(rev).hexsha
+    key = (repo.common_dir, sha)
+    with _indexes_lock:
+        index = _indexes.get(key)
+    if index is not None:
+        return index
+
+    index_file = os.path.join(repo.common_dir, INDEX_DIR_NAME, sha)
+    if os.path.exists(index_file):
+        with open(index_file, "r") as f:
+            paths = f.read().split("\0")
+    else:
+        logger.info(f"Building path index for commit {sha}")
+        # Lists blobs only, so directories are never matched. Reads trees only, which a blob-filtered clone holds.
+        paths = repo.git.ls_tree("-r", "--name-only", "-z", sha).split("\0")
+        # Indexes of older commits are no longer needed once the clone has moved on.
+        shutil.rmtree(os.path.dirname(index_file), ignore_errors=True)
+        os.makedirs(os.path.dirname(index_file), exist_ok=True)
+        with open(index_file, "w") as f:
+            f.write("\0".join(paths))
+
+    index = PathIndex(path for path in paths if path)
+    with _indexes_lock:
+        # Only the latest index is kept in memory.
+        _indexes.clear()
+        _indexes[key] = index
+    return index
@@ -1,31 +1,94 @@
+import importlib
 import json
-import re
+import threading
+from abc import ABC, abstractmethod
 
+from json_stream import MalformedJson, extract_json_object
 
-def remove_newlines(json_string):
-    """Remove newline characters if they aren't enclosed in double quotes."""
-    result = json_string
-    result = re.sub('(?<!")\\n', "", result)
-    result = re.sub("\\n(?= *})", "", result)
-    return result
+# Rough token estimate for prompts and responses, which average about 4 characters per token.
+CHARS_PER_TOKEN = 4
+# Keys of the file objects in the model's response, by output mode, and whether their values are strings or lists
+# of edits.
+FILE_KEYS = {"files": ("contents", str), "edits": ("edits", list)}
+# Model provider classes by provider name, as module and class names. Modules are imported on first use.
+PROVIDER_CLASSES = {"bedrock": ("providers.bedrock", "Claude")}
 
+# Providers survive across warm invocations, so their clients and connection pools are reused.
+_providers = {}
+_providers_lock = threading.Lock()
 
-class Model:
+
+class ModelResponseError(Exception):
+    """Raised when the model's response is malformed or exceeds its budget."""
+
+
+class Model(ABC):
     """Model class for GenAI."""
 
-    def fix_code(self, stack_trace, source_code_map):
-        """Trigger the code fix generation process."""
-        prompt = self._create_prompt(stack_trace, source_code_map)
-        content = self._invoke(prompt)
-        cleaned_content = self.clean_result(content)
-        return json.loads(cleaned_content)
-
-    def clean_result(self, content):
-        """Clean the response from the model."""
-        cleaned_result = content.replace("```", "")
-        cleaned_result = remove_newlines(cleaned_result)
-        cleaned_result = cleaned_result.strip()
-        cleaned_result = cleaned_result.rstrip(",")
-        # Replace \n with \\n to escape newlines in JSON
-        cleaned_result = cleaned_result.replace("\n", "\\n")
-        return cleaned_result
+    def fix_code(self, stack_trace, source_code_map, output_mode="files"):
+        """Trigger the code fix generation process.
+
+        In "files" mode the model returns the full contents of modified files, in "edits" mode search/replace edits.
+        """
+        prompt = self._create_prompt(stack_trace, source_code_map, output_mode)
+        content = self._invoke(prompt, output_mode)
+        return self.parse_result(content, output_mode)
+
+    @abstractmethod
+    def prompt_version(self, output_mode="files"):
+        """Return the version of the prompt used in `output_mode`, part of the cache key of results."""
+
+    def parse_result(self, content, output_mode="files"):
+        """Parse and validate the JSON object in the response from the model."""
+        try:
+            result = json.loads(extract_json_object(content))
+        except (MalformedJson, ValueError) as e:
+            raise ModelResponseError(f"Malformed response: {e}") from e
+        validate_result(result, output_mode)
+        return result
+
+
+def validate_result(result, output_mode):
+    """Check that a parsed response has the keys and types the prompt asks for."""
+    if not isinstance(result, dict):
+        raise ModelResponseError("Response is not a JSON object")
+    for key in ("description", "title"):
+        if not isinstance(result.get(key), str):
+            raise ModelResponseError(f"Response has no {key} string")
+    if not isinstance(result.get("source_code"), list):
+        raise ModelResponseError("Response has no source_code list")
+
+    key, value_type = FILE_KEYS[output_mode]
+    for file in result["source_code"]:
+        if not isinstance(file, dict) or not isinstance(file.get("filename"), str):
+            raise ModelResponseError(f"Invalid file object in response: {file!r:.200}")
+        if not isinstance(file.get(key), value_type):
+            raise ModelResponseError(f"File {file['filename']} has no {key}")
+        if output_mode == "edits":
+            for edit in file["edits"]:
+                if not isinstance(edit, dict) or not all(
+                    isinstance(edit.get(name), str) for name in ("search", "replace")
+                ):
+                    raise ModelResponseError(
+                        f"Invalid edit of {file['filename']} in response: {edit!r:.200}"
+                    )
+
+
+def get_provider(name, **kwargs):
+    """Return the model provider `name`, created with `kwargs` on first use and reused afterwards."""
+    if name not in PROVIDER_CLASSES:
+        raise Exception(f"Invalid model provider: {name}")
+    key = (name, tuple(sorted(kwargs.items())))
+    with _providers_lock:
+        provider = _providers.get(key)
+        if provider is None:
+            module_name, class_name = PROVIDER_CLASSES[name]
+            provider_class = getattr(importlib.import_module(module_name), class_name)
+            provider = _providers[key] = provider_class(**kwargs)
+    return provider
+
+
+def clear_providers():
+    """Drop every provider, so the next `get_provider` creates new ones."""
+    with _providers_lock:
+        _providers.clear()
@@ -1,12 +1,39 @@
+import hashlib
+import json
+import os
+import time
+import zlib
+from collections import deque
+
 import boto3
 from botocore.client import Config
 from langchain.llms.bedrock import Bedrock
 from langchain.prompts import PromptTemplate
 
-from providers import Model
+from instrumentation import current_metrics, log_payload
+from json_stream import JsonStreamParser, MalformedJson
+from providers import CHARS_PER_TOKEN, Model, ModelResponseError
+from providers.governor import ModelCallGovernor
 from utils import get_logger
 
-config = Config(connect_timeout=240, read_timeout=240)
+# Throttled and transiently failed calls are retried by the governor, which coordinates the retries of concurrent
+# calls, instead of botocore.
+retries = {"total_max_attempts": 1}
+config = Config(connect_timeout=240, read_timeout=240, retries=retries)
+# A streamed response delivers chunks as they are generated, so a stalled stream is detected without waiting for
+# the whole completion.
+stream_config = Config(connect_timeout=10, read_timeout=30, retries=retries)
+# Streamed responses taking longer than this are aborted.
+STREAM_MAX_SECONDS = int(os.environ.get("STREAM_MAX_SECONDS", "180"))
+# A model stuck in a loop repeats the same text until it runs out of tokens. Every REPETITION_WINDOW characters, the
+# latest window is compressed: code and prose compress to a third or so, a loop to almost nothing.
+REPETITION_WINDOW = 4096
+REPETITION_MAX_COMPRESSION_RATIO = 0.05
+# Characters of prose, such as "Here is the fix:", allowed before the JSON object starts. A response without an
+# object by then, such as a refusal, is aborted.
+STREAM_MAX_PREAMBLE = 512
+# Providers are reused across warm invocations, so only the metrics of the latest invocations are kept.
+MAX_RECORDED_INVOCATIONS = 100
 
 
 logger = get_logger()
@@ -26,6 +53,9 @@ Provide a response in JSON format with the following keys:
 - title: a title for the fix
 - source_code: an array of modified file objects with "filename" and "contents" keys
 
+Some files are excerpts, where lines irrelevant to the error are replaced by a marker line such as
+[[omitted lines 12-40]]. Return these files with every marker line kept unchanged and in place.
+
 <example code>
 
 def get_key(dict, key):
@@ -55,33 +85,126 @@ def get_key(dict, key):
 Assistant:{{
 """,
 )
+EDITS_PROMPT_TEMPLATE = PromptTemplate(
+    input_variables=["stack_trace", "source_code"],
+    template="""
+Human: 
+You are a code debugging and fixing assistant.
+You will debug stack traces to identify the issues in the provided source code.
+Generate edits to the source code to prevent the error from occurring again.
+Modify only the code relevant to the fix.
+Provide a response in JSON format with the following keys:
+- description: a description of the bug and how the modified code fixes it
+- title: a title for the fix
+- source_code: an array of modified file objects with "filename" and "edits" keys
+
+Each edit has a "search" key with lines copied exactly from the file, including indentation, and a "replace" key
+with the lines replacing them. Include just enough lines in "search" to match a single place in the file.
+Edits of a file are applied in order. To create a new file, use a single edit with an empty "search".
+Some files are excerpts, where lines irrelevant to the error are replaced by a marker line such as
+[[omitted lines 12-40]]. Never include these marker lines in an edit.
+
+<example code>
+
+def get_key(dict, key):
+    return dict[key]
+
+</example code>
+<example response>
+{{
+    "description": "Handle KeyErrors when the key does not exist in the dict",
+    "title": "Handle KeyErrors in get_key",
+    "source_code": [
+        {{
+            "filename": "src/foo.py",
+            "edits": [
+                {{
+                    "search": "    return dict[key]\n",
+                    "replace": "    try:\n        return dict[key]\n    except KeyError:\n        return None\n"
+                }}
+            ]
+        }}
+    ]
+}}
+</example response>
+
+<code>
+{source_code}
+</code>
+<stack_trace>
+{stack_trace}
+</stack_trace>
+
+Assistant:{{
+""",
+)
+PROMPT_TEMPLATES = {"files": PROMPT_TEMPLATE, "edits": EDITS_PROMPT_TEMPLATE}
+# Edits are a fraction of the size of whole files, so responses in edits mode are capped lower.
+MAX_TOKENS_TO_SAMPLE = {"files": 10000, "edits": 4000}
+# Identifies the prompt of each output mode in cached fix results, so that changing a prompt invalidates them.
+PROMPT_VERSIONS = {
+    output_mode: hashlib.sha256(
+        f"{template.template}{MAX_TOKENS_TO_SAMPLE[output_mode]}".encode()
+    ).hexdigest()[:16]
+    for output_mode, template in PROMPT_TEMPLATES.items()
+}
 
 
 class Claude(Model):
-    """Claude model class."""
+    """Claude model class.
 
-    def __init__(self, model_id=DEFAULT_MODEL, model_aws_region=DEFAULT_MODEL_REGION):
-        bedrock_client = boto3.client(
-            "bedrock-runtime",
-            region_name=model_aws_region,
-            config=config,
-        )
-        self.llm = Bedrock(
-            client=bedrock_client,
-            model_id=model_id,
-            model_kwargs={
-                "temperature": 0.0,
-                "max_tokens_to_sample": 10000,
-                "top_p": 0.999,
-                "top_k": 250,
-                "stop_sequences": [
-                    "\\n\\nHuman::",
-                ],
-            },
-        )
+    Model calls go through a `ModelCallGovernor`, which adapts their concurrency to throttling and retries throttled
+    calls, on the `fallbacks` (region, model ID) pairs in order when the model's region is throttled.
+    """
+
+    def __init__(
+        self,
+        model_id=DEFAULT_MODEL,
+        model_aws_region=DEFAULT_MODEL_REGION,
+        streaming=True,
+        endpoint_url=None,
+        fallbacks=(),
+        governor=None,
+    ):
+        self.model_id = model_id
+        self.streaming = streaming
+        # Regions and model IDs to invoke, in order of preference.
+        self.targets = [(model_aws_region, model_id), *fallbacks]
+        self.clients = [
+            boto3.client(
+                "bedrock-runtime",
+                region_name=region,
+                config=stream_config if streaming else config,
+                endpoint_url=endpoint_url,
+            )
+            for region, _ in self.targets
+        ]
+        self.governor = governor or ModelCallGovernor(len(self.targets))
+        self.model_kwargs = {
+            "temperature": 0.0,
+            "max_tokens_to_sample": 10000,
+            "top_p": 0.999,
+            "top_k": 250,
+            "stop_sequences": [
+                "\\n\\nHuman::",
+            ],
+        }
+        self.client = self.clients[0]
+        self.llms = [
+            Bedrock(
+                client=client, model_id=target_model_id, model_kwargs=self.model_kwargs
+            )
+            for client, (_, target_model_id) in zip(self.clients, self.targets)
+        ]
+        self.llm = self.llms[0]
+        # Metrics of the latest invocations, in order.
+        self.invocations = deque(maxlen=MAX_RECORDED_INVOCATIONS)
         logger.info("Initialized Claude")
 
-    def _create_prompt(self, stack_trace, source_code_map):
+    def prompt_version(self, output_mode="files"):
+        return PROMPT_VERSIONS[output_mode]
+
+    def _create_prompt(self, stack_trace, source_code_map, output_mode="files"):
         """Create a prompt for the model to generate a code fix."""
         logger.info("Creating prompt for model")
         source_code_parts = []
@@ -90,17 +213,188 @@ class Claude(Model):
                 f"File: {filename}\n\nContents:\n{source_code}\n\n"
             )
         concatenated_source_code = "\n".join(source_code_parts)
-        prompt = PROMPT_TEMPLATE.format(
+        prompt = PROMPT_TEMPLATES[output_mode].format(
             stack_trace=stack_trace, source_code=concatenated_source_code
         )
         return prompt
 
-    def _invoke(self, prompt):
-        """Invoke the model with the prompt."""
-        logger.info(f"Prompt: {prompt}")
-        response = self.llm(prompt)
-        # Append opening curly braces which might be missing, depending on the prompt.
-        if not response.startswith("{"):
-            response = "{" + response
-        logger.info(f"Raw response from GenAI: {response}")
+    def _invoke(self, prompt, output_mode="files"):
+        """Invoke the model with the prompt, through the governor."""
+        log_payload("Prompt", prompt)
+        max_tokens = MAX_TOKENS_TO_SAMPLE[output_mode]
+        metrics = {"input_tokens": -(-len(prompt) // CHARS_PER_TOKEN)}
+        start = time.monotonic()
+        try:
+            if self.streaming:
+                response = self.governor.call(
+                    lambda target: self._invoke_streaming(
+                        prompt, max_tokens, target, metrics
+                    ),
+                    metrics,
+                )
+            else:
+                response = self.governor.call(
+                    lambda target: self.llms[target](
+                        prompt, max_tokens_to_sample=max_tokens
+                    ),
+                    metrics,
+                )
+                metrics["output_tokens"] = -(-len(response) // CHARS_PER_TOKEN)
+        except Exception as e:
+            metrics.setdefault("outcome", type(e).__name__)
+            raise
+        finally:
+            region, model_id = self.targets[metrics.get("target", 0)]
+            metrics.update(region=region, model_id=model_id)
+            self._record_invocation(metrics, time.monotonic() - start)
+        log_payload("Raw response from GenAI", response)
         return response
+
+    def _invoke_streaming(self, prompt, max_tokens, target=0, metrics=None):
+        """Invoke the model of a target with a response stream, validating the JSON response as it is generated.
+
+        Stops reading as soon as the JSON document is complete, and raises `ModelResponseError` as soon as the
+        response exceeds `max_tokens`, repeats itself, runs longer than `STREAM_MAX_SECONDS` or has no JSON object
+        within its first `STREAM_MAX_PREAMBLE` characters. Once the object has started, a response which isn't
+        strict JSON, such as one with unescaped quotes, is read to the end and left to `parse_result` to repair. The time to first token, token counts and outcome are set in `metrics`.
+        """
+        body = {
+            **self.model_kwargs,
+            "prompt": prompt,
+            "max_tokens_to_sample": max_tokens,
+        }
+        metrics = {} if metrics is None else metrics
+        metrics.update(time_to_first_token=None, output_tokens=0)
+        metrics.pop("outcome", None)
+        start = time.monotonic()
+        response = self.clients[target].invoke_model_with_response_stream(
+            modelId=self.targets[target][1],
+            body=json.dumps(body),
+            accept="application/json",
+            contentType="application/json",
+        )
+        stream = response["body"]
+        parser = JsonStreamParser()
+        # Characters received before the start of the JSON object, or None once it started, whether they are all
+        # whitespace, and whether the parser still validates the response.
+        preamble = 0
+        leading = True
+        validating = True
+        parts = []
+        length = 0
+        stop_reason = None
+        try:
+            for event in stream:
+                chunk = json.loads(event["chunk"]["bytes"])
+                text = chunk.get("completion", "")
+                stop_reason = chunk.get("stop_reason")
+                if metrics["time_to_first_token"] is None and text:
+                    metrics["time_to_first_token"] = time.monotonic() - start
+                parts.append(text)
+                length += len(text)
+                invocation_metrics = chunk.get("amazon-bedrock-invocationMetrics")
+                if invocation_metrics:
+                    metrics["input_tokens"] = invocation_metrics["inputTokenCount"]
+                    metrics["output_tokens"] = invocation_metrics["outputTokenCount"]
+                else:
+                    metrics["output_tokens"] = -(-length // CHARS_PER_TOKEN)
+
+                if validating:
+                    feed = text
+                    if preamble is not None:
+                        feed = _json_object_start(text, leading)
+                        if feed is not None:
+                            preamble = None
+                        else:
+                            preamble += len(text)
+                            leading = leading and not text.strip()
+                            if preamble > STREAM_MAX_PREAMBLE:
+                                raise ModelResponseError(
+                                    f"Response has no JSON object in its first {STREAM_MAX_PREAMBLE} characters"
+                                )
+                    try:
+                        if feed:
+                            parser.feed(feed)
+                    except MalformedJson as e:
+                        logger.info(
+                            f"Response is not strict JSON, reading it to the end: {e}"
+                        )
+                        validating = False
+                    if parser.complete:
+                        break
+                if (
+                    length // REPETITION_WINDOW
+                    > (length - len(text)) // REPETITION_WINDOW
+                ):
+                    window = "".join(parts)[-REPETITION_WINDOW:].encode()
+                    ratio = len(zlib.compress(window)) / len(window)
+                    if ratio < REPETITION_MAX_COMPRESSION_RATIO:
+                        raise ModelResponseError("Response is repeating itself")
+                if metrics["output_tokens"] > max_tokens:
+                    raise ModelResponseError(f"Response exceeded {max_tokens} tokens")
+                if time.monotonic() - start > STREAM_MAX_SECONDS:
+                    raise ModelResponseError(
+                        f"Response took longer than {STREAM_MAX_SECONDS} s"
+                    )
+            if validating and not parser.complete:
+                raise ModelResponseError(
+                    f"Response ended before the JSON document was complete, stop reason {stop_reason}"
+                )
+        except ModelResponseError:
+            metrics["outcome"] = "aborted"
+            raise
+        finally:
+            stream.close()
+            if metrics["time_to_first_token"] is not None:
+                metrics["generation_seconds"] = (
+                    time.monotonic() - start - metrics["time_to_first_token"]
+                )
+        metrics["outcome"] = "ok"
+        return "".join(parts)
+
+    def _record_invocation(self, metrics, duration):
+        metrics["duration"] = duration
+        metrics.setdefault("outcome", "ok")
+        metrics.setdefault("time_to_first_token", None)
+        metrics.setdefault("output_tokens", 0)
+        # Only streamed responses tell when generation started.
+        generation = metrics.pop("generation_seconds", 0)
+        metrics["tokens_per_second"] = (
+            metrics["output_tokens"] / generation if generation > 0 else None
+        )
+        self.invocations.append(metrics)
+        logger.info(f"Model invocation metrics: {metrics}")
+        # The model calls of a fix are summed up in the metrics of the fix, except for the time to first token, which
+        # is the slowest one of its calls.
+        fix_metrics = current_metrics()
+        if fix_metrics:
+            fix_metrics.put_duration("model", duration)
+            if metrics["time_to_first_token"] is not None:
+                fix_metrics.put_duration(
+                    "model_first_token",
+                    metrics["time_to_first_token"],
+                    fix_metrics.put_max,
+                )
+            fix_metrics.put_duration("model_queue", metrics.get("queue_seconds", 0))
+            fix_metrics.put_duration("model_backoff", metrics.get("backoff_seconds", 0))
+            fix_metrics.put("model_calls", 1)
+            fix_metrics.put("model_attempts", metrics.get("attempts", 0))
+            fix_metrics.put("model_throttles", metrics.get("throttles", 0))
+            fix_metrics.put("model_errors", metrics.get("errors", 0))
+            fix_metrics.put("input_tokens", metrics["input_tokens"])
+            fix_metrics.put("output_tokens", metrics["output_tokens"])
+
+
+def _json_object_start(text, leading):
+    """Return the text of a chunk of a response from the start of its JSON object, or None if the object doesn't
+    start in the chunk.
+
+    The prompt opens the object, so a response usually continues it with its first key: a `leading` chunk, one
+    preceded by whitespace only, may start the object with a double quote.
+    """
+    if leading:
+        text = text.lstrip()
+        if text.startswith('"'):
+            return "{" + text
+    start = text.find("{")
+    return None if start == -1 else text[start:]
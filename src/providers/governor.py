@@ -0,0 +1,268 @@
+import os
+import random
+import threading
+import time
+
+import botocore.exceptions
+import urllib3.exceptions
+
+from utils import get_logger
+
+logger = get_logger()
+
+# Error codes of throttled model calls. Errors raised in the middle of a response stream use lower camel case codes.
+THROTTLING_ERRORS = {
+    "throttlingexception",
+    "toomanyrequestsexception",
+    "servicequotaexceededexception",
+    "serviceunavailableexception",
+    "modelnotreadyexception",
+}
+# Error codes of model calls which failed transiently, on the server or in the middle of a response stream, and
+# exceptions of connections which failed, were reset or timed out. These calls are retried like throttled ones,
+# without adapting the concurrency limit.
+TRANSIENT_ERRORS = {
+    "internalserverexception",
+    "modeltimeoutexception",
+    "modelstreamerrorexception",
+    "internalfailure",
+}
+TRANSIENT_EXCEPTIONS = (
+    ConnectionError,
+    TimeoutError,
+    botocore.exceptions.ConnectionError,
+    botocore.exceptions.HTTPClientError,
+    urllib3.exceptions.ProtocolError,
+    urllib3.exceptions.TimeoutError,
+)
+# Bounds and initial value of the number of concurrent model calls. The limit grows by one after a full limit's
+# worth of successful calls, and is multiplied by GOVERNOR_DECREASE after a throttled call.
+GOVERNOR_MIN_CONCURRENCY = int(os.environ.get("GOVERNOR_MIN_CONCURRENCY", "1"))
+GOVERNOR_MAX_CONCURRENCY = int(os.environ.get("GOVERNOR_MAX_CONCURRENCY", "8"))
+GOVERNOR_INITIAL_CONCURRENCY = int(os.environ.get("GOVERNOR_INITIAL_CONCURRENCY", "4"))
+GOVERNOR_INCREASE = float(os.environ.get("GOVERNOR_INCREASE", "1"))
+GOVERNOR_DECREASE = float(os.environ.get("GOVERNOR_DECREASE", "0.5"))
+# Attempts of a throttled or transiently failed call, across targets, and the bounds of the backoff between attempts
+# in seconds. Short, frequent retries keep the shared quota busy; long ones idle it and let messages be redelivered.
+GOVERNOR_MAX_ATTEMPTS = int(os.environ.get("GOVERNOR_MAX_ATTEMPTS", "16"))
+GOVERNOR_BASE_DELAY = float(os.environ.get("GOVERNOR_BASE_DELAY", "0.25"))
+GOVERNOR_MAX_DELAY = float(os.environ.get("GOVERNOR_MAX_DELAY", "2"))
+
+
+class ThrottledError(Exception):
+    """Raised when a model call is still throttled after its last attempt."""
+
+
+def is_throttling_error(error):
+    """Return whether an error, or an error it was raised from, is a throttling error."""
+    return any(_error_code(cause) in THROTTLING_ERRORS for cause in _error_chain(error))
+
+
+def is_transient_error(error):
+    """Return whether an error, or an error it was raised from, is a server error or a failed connection."""
+    for cause in _error_chain(error):
+        if (
+            isinstance(cause, TRANSIENT_EXCEPTIONS)
+            or _error_code(cause) in TRANSIENT_ERRORS
+        ):
+            return True
+        response = getattr(cause, "response", None)
+        if isinstance(response, dict):
+            status = response.get("ResponseMetadata", {}).get("HTTPStatusCode") or 0
+            if status >= 500:
+                return True
+    return False
+
+
+def _error_chain(error):
+    while error is not None:
+        yield error
+        # Wrappers such as langchain's Bedrock re-raise errors without keeping their type.
+        error = error.__cause__ or error.__context__
+
+
+def _error_code(error):
+    response = getattr(error, "response", None)
+    if isinstance(response, dict):
+        return response.get("Error", {}).get("Code", "").lower()
+    return None
+
+
+class AdaptiveLimiter:
+    """Concurrency limit adapted with additive increase, multiplicative decrease (AIMD).
+
+    Every successful call adds 1 / limit to the limit, so the limit grows by one after a full limit of successes.
+    A throttled call multiplies it by `decrease`, and calls failing for other reasons leave it unchanged. Calls which
+    were already running when the limit was decreased were admitted under the old limit, so their throttles don't
+    decrease it again. Limiters may share a `condition`, to wait for a slot of any of them.
+    """
+
+    def __init__(
+        self,
+        initial=GOVERNOR_INITIAL_CONCURRENCY,
+        minimum=GOVERNOR_MIN_CONCURRENCY,
+        maximum=GOVERNOR_MAX_CONCURRENCY,
+        increase=GOVERNOR_INCREASE,
+        decrease=GOVERNOR_DECREASE,
+        condition=None,
+    ):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.in_flight = 0
+        self.condition = condition or threading.Condition()
+        self._started = 0
+        self._decreased_at = 0
+
+    def acquire(self):
+        """Wait for a free slot, and return its ticket."""
+        with self.condition:
+            ticket = self.try_acquire()
+            while ticket is None:
+                self.condition.wait()
+                ticket = self.try_acquire()
+            return ticket
+
+    def try_acquire(self):
+        """Take a free slot and return its ticket, or return None if there is none."""
+        with self.condition:
+            if self.in_flight >= int(self.limit):
+                return None
+            self.in_flight += 1
+            self._started += 1
+            return self._started
+
+    def release(self, ticket, outcome="ok"):
+        """Free the slot of `ticket`, adapting the limit to the outcome of its call: "ok", "throttled" or "failed"."""
+        with self.condition:
+            self.in_flight -= 1
+            if outcome == "ok":
+                self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+            elif outcome == "throttled" and ticket > self._decreased_at:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self._decreased_at = self._started
+            self.condition.notify_all()
+
+
+class ModelCallGovernor:
+    """Runs model calls within adaptive concurrency limits, retrying throttled and transiently failed calls.
+
+    `call(function)` calls `function(target)` with the index of a target, e.g. a region and model ID, in order of
+    preference. Every target has its own `AdaptiveLimiter`, and a call goes to the first target with a free slot, so
+    fallback targets take the calls the preferred ones have no capacity for. A throttled call is retried right away
+    on another target, or after a jittered exponential backoff once every target throttled it. Calls failing with a
+    server error or a failed connection are retried the same way, but leave the concurrency limit unchanged.
+    """
+
+    def __init__(
+        self,
+        targets=1,
+        max_attempts=GOVERNOR_MAX_ATTEMPTS,
+        base_delay=GOVERNOR_BASE_DELAY,
+        max_delay=GOVERNOR_MAX_DELAY,
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        self._condition = threading.Condition()
+        self.limiters = [
+            AdaptiveLimiter(condition=self._condition) for _ in range(targets)
+        ]
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self.sleep = sleep
+        self._counts = {
+            "calls": 0,
+            "attempts": 0,
+            "throttles": 0,
+            "errors": 0,
+            "fallbacks": 0,
+        }
+
+    def call(self, function, metrics=None):
+        """Call `function(target)` until it isn't throttled or failing transiently, and return its result.
+
+        `metrics` is updated with the attempts, throttles, transient errors, seconds waited for a slot or a backoff,
+        and the target of the last attempt.
+        """
+        metrics = {} if metrics is None else metrics
+        metrics.update(
+            attempts=0, throttles=0, errors=0, queue_seconds=0.0, backoff_seconds=0.0
+        )
+        self._count("calls")
+        # Targets which throttled the call, or failed it transiently, since its last backoff.
+        throttled_targets = set()
+        for attempt in range(self.max_attempts):
+            if len(throttled_targets) == len(self.limiters):
+                # "Full jitter" spreads the retries of concurrent calls, in this and other Lambdas, over the window.
+                delay = random.uniform(
+                    0, min(self.max_delay, self.base_delay * 2**attempt)
+                )
+                logger.info(
+                    f"Model call failed on every target, retrying in {delay:.1f} s"
+                )
+                self.sleep(delay)
+                metrics["backoff_seconds"] += delay
+                throttled_targets.clear()
+            start = self.clock()
+            target, ticket = self._acquire(throttled_targets)
+            metrics["queue_seconds"] += self.clock() - start
+            metrics["target"] = target
+            metrics["attempts"] += 1
+            self._count("attempts")
+            if target:
+                self._count("fallbacks")
+            outcome = "failed"
+            try:
+                result = function(target)
+                outcome = "ok"
+                return result
+            except Exception as e:
+                if is_throttling_error(e):
+                    outcome = "throttled"
+                    metrics["throttles"] += 1
+                    self._count("throttles")
+                    logger.info(f"Model call throttled on target {target}: {e}")
+                elif is_transient_error(e):
+                    metrics["errors"] += 1
+                    self._count("errors")
+                    logger.warning(f"Model call failed on target {target}: {e!r}")
+                else:
+                    raise
+                throttled_targets.add(target)
+                if attempt == self.max_attempts - 1:
+                    if outcome != "throttled":
+                        raise
+                    raise ThrottledError(
+                        f"Model call throttled after {self.max_attempts} attempts"
+                    ) from e
+            finally:
+                self.limiters[target].release(ticket, outcome)
+
+    def stats(self):
+        """Return the counts of calls, attempts, throttles, transient errors and fallbacks, and the concurrency limit
+        of each target."""
+        with self._condition:
+            return {
+                **self._counts,
+                "limits": [limiter.limit for limiter in self.limiters],
+            }
+
+    def _acquire(self, excluded):
+        """Wait for a slot of the first target with one, leaving out the `excluded` targets. Return the target and
+        the slot's ticket."""
+        with self._condition:
+            while True:
+                for target, limiter in enumerate(self.limiters):
+                    if target not in excluded:
+                        ticket = limiter.try_acquire()
+                        if ticket is not None:
+                            return target, ticket
+                self._condition.wait()
+
+    def _count(self, name):
+        with self._condition:
+            self._counts[name] += 1
@@ -0,0 +1,101 @@
+import hashlib
+import os
+import shutil
+import threading
+
+from git import Repo
+
+from source_code import configure_repo, git_ssh_env
+from utils import get_logger
+
+logger = get_logger()
+
+# Clone options for the cache: only the latest commit, without file contents. Blobs are fetched on demand when a
+# worktree materializes the files it needs.
+CLONE_OPTIONS = ["--depth=1", "--filter=blob:none", "--no-checkout"]
+FETCH_OPTIONS = ["--depth=1", "--filter=blob:none", "--prune"]
+
+
+class RepoCache:
+    """Cache of partial clones, keyed by repo URL, reused across warm Lambda invocations.
+
+    The first use of a URL makes a shallow, blob-filtered clone; later uses refresh it with an incremental fetch.
+    Every fix gets its own sparse worktree of the cached clone, so concurrent or failed runs can't contaminate each
+    other or the cache.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def sync(self, url, ssh_private_key_path):
+        """Clone or refresh the cached repo for `url` and point its HEAD at the remote's default branch."""
+        path = self._path(url)
+        env = git_ssh_env(ssh_private_key_path)
+        with self._lock(url):
+            if os.path.isdir(path):
+                try:
+                    return self._refresh(path, env)
+                except Exception:
+                    logger.exception(f"Failed to refresh cached repo {path}, recloning")
+                    shutil.rmtree(path, ignore_errors=True)
+
+            logger.info(f"Cloning repo {url} to {path}")
+            repo = Repo.clone_from(url, path, env=env, multi_options=CLONE_OPTIONS)
+            configure_repo(repo)
+            return repo
+
+    def add_worktree(self, url, worktree_dir, ssh_private_key_path, sparse_paths):
+        """Create an isolated worktree of the cached repo which only materializes `sparse_paths`."""
+        repo = Repo(self._path(url))
+        env = git_ssh_env(ssh_private_key_path)
+        logger.info(f"Adding worktree {worktree_dir} for {len(sparse_paths)} files")
+        with self._lock(url):
+            repo.git.worktree("add", "--no-checkout", "--detach", worktree_dir, "HEAD")
+        worktree = Repo(worktree_dir)
+        with worktree.git.custom_environment(**env):
+            worktree.git.sparse_checkout("set", "--no-cone", *_anchored(sparse_paths))
+            worktree.git.checkout()
+        return worktree
+
+    def sparse_checkout_add(self, worktree, paths, ssh_private_key_path):
+        """Materialize additional paths in a sparse worktree."""
+        if not paths:
+            return
+        with worktree.git.custom_environment(**git_ssh_env(ssh_private_key_path)):
+            worktree.git.sparse_checkout("add", *_anchored(paths))
+
+    def remove_worktree(self, url, worktree_dir):
+        """Remove a worktree and its branch metadata from the cached repo."""
+        repo = Repo(self._path(url))
+        with self._lock(url):
+            try:
+                repo.git.worktree("remove", "--force", worktree_dir)
+            except Exception:
+                logger.exception(f"Failed to remove worktree {worktree_dir}")
+                shutil.rmtree(worktree_dir, ignore_errors=True)
+                repo.git.worktree("prune")
+
+    def _refresh(self, path, env):
+        logger.info(f"Refreshing cached repo {path}")
+        repo = Repo(path)
+        # Worktrees left behind by failed runs would otherwise pin their branches.
+        repo.git.worktree("prune")
+        with repo.git.custom_environment(**env):
+            repo.git.fetch("origin", *FETCH_OPTIONS)
+        repo.git.reset("--soft", "origin/HEAD")
+        return repo
+
+    def _path(self, url):
+        digest = hashlib.md5(url.encode(), usedforsecurity=False).hexdigest()
+        return os.path.join(self.cache_dir, digest)
+
+    def _lock(self, url):
+        with self._locks_lock:
+            return self._locks.setdefault(url, threading.Lock())
+
+
+def _anchored(paths):
+    """Anchor paths to the repo root, so that non-cone sparse patterns don't match same-named files elsewhere."""
+    return [f"/{path.lstrip('/')}" for path in paths]
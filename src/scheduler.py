@@ -0,0 +1,99 @@
+import time
+
+from utils import get_logger
+
+logger = get_logger()
+
+# Occurrence windows shorter than this are widened, so a burst of a few occurrences isn't ranked as an extreme rate.
+MIN_RATE_WINDOW_SECONDS = 60
+
+
+class TokenBucket:
+    """Token bucket persisted as a DynamoDB item, shared by every concurrent Lambda instance.
+
+    The bucket holds up to `capacity` tokens and refills at `refill_per_second`. Updates use optimistic concurrency
+    on a version attribute, so concurrent schedulers never grant the same token twice.
+    """
+
+    def __init__(
+        self,
+        dynamodb_client,
+        table_name,
+        name,
+        capacity,
+        refill_per_second,
+        clock=time.time,
+        max_attempts=10,
+    ):
+        self.dynamodb_client = dynamodb_client
+        self.table_name = table_name
+        self.key = {"pk": {"S": f"bucket#{name}"}, "sk": {"S": f"bucket#{name}"}}
+        self.name = name
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.clock = clock
+        self.max_attempts = max_attempts
+
+    def acquire(self, count):
+        """Take up to `count` tokens. Returns the number of tokens granted."""
+        return self._update(lambda tokens: min(count, int(tokens)))
+
+    def release(self, count):
+        """Return unused tokens to the bucket."""
+        self._update(lambda tokens: -count)
+
+    def _update(self, take):
+        for _ in range(self.max_attempts):
+            tokens, version = self._refilled_tokens()
+            taken = take(tokens)
+            item = {
+                **self.key,
+                "tokens": {"N": str(min(self.capacity, tokens - taken))},
+                "updated_at": {"N": str(self.clock())},
+                "version": {"N": str(version + 1)},
+            }
+            try:
+                if version:
+                    self.dynamodb_client.put_item(
+                        TableName=self.table_name,
+                        Item=item,
+                        ConditionExpression="version = :version",
+                        ExpressionAttributeValues={":version": {"N": str(version)}},
+                    )
+                else:
+                    self.dynamodb_client.put_item(
+                        TableName=self.table_name,
+                        Item=item,
+                        ConditionExpression="attribute_not_exists(pk)",
+                    )
+                return taken
+            except self.dynamodb_client.exceptions.ConditionalCheckFailedException:
+                logger.info(f"Token bucket {self.name} updated concurrently, retrying")
+        raise Exception(
+            f"Failed to update token bucket {self.name} after {self.max_attempts} attempts"
+        )
+
+    def _refilled_tokens(self):
+        response = self.dynamodb_client.get_item(
+            TableName=self.table_name, Key=self.key, ConsistentRead=True
+        )
+        item = response.get("Item")
+        if not item:
+            return self.capacity, 0
+        elapsed = max(0, self.clock() - float(item["updated_at"]["N"]))
+        tokens = float(item["tokens"]["N"]) + elapsed * self.refill_per_second
+        return min(self.capacity, tokens), int(item["version"]["N"])
+
+
+def occurrence_rate(issue):
+    """Return the occurrences per minute of an issue item from the issue table."""
+    occurrences = int(issue.get("occurrences", {}).get("N", "1"))
+    first_seen = int(issue.get("first_seen", {}).get("N", "0"))
+    last_seen = int(issue.get("last_seen", {}).get("N", "0"))
+    window = max((last_seen - first_seen) / 1000, MIN_RATE_WINDOW_SECONDS)
+    return occurrences / window * 60
+
+
+def priority(issue):
+    """Sort key ordering issue items by descending occurrence rate, oldest first on ties."""
+    return -occurrence_rate(issue), int(issue.get("first_seen", {}).get("N", "0"))
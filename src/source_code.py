@@ -1,94 +1,415 @@
 import os
+import random
+import re
+import threading
+import time
 from abc import ABC, abstractmethod
 
-import requests
-from black import FileMode, format_str
-from git import Repo
-
+from formatting import changed_files
 from utils import get_logger
 
 logger = get_logger()
 
+FILE_MODE = 0o100644
+TREE_MODE = 0o040000
+
+# Retries of throttled or failed GitHub requests, and the longest wait for a retry, in seconds. Longer waits fail the
+# request, so that the message is retried later.
+GITHUB_MAX_RETRIES = int(os.environ.get("GITHUB_MAX_RETRIES", "4"))
+GITHUB_MAX_WAIT = float(os.environ.get("GITHUB_MAX_WAIT", "60"))
+# Seconds of the first backoff after a server error or a secondary rate limit without a Retry-After header.
+GITHUB_BACKOFF = float(os.environ.get("GITHUB_BACKOFF", "1"))
+# Seconds between requests creating content. GitHub's secondary rate limits penalize bursts of them.
+GITHUB_WRITE_INTERVAL = float(os.environ.get("GITHUB_WRITE_INTERVAL", "1"))
+# Seconds pull requests created by this provider are indexed for, even though the listing doesn't show them yet.
+GITHUB_LISTING_LAG = float(os.environ.get("GITHUB_LISTING_LAG", "60"))
+GITHUB_POOL_SIZE = int(os.environ.get("GITHUB_POOL_SIZE", "10"))
+# Pull request descriptions carry the key of the issue they fix, hidden in an HTML comment.
+ISSUE_KEY_MARKER = "<!-- fix-code-issue: {} -->"
+ISSUE_KEY_PATTERN = re.compile(r"<!-- fix-code-issue: ([0-9a-f]+) -->")
+
+# Providers survive across warm invocations, so their connection pools, default branch and pull request index are
+# reused.
+_git_providers = {}
+_git_providers_lock = threading.Lock()
+
+# GitPython and requests are imported where they are used, so they don't add to the cold start of functions
+# which import this module without needing them.
+
 
 def clone_repo(url, repo_dir, ssh_private_key_path):
     """Clone the target repo to the local file system."""
+    from git import Repo
+
     logger.info(f"Cloning repo {url} to {repo_dir}")
-    repo = Repo.clone_from(
-        url,
-        repo_dir,
-        env={
-            "GIT_SSH_COMMAND": f"ssh -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no -i {ssh_private_key_path}"
-        },
-    )
+    repo = Repo.clone_from(url, repo_dir, env=git_ssh_env(ssh_private_key_path))
+    configure_repo(repo)
+    return repo
+
+
+def git_ssh_env(ssh_private_key_path):
+    """Environment variables for git to authenticate with the SSH private key."""
+    return {
+        "GIT_SSH_COMMAND": f"ssh -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no -i {ssh_private_key_path}"
+    }
+
+
+def configure_repo(repo):
+    """Set the identity used to commit fixes."""
     repo.config_writer().set_value("user", "name", "fix-code-bot").release()
     repo.config_writer().set_value("user", "email", "fix@code.bot").release()
-    return repo
 
 
 def update_source_code(files, repo_dir, format_code=True):
-    """Overwrite files in target repo."""
+    """Overwrite files in target repo, formatting them by file type. Only files which change are written, and they
+    are returned."""
     logger.info(f"Updating source code in {repo_dir}")
+    files = changed_files(files, repo_dir, format_code)
     for file in files:
-        if format_code:
-            contents = format(file["contents"])
-        with open(os.path.join(repo_dir, file["filename"]), "w") as f:
+        file_path = os.path.join(repo_dir, file["filename"])
+        # Sparse worktrees only contain the directories of the files which were checked out.
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "w") as f:
             logger.info(f'Writing to {file["filename"]}')
-            f.write(contents)
+            f.write(file["contents"])
+    return files
 
 
-def format(content):
-    """Format code."""
-    return format_str(content, mode=FileMode())
+def create_branch(branch_name, repo, commit_message, filenames, ssh_private_key_path):
+    """Commit the changed files on top of HEAD and push the commit to a new branch of the remote.
 
+    Return True if a branch was pushed, or None if the files don't change HEAD.
+    """
+    commit = commit_files(repo, filenames, commit_message)
+    if commit is None:
+        return None
+    logger.info(f"Pushing {commit.hexsha} to branch {branch_name}")
+    with repo.git.custom_environment(**git_ssh_env(ssh_private_key_path)):
+        repo.git.push("origin", f"{commit.hexsha}:refs/heads/{branch_name}")
+    return True
 
-def create_branch(branch_name, repo, commit_message):
-    """Check for any changes to the source code and create a branch."""
-    if repo.index.diff(None):
-        logger.info(
-            f"Source code has been modified, committing changes to branch {branch_name}"
-        )
-        new_branch = repo.create_head(branch_name)
-        new_branch.checkout()
-        repo.git.add(A=True)
-        repo.git.commit(m=commit_message)
-        logger.info(f"Pushing branch {branch_name}")
-        repo.git.push("origin", branch_name)
-        return True
+
+def commit_files(repo, filenames, message, parent="HEAD"):
+    """Write a commit of the working tree files `filenames` on top of `parent`, without touching the index or the
+    working tree. Return the commit, or None if the files don't change the parent's tree.
+
+    Only the blobs of the files and the trees on their paths are written, and every other entry is reused from the
+    parent's tree, so the cost depends on the number of files changed rather than the size of the repo.
+    """
+    from git import Commit
+
+    if not filenames:
+        return None
+    parent = repo.commit(parent)
+    # hash-object applies the .gitattributes filters of each path, as `git add` does.
+    hexshas = repo.git.hash_object("-w", "--", *filenames).split()
+    changes = {}
+    for filename, hexsha in zip(filenames, hexshas):
+        *directories, name = filename.strip("/").split("/")
+        tree_changes = changes
+        for directory in directories:
+            tree_changes = tree_changes.setdefault(directory, {})
+        tree_changes[name] = bytes.fromhex(hexsha)
+    binsha = _write_tree(repo, parent.tree.binsha, changes)
+    if binsha == parent.tree.binsha:
+        return None
+    logger.info(f"Committing {len(filenames)} files on top of {parent.hexsha}")
+    return Commit.create_from_tree(
+        repo, binsha.hex(), message, parent_commits=[parent], head=False
+    )
+
+
+def _write_tree(repo, binsha, changes):
+    """Write a copy of the tree `binsha` (None for a new tree) with the blobs or subtrees of `changes` replaced, and
+    return its binsha. `changes` maps names to blob binshas, or to the changes of a subtree.
+    """
+    from io import BytesIO
+
+    from git.objects.fun import tree_entries_from_data, tree_to_stream
+    from gitdb import IStream
+
+    entries = {}
+    if binsha is not None:
+        data = repo.odb.stream(binsha).read()
+        entries = {
+            name: (sha, mode) for sha, mode, name in tree_entries_from_data(data)
+        }
+    for name, change in changes.items():
+        if isinstance(change, dict):
+            sha, mode = entries.get(name, (None, TREE_MODE))
+            entries[name] = (
+                _write_tree(repo, sha if mode == TREE_MODE else None, change),
+                TREE_MODE,
+            )
+        else:
+            # Files keep their mode, i.e. their executable bit.
+            _, mode = entries.get(name, (None, FILE_MODE))
+            entries[name] = (change, mode if mode != TREE_MODE else FILE_MODE)
+    # Git orders the entries of a tree by name, as if the names of subtrees ended with "/".
+    stream = BytesIO()
+    tree_to_stream(
+        [
+            (sha, mode, name)
+            for name, (sha, mode) in sorted(
+                entries.items(),
+                key=lambda item: item[0].encode()
+                + (b"/" if item[1][1] == TREE_MODE else b""),
+            )
+        ],
+        stream.write,
+    )
+    size = stream.tell()
+    stream.seek(0)
+    return repo.odb.store(IStream("tree", size, stream)).binsha
 
 
 class GitProvider(ABC):
     @abstractmethod
-    def create_pull_request(branch_name):
+    def find_pull_request(self, issue_key, refresh=True):
         pass
 
+    @abstractmethod
+    def create_pull_request(
+        self, branch, title, description, issue_key=None, refresh=True
+    ):
+        pass
+
+
+class GitHubError(Exception):
+    """Raised when the GitHub API rejects a request, or keeps throttling it."""
+
 
 class GitHubProvider(GitProvider):
     """GitHub provider.
 
-    Interacts with the GitHub API to perform git operations.
+    Interacts with the GitHub API to perform git operations. The provider keeps a pool of keep-alive connections
+    and is meant to be reused across warm invocations, see `get_git_provider`.
+
+    Throttled requests are retried after the wait GitHub asks for through its Retry-After and X-RateLimit-* headers,
+    and requests are held back while the primary rate limit is exhausted. Pull requests are created one at a time,
+    GITHUB_WRITE_INTERVAL seconds apart, as GitHub recommends to stay under its secondary rate limits.
+
+    Every pull request is tagged with the key of the issue it fixes. Open pull requests are indexed by that key, so
+    an issue which already has an open fix doesn't get another.
     """
 
-    def __init__(self, api_key, repo_url):
+    def __init__(
+        self,
+        api_key,
+        repo_url,
+        max_retries=GITHUB_MAX_RETRIES,
+        max_wait=GITHUB_MAX_WAIT,
+        write_interval=GITHUB_WRITE_INTERVAL,
+        clock=time.time,
+        sleep=time.sleep,
+    ):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.repo_url = repo_url
         self.url = f"{repo_url}/pulls"
         self.api_key = api_key
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self.write_interval = write_interval
+        self.clock = clock
+        self.sleep = sleep
         self.headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Accept": "application/vnd.github+json",
             "X-GitHub-Api-Version": "2022-11-28",
         }
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        # Retries are driven by the rate limit headers below, rather than by urllib3.
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=GITHUB_POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._default_branch = None
+        # Open pull requests by issue key, as listed and including the ones just created, and the ETag of the
+        # listing.
+        self._listed_pull_requests = {}
+        self._pull_requests = {}
+        self._pull_requests_etag = None
+        self._created = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._issue_locks = {}
+        self._last_write = 0
+        self._blocked_until = 0
+
+    @property
+    def default_branch(self):
+        """The repo's default branch, which pull requests target. Retrieved once, without holding the lock."""
+        with self._lock:
+            default_branch = self._default_branch
+        if default_branch is None:
+            default_branch = self._request("GET", self.repo_url).json()[
+                "default_branch"
+            ]
+            with self._lock:
+                self._default_branch = default_branch
+        return default_branch
+
+    def open_pull_requests(self):
+        """Refresh and return the open pull requests by issue key.
 
-    def create_pull_request(self, branch, title, description):
-        """Create a new pull request for a target branch"""
+        The listing is a conditional request, which GitHub doesn't count against the rate limit when nothing
+        changed. The ETag only covers the first page, so listings spanning several pages are always read in full.
+        The requests are sent without holding the lock, which is only taken to swap in the new index.
+        """
+        with self._lock:
+            etag = self._pull_requests_etag
+        headers = {"If-None-Match": etag} if etag else {}
+        url = self.url
+        params = {"state": "open", "per_page": 100}
+        response = self._request("GET", url, params=params, headers=headers)
+        listed = None
+        if response.status_code != 304:
+            etag = response.headers.get("ETag")
+            listed = {}
+            while True:
+                for pull_request in response.json():
+                    issue_key = parse_issue_key(pull_request.get("body"))
+                    if issue_key:
+                        listed.setdefault(issue_key, pull_request)
+                url = response.links.get("next", {}).get("url")
+                if not url:
+                    break
+                etag = None
+                response = self._request("GET", url)
+        with self._lock:
+            if listed is not None:
+                self._listed_pull_requests = listed
+                self._pull_requests_etag = etag
+            pull_requests = dict(self._listed_pull_requests)
+            # Listings can lag behind pull requests which were just created.
+            self._created = {
+                issue_key: (created, pull_request)
+                for issue_key, (created, pull_request) in self._created.items()
+                if self.clock() - created < GITHUB_LISTING_LAG
+            }
+            for issue_key, (_, pull_request) in self._created.items():
+                pull_requests.setdefault(issue_key, pull_request)
+            self._pull_requests = pull_requests
+        logger.info(f"Indexed {len(pull_requests)} open fix pull requests")
+        return dict(pull_requests)
+
+    def find_pull_request(self, issue_key, refresh=True):
+        """Return the open pull request fixing the issue, or None. Without `refresh`, only the index is read."""
+        if refresh:
+            return self.open_pull_requests().get(issue_key)
+        with self._lock:
+            return self._pull_requests.get(issue_key)
+
+    def create_pull_request(
+        self, branch, title, description, issue_key=None, refresh=True
+    ):
+        """Create a new pull request for a target branch, and return it.
+
+        If a pull request for the same issue is already open, it is returned instead. Without `refresh`, open pull
+        requests are looked up in the index, along with the ones created since it was refreshed.
+        """
+        if issue_key is None:
+            return self._create_pull_request(branch, title, description)
+        # Concurrent fixes of the same issue are serialized, so only the first one opens a pull request.
+        with self._lock:
+            issue_lock = self._issue_locks.setdefault(issue_key, threading.Lock())
+        with issue_lock:
+            pull_request = self.find_pull_request(issue_key, refresh)
+            if pull_request:
+                logger.info(
+                    f"Pull request {pull_request['html_url']} already fixes issue {issue_key}, "
+                    f"not creating another from {branch}"
+                )
+                return pull_request
+            pull_request = self._create_pull_request(
+                branch, title, f"{description}\n\n{ISSUE_KEY_MARKER.format(issue_key)}"
+            )
+            with self._lock:
+                self._pull_requests[issue_key] = pull_request
+                self._created[issue_key] = (self.clock(), pull_request)
+            return pull_request
+
+    def _create_pull_request(self, branch, title, description):
         data = {
             "title": title,
             "body": description,
             "head": branch,
-            "base": "main",
+            "base": self.default_branch,
         }
+        with self._write_lock:
+            self.sleep(max(0, self._last_write + self.write_interval - self.clock()))
+            try:
+                response = self._request("POST", self.url, json=data)
+            finally:
+                self._last_write = self.clock()
+        pull_request = response.json()
+        logger.info(f"Pull request created ({pull_request['html_url']})")
+        return pull_request
 
-        response = requests.post(self.url, json=data, headers=self.headers, timeout=30)
+    def _request(self, method, url, **kwargs):
+        """Send a request, retrying it while it is throttled or fails on the server."""
+        for attempt in range(self.max_retries + 1):
+            wait = self._blocked_until - self.clock()
+            if wait > 0:
+                self._wait(wait, "the rate limit resets")
+            response = self.session.request(method, url, timeout=30, **kwargs)
+            self._track_rate_limit(response)
+            if response.status_code < 400:
+                return response
+            wait = self._retry_wait(response, attempt)
+            if wait is None or attempt == self.max_retries:
+                break
+            self._wait(wait, f"{method} {url} returned {response.status_code}")
+        raise GitHubError(
+            f"{method} {url} failed with status {response.status_code}: {response.text:.500}"
+        )
 
-        if response.status_code == 201:
-            logger.info(f"Pull request created ({response.json()['html_url']})")
-        else:
-            logger.info(f"Failed to create pull request with error: {response.text}")
+    def _track_rate_limit(self, response):
+        """Hold back requests until the reset when the primary rate limit is exhausted."""
+        if response.headers.get("X-RateLimit-Remaining") == "0":
+            reset = int(response.headers.get("X-RateLimit-Reset", 0))
+            self._blocked_until = max(self._blocked_until, reset)
+
+    def _retry_wait(self, response, attempt):
+        """Return the seconds to wait before retrying a failed request, or None if it shouldn't be retried."""
+        retry_after = response.headers.get("Retry-After")
+        if retry_after is not None:
+            return float(retry_after)
+        if response.status_code in (403, 429):
+            if response.headers.get("X-RateLimit-Remaining") == "0":
+                return int(response.headers.get("X-RateLimit-Reset", 0)) - self.clock()
+            # Secondary rate limits without a Retry-After header are retried with an exponential backoff.
+            if "rate limit" in response.text.lower():
+                return GITHUB_BACKOFF * 2**attempt
+            return None
+        if response.status_code >= 500:
+            return GITHUB_BACKOFF * 2**attempt
+        return None
+
+    def _wait(self, seconds, reason):
+        if seconds > self.max_wait:
+            raise GitHubError(
+                f"Throttled by GitHub for {seconds:.0f} s until {reason}, more than {self.max_wait} s"
+            )
+        # Jitter spreads the retries of concurrent requests.
+        seconds = max(0, seconds) * random.uniform(1, 1.25)
+        logger.info(f"Waiting {seconds:.1f} s until {reason}")
+        self.sleep(seconds)
+
+
+def parse_issue_key(description):
+    """Return the issue key tagged in a pull request description, or None."""
+    match = ISSUE_KEY_PATTERN.search(description or "")
+    return match.group(1) if match else None
+
+
+def get_git_provider(api_key, repo_url):
+    """Return the GitHub provider of a repo, created on first use and reused afterwards."""
+    key = (api_key, repo_url)
+    with _git_providers_lock:
+        provider = _git_providers.get(key)
+        if provider is None:
+            provider = _git_providers[key] = GitHubProvider(api_key, repo_url)
+    return provider
@@ -0,0 +1,253 @@
+import ast
+import os
+import re
+
+from providers import CHARS_PER_TOKEN
+from utils import get_logger
+
+logger = get_logger()
+
+DEFAULT_TOKEN_BUDGET = 20000
+# Lines kept above and below a frame when its enclosing definition can't be found.
+DEFAULT_LINE_WINDOW = 20
+
+# Lines left out of an excerpt are replaced by a marker, which the model is asked to keep in place so the omitted
+# lines can be restored in the files it returns.
+OMITTED_MARKER = "[[omitted lines {start}-{end}]]\n"
+OMITTED_PATTERN = re.compile(r"^\s*\[\[omitted lines (\d+)-(\d+)\]\]\s*$")
+# Shorter runs of lines are kept rather than replaced by a marker.
+MIN_OMITTED_LINES = 3
+
+DEFINITION_NODES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+
+
+def estimate_tokens(text):
+    """Estimate the number of tokens of a text."""
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+class SourceExcerpt:
+    """The lines of a source file shown to the model: the whole file, or the ranges relevant to the frames in it."""
+
+    def __init__(self, filename, source, ranges=None):
+        self.filename = filename
+        self.lines = source.splitlines(keepends=True)
+        # Sorted, non-overlapping (start, end) line ranges, 1-based and inclusive. None keeps the whole file.
+        self.ranges = (
+            _merge_ranges(ranges, len(self.lines)) if ranges is not None else None
+        )
+        self.text = self._render()
+        self.tokens = estimate_tokens(self.text)
+
+    @property
+    def is_complete(self):
+        return self.ranges is None
+
+    def expand(self, contents):
+        """Restore the omitted lines in the contents the model returned for this excerpt."""
+        if self.is_complete:
+            return contents
+        expected = self._omitted_ranges()
+        restored = []
+        found = []
+        for line in contents.splitlines(keepends=True):
+            match = OMITTED_PATTERN.match(line)
+            if match:
+                start, end = int(match.group(1)), int(match.group(2))
+                found.append((start, end))
+                restored.extend(self.lines[start - 1 : end])
+            else:
+                restored.append(line)
+        if found != expected:
+            raise ValueError(
+                f"Omitted line markers of {self.filename} were changed: expected {expected}, got {found}"
+            )
+        return "".join(restored)
+
+    def _render(self):
+        if self.is_complete:
+            return "".join(self.lines)
+        parts = []
+        previous_end = 0
+        for start, end in self.ranges:
+            if start > previous_end + 1:
+                parts.append(
+                    OMITTED_MARKER.format(start=previous_end + 1, end=start - 1)
+                )
+            parts.extend(self.lines[start - 1 : end])
+            previous_end = end
+        if previous_end < len(self.lines):
+            parts.append(
+                OMITTED_MARKER.format(start=previous_end + 1, end=len(self.lines))
+            )
+        return "".join(parts)
+
+    def _omitted_ranges(self):
+        omitted = []
+        previous_end = 0
+        for start, end in self.ranges + [(len(self.lines) + 1, None)]:
+            if start > previous_end + 1:
+                omitted.append((previous_end + 1, start - 1))
+            previous_end = end
+        return omitted
+
+
+def build_source_context(
+    repo_dir,
+    file_frames,
+    token_budget=DEFAULT_TOKEN_BUDGET,
+    line_window=DEFAULT_LINE_WINDOW,
+):
+    """Select the source shown to the model for the files of a stack trace, within a token budget.
+
+    `file_frames` maps repo paths to the frames resolved to them, with the file of the innermost frame first. Each
+    file gets an excerpt of the code around its frames, in order, while the budget allows. The remaining budget then
+    upgrades excerpts to whole files, in the same order. Returns a dict of filenames to `SourceExcerpt`.
+    """
+    sources = {}
+    for filename in file_frames:
+        with open(os.path.join(repo_dir, filename), "r") as f:
+            sources[filename] = f.read()
+
+    excerpts = {}
+    remaining = token_budget
+    for filename, frames in file_frames.items():
+        lines = [frame.line for frame in frames]
+        candidates = [
+            SourceExcerpt(
+                filename,
+                sources[filename],
+                focus_ranges(sources[filename], filename, lines, line_window),
+            ),
+            SourceExcerpt(
+                filename, sources[filename], window_ranges(lines, line_window)
+            ),
+        ]
+        excerpt = next((c for c in candidates if c.tokens <= remaining), None)
+        if excerpt is None:
+            logger.info(f"Leaving {filename} out of the prompt, over the token budget")
+            continue
+        excerpts[filename] = excerpt
+        remaining -= excerpt.tokens
+
+    for filename, excerpt in excerpts.items():
+        if excerpt.is_complete:
+            continue
+        complete = SourceExcerpt(filename, sources[filename])
+        if complete.tokens - excerpt.tokens <= remaining:
+            excerpts[filename] = complete
+            remaining -= complete.tokens - excerpt.tokens
+
+    logger.info(
+        f"Source context of {len(excerpts)} files uses {token_budget - remaining} of {token_budget} tokens: "
+        f"{[(filename, excerpt.is_complete) for filename, excerpt in excerpts.items()]}"
+    )
+    return excerpts
+
+
+def focus_ranges(source, filename, lines, line_window=DEFAULT_LINE_WINDOW):
+    """Line ranges of a file relevant to frames on `lines`.
+
+    For Python, these are the functions or classes enclosing the frames, the module's imports and the signatures
+    or assignments of module level names they reference. Other languages, and code which doesn't parse, fall back
+    to a window of lines around each frame.
+    """
+    if not filename.endswith(".py"):
+        return window_ranges(lines, line_window)
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return window_ranges(lines, line_window)
+
+    ranges = []
+    focused = []
+    for line in lines:
+        path = _enclosing_definitions(tree, line)
+        if not path:
+            ranges.extend(window_ranges([line], line_window))
+            continue
+        # The innermost definition in full, and the headers of the classes or functions enclosing it.
+        for node in path[:-1]:
+            ranges.append(_header_range(node))
+        ranges.append(_node_range(path[-1]))
+        focused.append(path[-1])
+
+    referenced = {
+        node.id
+        for definition in focused
+        for node in ast.walk(definition)
+        if isinstance(node, ast.Name)
+    }
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            ranges.append(_node_range(node))
+        elif isinstance(node, DEFINITION_NODES) and node.name in referenced:
+            ranges.append(_header_range(node))
+        elif referenced.intersection(_assigned_names(node)):
+            ranges.append(_node_range(node))
+    return ranges
+
+
+def window_ranges(lines, line_window=DEFAULT_LINE_WINDOW):
+    """Line ranges of `line_window` lines around each line."""
+    return [(max(1, line - line_window), line + line_window) for line in lines]
+
+
+def _enclosing_definitions(tree, line):
+    """The definitions enclosing a line, outermost first."""
+    path = []
+    body = tree.body
+    while True:
+        node = next(
+            (
+                node
+                for node in body
+                if isinstance(node, DEFINITION_NODES)
+                and _node_range(node)[0] <= line <= node.end_lineno
+            ),
+            None,
+        )
+        if node is None:
+            return path
+        path.append(node)
+        body = node.body
+
+
+def _assigned_names(node):
+    if isinstance(node, ast.Assign):
+        targets = node.targets
+    elif isinstance(node, ast.AnnAssign):
+        targets = [node.target]
+    else:
+        return []
+    return [target.id for target in targets if isinstance(target, ast.Name)]
+
+
+def _node_range(node):
+    decorators = getattr(node, "decorator_list", [])
+    start = min([node.lineno] + [decorator.lineno for decorator in decorators])
+    return start, node.end_lineno
+
+
+def _header_range(node):
+    """The decorators and signature of a definition, up to its docstring or first statement."""
+    start, _ = _node_range(node)
+    return start, max(node.body[0].lineno - 1, node.lineno)
+
+
+def _merge_ranges(ranges, line_count):
+    """Sort and merge ranges, also merging across gaps too short to be worth a marker."""
+    merged = []
+    for start, end in sorted(ranges):
+        start, end = max(1, start), min(end, line_count)
+        if start > end:
+            continue
+        if start <= MIN_OMITTED_LINES:
+            start = 1
+        if end > line_count - MIN_OMITTED_LINES:
+            end = line_count
+        if merged and start <= merged[-1][1] + MIN_OMITTED_LINES:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
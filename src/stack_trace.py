@@ -0,0 +1,167 @@
+import re
+from collections import namedtuple
+
+Frame = namedtuple(
+    "Frame", ["path", "line", "column", "function", "is_library", "language"]
+)
+
+# A language's `pattern` uses the named groups `path`, `line` and optionally `column` and `function`.
+# `library_paths` are path substrings and `library_functions` function name prefixes marking a frame as runtime or
+# third party code. `normalize` optionally rewrites the parsed groups (i.e. to derive a file path from a Java class).
+Language = namedtuple(
+    "Language",
+    ["name", "pattern", "library_paths", "library_functions", "normalize"],
+    defaults=((), (), None),
+)
+
+GROUP_NAMES = ("path", "line", "column", "function")
+# Python prints the most recent call last, the other runtimes print it first.
+MOST_RECENT_CALL_LAST = ("python",)
+COMMON_LIBRARY_PATHS = (
+    "/site-packages/",
+    "/dist-packages/",
+    "/lib/python3",
+    "/var/runtime/",
+    "/var/lang/",
+    "/node_modules/",
+    "node:internal/",
+    "<frozen ",
+    "<string>",
+)
+
+
+def _java_path(groups):
+    """Java frames only name the file, so prefix it with the package directories of the class."""
+    # Drop the module name of JDK 9+ frames (i.e. `java.base/java.lang.Thread.run`).
+    qualified_name = groups["function"].rpartition("/")[2]
+    package, _, _ = qualified_name.rpartition(".")
+    package, _, _ = package.rpartition(".")
+    if package:
+        groups["path"] = f"{package.replace('.', '/')}/{groups['path']}"
+    return groups
+
+
+DEFAULT_LANGUAGES = (
+    Language(
+        "python",
+        r'File "(?P<path>[^"\n]+)", line (?P<line>\d+)(?:, in (?P<function>[^\s]+))?',
+    ),
+    # at Namespace.Class.Method(String arg) in C:\src\File.cs:line 42
+    Language(
+        "dotnet",
+        r"at (?P<function>[\w.`<>$|\[\],]+)\([^\n)]*\) in (?P<path>[^\n]+?):line (?P<line>\d+)",
+        library_functions=("System.", "Microsoft."),
+    ),
+    # at com.example.Service.handle(Service.java:42)
+    Language(
+        "java",
+        r"at (?P<function>[\w$.<>/]+)\((?P<path>[\w$-]+\.(?:java|kt|kts|scala|groovy)):(?P<line>\d+)\)",
+        library_functions=(
+            "java.",
+            "javax.",
+            "jdk.",
+            "sun.",
+            "kotlin.",
+            "kotlinx.",
+            "scala.",
+        ),
+        normalize=_java_path,
+    ),
+    # at handler (file:///var/task/index.mjs:10:5), at async Promise.all (index 0), at /var/task/index.js:10:5
+    Language(
+        "node",
+        r"at (?:async )?(?:(?P<function>[^\n()]+?) \()?(?:file://)?"
+        r"(?P<path>(?:node:|[A-Za-z]:)?[^\s():]+):(?P<line>\d+):(?P<column>\d+)\)?",
+    ),
+    # main.handler(0x1, 0x2)\n\t/app/main.go:12 +0x1d
+    Language(
+        "go",
+        r"^(?P<function>[\w./*()$-]+)\([^\n]*\)\n\t(?P<path>[^\s:]+\.go):(?P<line>\d+)",
+        library_paths=("/usr/local/go/src/", "/go/pkg/mod/"),
+        library_functions=("runtime.",),
+    ),
+    # /app/models/user.rb:42:in `save' (and 'User#save' since Ruby 3.4)
+    Language(
+        "ruby",
+        r"(?P<path>[^\s:'\"`]+\.rb):(?P<line>\d+):in [`'](?P<function>[^'\n]+)'",
+        library_paths=("/gems/", "/lib/ruby/", "<internal:"),
+    ),
+)
+
+
+class FrameParser:
+    """Single-pass parser of stack frames from traces in any of the configured languages.
+
+    The language patterns are compiled into one alternation, so a trace is scanned once whatever the number of
+    languages. Each language is wrapped in a group named after it, which is the last group closed on a match.
+    Patterns must match from the start of a line or the first character after whitespace.
+    """
+
+    def __init__(self, languages=DEFAULT_LANGUAGES):
+        self.languages = {language.name: language for language in languages}
+        self._group_names = {}
+        self._library_paths = {}
+        for language in languages:
+            names = [name for name in GROUP_NAMES if f"(?P<{name}>" in language.pattern]
+            self._group_names[language.name] = (
+                names,
+                [f"{language.name}_{name}" for name in names],
+            )
+            markers = COMMON_LIBRARY_PATHS + tuple(language.library_paths)
+            self._library_paths[language.name] = re.compile(
+                "|".join(re.escape(marker) for marker in markers)
+            )
+        pattern = "|".join(
+            f"(?P<{language.name}>{_prefix_groups(language.pattern, language.name)})"
+            for language in languages
+        )
+        # Frames start a line or follow whitespace in every supported language. Checking that first rejects most
+        # positions of a trace without trying each language.
+        self._pattern = re.compile(f"(?<!\\S)(?:{pattern})", re.MULTILINE)
+
+    def parse(self, trace):
+        """Return the frames of a trace, in the order they appear."""
+        frames = []
+        for match in self._pattern.finditer(trace):
+            language = self.languages[match.lastgroup]
+            names, group_names = self._group_names[language.name]
+            groups = dict(zip(names, match.group(*group_names)))
+            if language.normalize:
+                groups = language.normalize(groups)
+            path = groups["path"]
+            function = groups.get("function")
+            column = groups.get("column")
+            is_library = self._library_paths[language.name].search(path) is not None
+            frames.append(
+                Frame(
+                    path=path,
+                    line=int(groups["line"]),
+                    column=int(column) if column else None,
+                    function=function.strip() if function else None,
+                    is_library=is_library
+                    or bool(
+                        function and function.startswith(language.library_functions)
+                    ),
+                    language=language.name,
+                )
+            )
+        return frames
+
+
+def _prefix_groups(pattern, prefix):
+    return re.sub(r"\(\?P<(\w+)>", rf"(?P<{prefix}_\1>", pattern)
+
+
+_default_parser = FrameParser()
+
+
+def parse_frames(trace):
+    """Parse the frames of a trace with the default languages."""
+    return _default_parser.parse(trace)
+
+
+def innermost_first(frames):
+    """Order frames from the call which raised the error outwards."""
+    if frames and frames[-1].language in MOST_RECENT_CALL_LAST:
+        return frames[::-1]
+    return frames
@@ -0,0 +1,102 @@
+import contextvars
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from instrumentation import current_metrics
+from utils import get_logger
+
+logger = get_logger()
+
+Stage = namedtuple("Stage", ["name", "function", "dependencies"])
+
+
+class StageGraph:
+    """Graph of stages, each started as soon as the stages it depends on have completed.
+
+    A stage's function is called with the results of its dependencies as keyword arguments named after them, so
+    independent stages overlap on a thread pool of `max_workers`. With a single worker, stages run one at a time in
+    the order they were added. Every stage is timed; `timings` maps stage names to their duration in seconds. The
+    timings are also put in the current metrics, prefixed with `metrics_prefix`. Stages run in a copy of the context
+    the graph is run in.
+    """
+
+    def __init__(self, name, max_workers=4, metrics_prefix=""):
+        self.name = name
+        self.max_workers = max_workers
+        self.metrics_prefix = metrics_prefix
+        self.stages = {}
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, function, *dependencies):
+        """Add a stage running `function` after the stages named in `dependencies`."""
+        for dependency in dependencies:
+            if dependency not in self.stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {dependency}")
+        self.stages[name] = Stage(name, function, dependencies)
+        return self
+
+    def run(self):
+        """Run every stage and return a dict of their results.
+
+        When a stage raises, no further stages are started, and the exception is raised once the running stages
+        have completed.
+        """
+        results = {}
+        pending = dict(self.stages)
+        running = {}
+        error = None
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                if error is None:
+                    for stage in list(pending.values()):
+                        if len(running) >= self.max_workers:
+                            break
+                        if all(
+                            dependency in results for dependency in stage.dependencies
+                        ):
+                            del pending[stage.name]
+                            kwargs = {
+                                dependency: results[dependency]
+                                for dependency in stage.dependencies
+                            }
+                            running[
+                                executor.submit(
+                                    contextvars.copy_context().run,
+                                    self._run_stage,
+                                    stage,
+                                    kwargs,
+                                )
+                            ] = stage
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    try:
+                        results[stage.name] = future.result()
+                    except Exception as e:
+                        error = error or e
+        self.timings["total"] = time.perf_counter() - start
+        timings = ", ".join(
+            f"{name} {duration:.3f} s" for name, duration in self.timings.items()
+        )
+        logger.info(f"Stage timings of {self.name}: {timings}")
+        metrics = current_metrics()
+        if metrics:
+            for name, duration in self.timings.items():
+                metrics.put_duration(f"{self.metrics_prefix}{name}", duration)
+        if error is not None:
+            raise error
+        return results
+
+    def _run_stage(self, stage, kwargs):
+        start = time.perf_counter()
+        try:
+            return stage.function(**kwargs)
+        finally:
+            with self._lock:
+                self.timings[stage.name] = time.perf_counter() - start
@@ -1,4 +1,6 @@
 import logging
+import threading
+import time
 
 import boto3
 
@@ -14,12 +16,15 @@ def get_logger():
     return logging.getLogger()
 
 
-def get_config(parameter_store_prefix, parameter_names):
+logger = get_logger()
+
+
+def get_config(parameter_store_prefix, parameter_names, ssm_client=None):
     """Build a config object from parameter store values.
 
     Withdraw the prefix value from the returned config object.
     """
-    ssm = boto3.client("ssm")
+    ssm = ssm_client or boto3.client("ssm")
     prefixed_parameter_names = [
         f"{parameter_store_prefix}{parameter_name}"
         for parameter_name in parameter_names
@@ -35,3 +40,74 @@ def get_config(parameter_store_prefix, parameter_names):
         config[config_item_name] = param["Value"]
 
     return config
+
+
+class ConfigCache:
+    """Config from parameter store, cached across warm Lambda invocations.
+
+    A config younger than `ttl` seconds is returned as is. Past that, it is refreshed by the next `get` before
+    returning: Lambda freezes the execution environment between invocations, so a refresh in the background would
+    stall. Up to `max_stale` seconds past `ttl`, concurrent calls get the stale config while one of them refreshes it,
+    and a failed refresh keeps it. Call `invalidate` when the config is known to be outdated, e.g. after a credential
+    was rejected.
+    """
+
+    def __init__(
+        self,
+        parameter_store_prefix,
+        parameter_names,
+        ttl=300,
+        max_stale=3600,
+        clock=time.monotonic,
+    ):
+        self.parameter_store_prefix = parameter_store_prefix
+        self.parameter_names = parameter_names
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._clock = clock
+        # Created up front: creating boto3 clients concurrently with other threads isn't thread safe.
+        self._ssm_client = boto3.client("ssm")
+        self._config = None
+        self._fetched_at = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return the config, fetching it if there is none or it is older than `ttl`."""
+        with self._lock:
+            age = None if self._config is None else self._clock() - self._fetched_at
+            if age is not None and age <= self.ttl:
+                return self._config
+            stale = None
+            if age is not None and age <= self.ttl + self.max_stale:
+                if self._refreshing:
+                    return self._config
+                stale = self._config
+                self._refreshing = True
+        try:
+            return self._fetch()
+        except Exception:
+            if stale is None:
+                raise
+            logger.exception("Failed to refresh config, keeping the stale one")
+            return stale
+        finally:
+            if stale is not None:
+                with self._lock:
+                    self._refreshing = False
+
+    def invalidate(self):
+        """Drop the cached config, so the next `get` fetches it."""
+        with self._lock:
+            self._config = None
+            self._fetched_at = None
+
+    def _fetch(self):
+        logger.info("Retrieving config")
+        config = get_config(
+            self.parameter_store_prefix, self.parameter_names, self._ssm_client
+        )
+        with self._lock:
+            self._config = config
+            self._fetched_at = self._clock()
+        return config
@@ -0,0 +1,62 @@
+"""End-to-end tests of streamed model responses which aren't strict JSON, against the fake Bedrock endpoint."""
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from fake_bedrock import FakeBedrock  # noqa: E402
+from providers import ModelResponseError  # noqa: E402
+from providers.bedrock import STREAM_MAX_PREAMBLE, Claude  # noqa: E402
+
+FILE = {"filename": "src/foo.py", "contents": 'print("hi")\n'}
+# A continuation of the object opened by the prompt, with the quotes in the contents left unescaped.
+UNESCAPED_QUOTES = (
+    '"description": "Print a greeting", "title": "Greet", '
+    '"source_code": [{"filename": "src/foo.py", "contents": "print("hi")\n"}]}'
+)
+PROSE_PREFIXED = "Here is the fix:\n```json\n{}\n```".format(
+    json.dumps(
+        {"description": "Print a greeting", "title": "Greet", "source_code": [FILE]}
+    )
+)
+
+
+@pytest.fixture(autouse=True)
+def aws_credentials(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "fake")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "fake")
+
+
+@pytest.mark.parametrize(
+    "completion", [UNESCAPED_QUOTES, PROSE_PREFIXED], ids=["unescaped_quotes", "prose"]
+)
+def test_streamed_response_is_repaired(completion):
+    with FakeBedrock(
+        respond=lambda body: completion, first_token_delay=0, tokens_per_second=10000
+    ) as fake:
+        provider = Claude(endpoint_url=fake.endpoint_url)
+        result = provider.fix_code("KeyError: 'x'", {"src/foo.py": "x = 1\n"}, "files")
+    assert result["title"] == "Greet"
+    assert result["source_code"] == [FILE]
+    assert provider.invocations[-1]["outcome"] == "ok"
+
+
+def test_streamed_refusal_is_aborted():
+    refusal = (
+        "I apologize, but I cannot determine the fix from this stack trace. " * 100
+    )
+    with FakeBedrock(
+        respond=lambda body: refusal, first_token_delay=0, tokens_per_second=10000
+    ) as fake:
+        provider = Claude(endpoint_url=fake.endpoint_url)
+        with pytest.raises(ModelResponseError, match="no JSON object"):
+            provider.fix_code("KeyError: 'x'", {"src/foo.py": "x = 1\n"}, "files")
+    metrics = provider.invocations[-1]
+    assert metrics["outcome"] == "aborted"
+    # Aborted within the preamble, rather than at the end of the response.
+    assert metrics["output_tokens"] * 4 < 2 * STREAM_MAX_PREAMBLE
@@ -0,0 +1,38 @@
+"""Tests of the exception type fingerprints are keyed on."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from fingerprint import Fingerprinter  # noqa: E402
+
+CHAINED = """Traceback (most recent call last):
+  File "/var/task/handlers/create_order.py", line 14, in handler
+    order_items = body["order_items"]
+KeyError: 'order_items'
+
+During handling of the above exception, another exception occurred:
+
+Traceback (most recent call last):
+  File "/var/task/handlers/create_order.py", line 16, in handler
+    raise {final}("Order has no items")
+{final}: Order has no items
+"""
+LAMBDA = """[ERROR] {final}: Retry after a TimeoutError
+Traceback (most recent call last):
+  File "/var/task/handlers/create_order.py", line 14, in handler
+    raise {final}("Retry after a TimeoutError")
+"""
+
+
+@pytest.mark.parametrize("trace", [CHAINED, LAMBDA], ids=["chained", "lambda"])
+def test_exception_type_is_the_final_one(trace):
+    fingerprinter = Fingerprinter()
+    value_error = trace.format(final="ValueError")
+    type_error = trace.format(final="TypeError")
+    assert fingerprinter.frames(value_error)[0] == "ValueError"
+    assert fingerprinter.fingerprint(value_error) != fingerprinter.fingerprint(
+        type_error
+    )
@@ -0,0 +1,84 @@
+"""Tests of the retries of throttled and transiently failed model calls."""
+import os
+import sys
+
+import botocore.exceptions
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from providers.governor import ModelCallGovernor, ThrottledError  # noqa: E402
+
+
+def client_error(code, status):
+    return botocore.exceptions.ClientError(
+        {
+            "Error": {"Code": code, "Message": code},
+            "ResponseMetadata": {"HTTPStatusCode": status},
+        },
+        "InvokeModelWithResponseStream",
+    )
+
+
+def failing(errors):
+    """Return a model call raising each of `errors` in turn, then returning "done"."""
+    errors = list(errors)
+
+    def function(target):
+        if errors:
+            raise errors.pop(0)
+        return "done"
+
+    return function
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        client_error("InternalServerException", 500),
+        client_error("ServiceUnavailable", 503),
+        botocore.exceptions.EndpointConnectionError(endpoint_url="https://bedrock"),
+        ValueError("Error raised by bedrock service"),
+    ],
+    ids=["internal", "unavailable", "connection", "wrapped"],
+)
+def test_transient_error_is_retried_without_changing_limit(error):
+    if isinstance(error, ValueError):
+        error.__cause__ = client_error("InternalServerException", 500)
+    governor = ModelCallGovernor(sleep=lambda delay: None)
+    limit = governor.limiters[0].limit
+    metrics = {}
+    assert governor.call(failing([error, error]), metrics) == "done"
+    assert metrics["attempts"] == 3
+    assert metrics["errors"] == 2
+    assert metrics["throttles"] == 0
+    assert governor.limiters[0].limit >= limit
+
+
+def test_throttle_decreases_limit():
+    governor = ModelCallGovernor(sleep=lambda delay: None)
+    limit = governor.limiters[0].limit
+    metrics = {}
+    assert (
+        governor.call(failing([client_error("ThrottlingException", 429)]), metrics)
+        == "done"
+    )
+    assert metrics["throttles"] == 1
+    assert governor.limiters[0].limit < limit
+
+
+def test_last_error_is_raised_after_every_attempt():
+    governor = ModelCallGovernor(max_attempts=2, sleep=lambda delay: None)
+    error = client_error("InternalServerException", 500)
+    with pytest.raises(botocore.exceptions.ClientError):
+        governor.call(failing([error, error]))
+    with pytest.raises(ThrottledError):
+        governor.call(failing([client_error("ThrottlingException", 429)] * 2))
+
+
+def test_other_error_is_not_retried():
+    governor = ModelCallGovernor(sleep=lambda delay: None)
+    metrics = {}
+    with pytest.raises(KeyError):
+        governor.call(failing([KeyError("content")]), metrics)
+    assert metrics["attempts"] == 1